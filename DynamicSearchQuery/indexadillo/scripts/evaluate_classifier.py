@@ -0,0 +1,103 @@
+"""
+Offline evaluation of the embedding classifier against labels produced by the chat model.
+
+The input is a JSON lines file with one chunk per line that carries at least `embedding` and
+`classification`, e.g. the output of the classify activity or documents exported from the index
+(`select=embedding,classification`). No service is called unless --examples is used, in which case
+the labelled examples are embedded with the Azure OpenAI settings from the environment.
+
+    python scripts/evaluate_classifier.py chunks.jsonl --folds 5
+    python scripts/evaluate_classifier.py chunks.jsonl --examples
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from collections import Counter
+from typing import List
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from activities.embedding import embed_texts  # noqa: E402
+from application.embeddingclassifier import EmbeddingClassifier, get_embedding_classifier  # noqa: E402
+
+MARGINS = [0.0, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15]
+
+
+def load_chunks(path: str):
+    vectors, labels = [], []
+    with open(path, encoding="utf-8") as chunks_file:
+        for line in chunks_file:
+            if line.strip():
+                chunk = json.loads(line)
+                vectors.append(chunk["embedding"])
+                labels.append(chunk["classification"])
+    return np.asarray(vectors, dtype=np.float32), labels
+
+
+def cross_validated_predictions(vectors: np.ndarray, labels: List[str], folds: int):
+    """Predict every chunk with centroids built from the other folds."""
+    predictions = [None] * len(labels)
+    confidence = np.zeros(len(labels), dtype=np.float32)
+    fold_of = np.arange(len(labels)) % folds
+    for fold in range(folds):
+        train = fold_of != fold
+        classifier = EmbeddingClassifier.from_examples(vectors[train], [label for label, keep in zip(labels, train) if keep])
+        test = np.flatnonzero(~train)
+        fold_predictions, fold_confidence = classifier.predict(vectors[test])
+        for position, prediction, score in zip(test, fold_predictions, fold_confidence):
+            predictions[position] = prediction
+            confidence[position] = score
+    return predictions, confidence
+
+
+async def example_predictions(vectors: np.ndarray):
+    from openai import AsyncAzureOpenAI
+
+    async with AsyncAzureOpenAI(
+        azure_endpoint=os.getenv("AOPENAI_ENDPOINT"),
+        api_key=os.getenv("AOPENAI_API_KEY"),
+        api_version=os.getenv("AOPENAI_API_VERSION")
+    ) as client:
+        classifier = await get_embedding_classifier(lambda texts: embed_texts(client, texts))
+    return classifier.predict(vectors)
+
+
+def report(labels: List[str], predictions: List[str], confidence: np.ndarray):
+    labels = np.asarray(labels)
+    predictions = np.asarray(predictions)
+    print(f"Chunks: {len(labels)}  label distribution: {dict(Counter(labels.tolist()))}")
+    print(f"Agreement without fallback: {np.mean(labels == predictions):.3f}")
+    print()
+    print("margin  handled by embeddings  agreement on handled  chat calls saved")
+    for margin in MARGINS:
+        handled = confidence >= margin
+        agreement = np.mean(labels[handled] == predictions[handled]) if handled.any() else float("nan")
+        print(f"{margin:6.3f}  {np.mean(handled):21.3f}  {agreement:20.3f}  {int(handled.sum()):16d}")
+    print()
+    print("Per label (chat label -> embedding label):")
+    for label in sorted(set(labels.tolist())):
+        confusion = Counter(predictions[labels == label].tolist())
+        print(f"  {label}: {dict(confusion.most_common())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("chunks", help="JSON lines file with embedded and classified chunks")
+    parser.add_argument("--folds", type=int, default=5, help="cross validation folds when building centroids from the input")
+    parser.add_argument("--examples", action="store_true", help="build centroids from the shipped labelled examples instead")
+    args = parser.parse_args()
+
+    vectors, labels = load_chunks(args.chunks)
+    if args.examples:
+        predictions, confidence = asyncio.run(example_predictions(vectors))
+    else:
+        predictions, confidence = cross_validated_predictions(vectors, labels, args.folds)
+    report(labels, predictions, confidence)
+
+
+if __name__ == "__main__":
+    main()
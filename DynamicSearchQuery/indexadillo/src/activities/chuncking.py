@@ -1,37 +1,69 @@
 from application.app import app
+from application.payloadstore import load_payload, offload_threshold, store_payload
+from bisect import bisect_right
 from chonkie import SentenceChunker
+from itertools import accumulate
 from typing import List, Dict
+import threading
+
+_chunker = None
+_chunker_lock = threading.Lock()
+
+def get_chunker() -> SentenceChunker:
+    """One chunker per worker process, so the tokenizer is only loaded on the first activity call."""
+    global _chunker
+    if _chunker is None:
+        with _chunker_lock:
+            if _chunker is None:
+                _chunker = SentenceChunker(
+                    tokenizer="gpt2",
+                    chunk_size=512,
+                    chunk_overlap=128,
+                    min_sentences_per_chunk=1
+                )
+    return _chunker
 
 @app.function_name(name="chunking")
 @app.activity_trigger(input_name="document")
 def chunking(document: Dict) -> List[str]:
-    chunker = SentenceChunker(
-        tokenizer="gpt2",
-        chunk_size=512,
-        chunk_overlap=128,
-        min_sentences_per_chunk=1
-    )
+    document, threshold = offload_threshold(document)
+    return store_payload(chunk_document(load_payload(document)), "chunks", threshold)
+
+@app.function_name(name="chunk_documents")
+@app.activity_trigger(input_name="documents")
+def chunk_documents(documents: List[Dict]) -> List[Dict]:
+    """Chunks of several cracked documents in one list, used for document groups."""
+    return store_payload([chunk for document in documents for chunk in chunk_document(load_payload(document))], "chunks")
+
+def chunk_document(document: Dict) -> List[Dict]:
+    """Split the text of a cracked document into chunks that know their pages and position in the document."""
+    chunker = get_chunker()
     only_text_pages = [page for page in document["pages"]]
+    page_ends = page_offsets(only_text_pages)
     all_text = "".join(only_text_pages)
     chunks = chunker.chunk(all_text)
     chunks_with_page_numbers = []
-    for chunk in chunks:
+    for chunk_index, chunk in enumerate(chunks):
         chunks_with_page_numbers.append({
             "filename": document["filename"],
             "url": document["url"],
             "text": chunk.text,
-            "start_page": get_page_number(chunk.start_index, only_text_pages),
-            "end_page": get_page_number(chunk.end_index, only_text_pages),
+            "start_page": get_page_number(chunk.start_index, page_ends),
+            "end_page": get_page_number(chunk.end_index, page_ends),
             "start_index": chunk.start_index,
             "end_index": chunk.end_index,
             "token_count": chunk.token_count,
+            # Position of the chunk in the document, its index document id is derived from it
+            "chunk_index": chunk_index,
         })
     return chunks_with_page_numbers
 
-def get_page_number(position: int, pages: List[str]) -> int:
-    position -= 1
-    for page_number, page_content in enumerate(pages):
-        if position < len(page_content):
-            return page_number
-        position -= len(page_content)
-    raise ValueError("Position out of range")
\ No newline at end of file
+def page_offsets(pages: List[str]) -> List[int]:
+    """Offset in the joined text at which every page ends."""
+    return list(accumulate(len(page) for page in pages))
+
+def get_page_number(position: int, page_ends: List[int]) -> int:
+    page_number = bisect_right(page_ends, position - 1)
+    if page_number == len(page_ends):
+        raise ValueError("Position out of range")
+    return page_number
@@ -0,0 +1,200 @@
+from application.app import app
+from application.storage import get_container_client
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.durable_functions import DurableOrchestrationClient, OrchestrationRuntimeStatus
+from typing import Dict, List, Optional, Tuple, Union
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger("scripts")
+
+DOCUMENT_CLAIMS_CONTAINER = os.getenv("DOCUMENT_CLAIMS_CONTAINER", "document-claims")
+# A claimed document that was not started within this time is claimed again by the next run
+DOCUMENT_CLAIM_TIMEOUT_SECONDS = int(os.getenv("DOCUMENT_CLAIM_TIMEOUT_SECONDS", "3600"))
+DOCUMENT_CLAIM_PARALLEL = int(os.getenv("DOCUMENT_CLAIM_PARALLEL", "16"))
+
+ACTIVE_STATUSES = {
+    OrchestrationRuntimeStatus.Pending,
+    OrchestrationRuntimeStatus.Running,
+    OrchestrationRuntimeStatus.ContinuedAsNew,
+    OrchestrationRuntimeStatus.Suspended,
+}
+
+
+def document_instance_id(index_name: str, blob: Dict) -> str:
+    """Instance id of the `index_document` orchestration of one version of a blob in an index."""
+    name = blob.get("blob_name") or blob["blob_url"].split("?")[0]
+    version = blob.get("etag") or blob.get("content_md5") or ""
+    return "document-" + hashlib.sha256(f"{index_name}|{name}|{version}".encode("utf-8")).hexdigest()[:32]
+
+
+class DocumentClaims:
+    """
+    Which `index_document` instance is responsible for a blob of an index, one small JSON blob per index
+    and source blob in the AzureWebJobsStorage account. Claims are written with ETag optimistic concurrency,
+    so of two runs claiming the same blob at the same time only one wins.
+    """
+
+    def __init__(self, index_name: str):
+        self.index_name = index_name
+        self.container_client = get_container_client(DOCUMENT_CLAIMS_CONTAINER)
+
+    def entry_name(self, blob_name: str) -> str:
+        return f"{self.index_name}/{hashlib.sha256(blob_name.encode('utf-8')).hexdigest()}.json"
+
+    def read(self, blob_name: str) -> Tuple[Optional[Dict], Optional[str]]:
+        """The claim of a blob and its storage ETag, (None, None) if the blob was never claimed."""
+        try:
+            downloader = self.container_client.download_blob(self.entry_name(blob_name))
+            return json.loads(downloader.readall()), downloader.properties.etag
+        except ResourceNotFoundError:
+            return None, None
+
+    def write(self, blob_name: str, claim: Dict, etag: Optional[str]) -> bool:
+        """Replace the claim read with `etag` (None: create it), False if someone else changed it in between."""
+        try:
+            if etag is None:
+                self.container_client.upload_blob(self.entry_name(blob_name), json.dumps(claim))
+            else:
+                self.container_client.upload_blob(self.entry_name(blob_name), json.dumps(claim), overwrite=True,
+                                                  etag=etag, match_condition=MatchConditions.IfNotModified)
+            return True
+        except (ResourceExistsError, ResourceModifiedError):
+            return False
+
+
+def completed_successfully(status) -> bool:
+    """Whether an `index_document` instance finished with all chunks uploaded."""
+    if status.runtime_status != OrchestrationRuntimeStatus.Completed:
+        return False
+    output = status.output if isinstance(status.output, dict) else {}
+    return not output.get("failed") and not output.get("superseded")
+
+
+async def claim_document(client: DurableOrchestrationClient, claims: DocumentClaims, blob: Dict, owner: str,
+                         page: Optional[str] = None) -> str:
+    """
+    Claim a blob for the `index_document` instance of its version. Returns "claimed", "superseded" when a
+    claim for another version was taken over, or "deduplicated" when the document is already in the works,
+    already indexed, or was listed twice by the same run. `page` identifies the listing page of the owner, a
+    claim made for the same page again (a retried activity) is not a duplicate.
+    """
+    instance_id = document_instance_id(claims.index_name, blob)
+    existing, etag = await asyncio.to_thread(claims.read, blob["blob_name"])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    outcome = "claimed"
+    if existing is not None:
+        status = await client.get_status(existing["instance_id"])
+        active = status.runtime_status in ACTIVE_STATUSES
+        if existing["instance_id"] == instance_id:
+            if existing["owner"] == owner:
+                if existing.get("page") != page:
+                    # Listed again by the same run, e.g. through overlapping prefixes
+                    return "deduplicated"
+            else:
+                claimed_at = datetime.datetime.fromisoformat(existing["claimed_at"])
+                waiting_to_start = status.runtime_status is None \
+                    and (now - claimed_at).total_seconds() < DOCUMENT_CLAIM_TIMEOUT_SECONDS
+                if active or waiting_to_start or completed_successfully(status):
+                    return "deduplicated"
+        elif blob.get("last_modified") and existing.get("last_modified") and blob["last_modified"] < existing["last_modified"]:
+            # This run listed the blob before it was overwritten, the newer version is already claimed
+            return "deduplicated"
+        elif active:
+            # The running instance notices that it was superseded before it embeds or uploads
+            outcome = "superseded"
+
+    claim = {
+        "instance_id": instance_id,
+        "owner": owner,
+        "page": page,
+        "etag": blob.get("etag"),
+        "last_modified": blob.get("last_modified"),
+        "claimed_at": now.isoformat(),
+    }
+    if not await asyncio.to_thread(claims.write, blob["blob_name"], claim, etag):
+        return "deduplicated"
+    return outcome
+
+
+def unique_blobs(blobs: List[Dict]) -> List[Dict]:
+    """The first listing of every blob name, a blob listed twice within a page is claimed once."""
+    seen = set()
+    unique = []
+    for blob in blobs:
+        if blob["blob_name"] not in seen:
+            seen.add(blob["blob_name"])
+            unique.append(blob)
+    return unique
+
+
+@app.function_name(name="claim_documents")
+@app.activity_trigger(input_name="params")
+@app.durable_client_input(client_name="client")
+async def claim_documents(params: dict, client: DurableOrchestrationClient) -> Dict:
+    """
+    Claims the blobs of a listing page for this run. Returns the claimed blobs with the `instance_id` of
+    their `index_document` orchestration and the number of blobs that were deduplicated or superseded.
+    """
+    claims = DocumentClaims(params["index_name"])
+    semaphore = asyncio.Semaphore(DOCUMENT_CLAIM_PARALLEL)
+
+    async def claim(blob: Dict) -> str:
+        async with semaphore:
+            return await claim_document(client, claims, blob, params["owner"], params.get("page"))
+
+    blobs = unique_blobs(params["blobs"])
+    outcomes = await asyncio.gather(*[claim(blob) for blob in blobs])
+    outcomes += ["deduplicated"] * (len(params["blobs"]) - len(blobs))
+    claimed = [
+        {**blob, "instance_id": document_instance_id(claims.index_name, blob)}
+        for blob, outcome in zip(blobs, outcomes) if outcome != "deduplicated"
+    ]
+    result = {
+        "blobs": claimed,
+        "deduplicated": outcomes.count("deduplicated"),
+        "superseded": outcomes.count("superseded"),
+    }
+    logger.info(f"Claimed {len(claimed)} of {len(params['blobs'])} blobs, {result['deduplicated']} deduplicated, {result['superseded']} superseded")
+    return result
+
+
+@app.function_name(name="release_document_claims")
+@app.activity_trigger(input_name="params")
+def release_document_claims(params: dict):
+    """
+    Removes the claims of documents that were processed in a document group, whose `index_document`
+    instance ids never ran, so the claims do not look like documents waiting to be started.
+    """
+    claims = DocumentClaims(params["index_name"])
+    for blob in params["blobs"]:
+        claim, etag = claims.read(blob["blob_name"])
+        if claim is not None and claim["instance_id"] == blob["instance_id"]:
+            try:
+                claims.container_client.delete_blob(claims.entry_name(blob["blob_name"]), etag=etag,
+                                                    match_condition=MatchConditions.IfNotModified)
+            except (ResourceModifiedError, ResourceNotFoundError):
+                pass
+
+
+@app.function_name(name="check_document_claim")
+@app.activity_trigger(input_name="params")
+def check_document_claim(params: dict) -> Union[bool, List[bool]]:
+    """
+    Whether the `index_document` instance still holds the claim of its blob, or a list with the answer for
+    every blob of `blobs` for document groups.
+    """
+    claims = DocumentClaims(params["index_name"])
+
+    def holds(blob: Dict) -> bool:
+        claim, _ = claims.read(blob["blob_name"])
+        return claim is None or claim["instance_id"] == blob["instance_id"]
+
+    if "blobs" in params:
+        return [holds(blob) for blob in params["blobs"]]
+    return holds(params)
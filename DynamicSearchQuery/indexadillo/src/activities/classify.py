@@ -1,78 +1,184 @@
 from application.app import app
-from typing import List, Dict
+from application.payloadstore import load_payload, offload_threshold, store_payload
+from application.clients import get_openai_client
+from application.embeddingclassifier import CLASSIFY_EMBEDDING_MIN_MARGIN, get_embedding_classifier
+from application.ratelimit import get_rate_limiter
+from application.vectorcodec import chunk_list, embedding_matrix
+from typing import List, Dict, Optional
+import asyncio
+import json
 import logging
 import os
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
+from activities.embedding import embed_cached
 
 logger = logging.getLogger("scripts")
 
+LABELS = ["PreambleBlock", "TermsandconditionsBlock", "SignatureBlock", "ServiceBlock", "PricingBlock", "Other"]
+
+# Number of chunks classified by a single chat completion, 1 sends one request per chunk
+CLASSIFY_BATCH_SIZE = int(os.getenv("CLASSIFY_BATCH_SIZE", "20"))
+CLASSIFY_MAX_IN_FLIGHT = int(os.getenv("CLASSIFY_MAX_IN_FLIGHT", "4"))
+# "llm" asks the chat model for every chunk, "embedding" only for chunks the embedding classifier is unsure about
+CLASSIFY_MODE = os.getenv("CLASSIFY_MODE", "llm").lower()
+
+CLASSIFICATION_GUIDELINES = """
+Classification guidelines:
+PreambleBlock: introductory or background statements
+TermsandconditionsBlock: references terms, conditions, obligations, disclaimers, or policies
+SignatureBlock: references signature lines or signatories
+ServiceBlock: references scope of services or the services provided
+PricingBlock: references fees, costs, or pricing details
+Other: if no clear match above
+
+Example#1:
+Text: This Agreement contains the entire agreement between the parties with respectto the subject matter hereof and supersedes all oral understandings, representations, prior discussions andpreliminary agreements. Any representations, warranties, promise or conditions not expressly contained in thisAgreement shall not be binding upon the parties.MICROSOFT CORPORATIONBy1281.NameRex SmithTitleEM MIN OPSSignature Date6-29-00 XXXCompany, INC.ByNameAAAPersonTitleBBBTitleSignature Date6/29/00US 6/29/0FINANCEAPPROVALAPPROVED26/29/09EXODUS
+Classification: SignatureBlock
+
+Example#2:
+Text: 13.TERM & TERMINATION.(a)Duration. This Agreement shall commence as of the Effective Date and shall continue in effectuntil terminated in accordance with this Section 13, provided that XXXCompany must complete all Services described inany then-effective Schedule which has not been previously terminated. YYYCompany may elect to terminate thisAgreement (and/or any Schedule) term without cause or without the occurrence of a Default, which terminationshall be effective upon ninety (90) days written notice of such cancellation. Except in cases of cancellation forDefault as specified in Section 13(b) of this Agreement, Microsoft will pay for all Services performed by Exodusuntil the date of termination of the Agreement (and/or applicable Schedule).(b)Early Termination and Default. The term of this Agreement is subject to early termination ofthe Agreement in accordance with the following:(1)This Agreement (and/or any Schedule) shall terminate automatically upon a Defaultunder Section 13(b)(ii)(D) below. Either party shall have the right to terminate this Agreement (and/or anySchedule) immediately upon a Default under Section 13(b)(ii)(A) or (B)
+Classification: TermsandconditionsBlock
+
+Example#3:
+Text: The term of the Services provided under this Schedule shall commence on July 1,2000 and shall expire on theone year anniversary of such date. The parties may renew the Term of this Schedule upon mutual writtenagreement
+Classification: TermsandconditionsBlock
+
+Example#4:
+Text: MASTER SERVICES AGREEMENTCONFIDENTIALThis Master Services Agreement ("Agreement") is made as of June 29, 2000 (the "Effective Date") by andbetween YYYCompany, a Washington corporation, with its chief executive offices at and amailing address of One Redmond, WA 98052 ("YYYCompany"), and XXXCompany, Inc. a ZZZ State corporation, with a mailing address of, and its chief executive offices at SantaClara, CA 95054 ("XXXCompany")
+Classification: PreambleBlock
+""".strip()
+
+# The system message is identical for every request, single or batch, so the service can reuse the cached
+# prompt prefix. Everything that varies per request (instructions, count, texts) goes into the user message.
+SYSTEM_PROMPT = f"""
+You are an expert legal contract documents analysis assistant.
+Classify texts of contracts into exactly one category each (no explanation):
+PreambleBlock, TermsandconditionsBlock, SignatureBlock,
+ServiceBlock, PricingBlock, Other.
+
+You Must do:
+1. Classification must be strictly one of:
+   PreambleBlock, TermsandconditionsBlock,
+   SignatureBlock, ServiceBlock, PricingBlock, Other.
+2. Refer Examples in the prompt to better understand the context.
+3. Do not use any other classification or explanation.
+
+{CLASSIFICATION_GUIDELINES}
+""".strip()
+
+SINGLE_PROMPT = """
+Only return the classification of the following text (no explanation).
+
+Text: {text}
+""".strip()
+
+BATCH_PROMPT = """
+Return only a JSON array of strings with one classification per numbered text below, in the order of the texts.
+The array must contain exactly {count} entries.
+
+{texts}
+""".strip()
+
+
+def parse_batch_response(content: str, count: int) -> Optional[List[str]]:
+    """Return the labels of a batch answer, or None if it is not a JSON array of `count` known labels."""
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.strip("`").removeprefix("json").strip()
+    try:
+        labels = json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(labels, list) or len(labels) != count:
+        return None
+    labels = [label.strip() if isinstance(label, str) else label for label in labels]
+    if any(label not in LABELS for label in labels):
+        return None
+    return labels
+
+
+async def create_completion(client: AsyncAzureOpenAI, prompt: str, max_tokens: int):
+    """One chat completion within the chat rate limit, the prompt is estimated at 4 characters per token."""
+    await get_rate_limiter("chat").acquire((len(SYSTEM_PROMPT) + len(prompt)) // 4 + max_tokens)
+    return await client.chat.completions.create(
+        model=os.getenv("AOPENAI_MODEL_DEPLOYMENT_NAME"),
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_tokens,
+        temperature=0
+    )
+
+
+async def classify_text(client: AsyncAzureOpenAI, text: str) -> str:
+    """Classify a single text, answers that are not one of LABELS count as "Other"."""
+    response = await create_completion(client, SINGLE_PROMPT.format(text=text), 10)
+    label = response.choices[0].message.content.strip().strip(".")
+    if label not in LABELS:
+        logger.warning(f"Unknown classification {label[:50]!r}, using Other")
+        return "Other"
+    return label
+
+
+async def classify_batch(client: AsyncAzureOpenAI, texts: List[str]) -> List[str]:
+    """Classify several texts with one request, falling back to one request per text if the answer is malformed."""
+    if len(texts) == 1:
+        return [await classify_text(client, texts[0])]
+
+    numbered_texts = "\n\n".join(f"Text {i + 1}: {text}" for i, text in enumerate(texts))
+    response = await create_completion(
+        client,
+        BATCH_PROMPT.format(count=len(texts), texts=numbered_texts),
+        12 * len(texts) + 20
+    )
+    labels = parse_batch_response(response.choices[0].message.content, len(texts))
+    if labels is None:
+        logger.warning(f"Malformed batch classification for {len(texts)} chunks, classifying them one by one")
+        labels = await asyncio.gather(*[classify_text(client, text) for text in texts])
+    return labels
+
+
+async def classify_texts(client: AsyncAzureOpenAI, texts: List[str]) -> List[str]:
+    """Classify `texts` in batches of CLASSIFY_BATCH_SIZE with at most CLASSIFY_MAX_IN_FLIGHT requests outstanding."""
+    semaphore = asyncio.Semaphore(CLASSIFY_MAX_IN_FLIGHT)
+    batch_size = max(CLASSIFY_BATCH_SIZE, 1)
+
+    async def run(batch: List[str]) -> List[str]:
+        async with semaphore:
+            return await classify_batch(client, batch)
+
+    results = await asyncio.gather(*[run(texts[i : i + batch_size]) for i in range(0, len(texts), batch_size)])
+    return [label for labels in results for label in labels]
+
+
 @app.function_name(name="classify")
 @app.activity_trigger(input_name="chunks")
-def classifychunks(chunks: List[Dict]) -> List[Dict]:
+async def classifychunks(chunks: List[Dict]) -> List[Dict]:
+    chunks, threshold = offload_threshold(chunks)
+    payload = await asyncio.to_thread(load_payload, chunks)
+    await classify_chunks(payload)
+    return await asyncio.to_thread(store_payload, payload, "classifications", threshold)
+
+
+async def classify_chunks(payload) -> None:
+    """Set the "classification" of every chunk of a packed or plain payload."""
+    chunks = chunk_list(payload)
     logger.info("classify the chunks")
     logger.info(f"Number of chunks: {len(chunks)}")
 
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AOPENAI_ENDPOINT"),
-        api_key=os.getenv("AOPENAI_API_KEY"),
-        api_version=os.getenv("AOPENAI_API_VERSION")
-    )
+    client = get_openai_client("chat")
+    texts = [chunk.get("text", "") for chunk in chunks]
+    if CLASSIFY_MODE == "embedding" and chunks:
+        classifier = await get_embedding_classifier(embed_cached)
+        classifications, confidence = classifier.predict(embedding_matrix(payload))
+        uncertain = [i for i in range(len(chunks)) if confidence[i] < CLASSIFY_EMBEDDING_MIN_MARGIN]
+        logger.info(f"Embedding classifier labelled {len(chunks) - len(uncertain)} chunks, {len(uncertain)} go to the chat model")
+        for i, classification in zip(uncertain, await classify_texts(client, [texts[i] for i in uncertain])):
+            classifications[i] = classification
+    else:
+        classifications = await classify_texts(client, texts)
 
-    for i, chunk in enumerate(chunks):
-        text = chunk.get("text", "")
-        prompt = f"""
-        Classify the following text into exactly one category (no explanation):
-        PreambleBlock, TermsandconditionsBlock, SignatureBlock,
-        ServiceBlock, PricingBlock, Other.  
-
-        You Must do:
-        1. Only return the classification (no explanation).
-        2. Classification must be strictly one of:
-           PreambleBlock, TermsandconditionsBlock,
-           SignatureBlock, ServiceBlock, PricingBlock, Other.
-        3. Refer Examples in the prompt to better understand the context.
-        4. Do not use any other classification or explanation.
-
-        Classification guidelines:
-        PreambleBlock: introductory or background statements
-        TermsandconditionsBlock: references terms, conditions, obligations, disclaimers, or policies
-        SignatureBlock: references signature lines or signatories
-        ServiceBlock: references scope of services or the services provided
-        PricingBlock: references fees, costs, or pricing details
-        Other: if no clear match above
-
-        Example#1:
-        Text: This Agreement contains the entire agreement between the parties with respectto the subject matter hereof and supersedes all oral understandings, representations, prior discussions andpreliminary agreements. Any representations, warranties, promise or conditions not expressly contained in thisAgreement shall not be binding upon the parties.MICROSOFT CORPORATIONBy1281.NameRex SmithTitleEM MIN OPSSignature Date6-29-00 XXXCompany, INC.ByNameAAAPersonTitleBBBTitleSignature Date6/29/00US 6/29/0FINANCEAPPROVALAPPROVED26/29/09EXODUS
-        Classification: SignatureBlock
-
-        Example#2:
-        Text: 13.TERM & TERMINATION.(a)Duration. This Agreement shall commence as of the Effective Date and shall continue in effectuntil terminated in accordance with this Section 13, provided that XXXCompany must complete all Services described inany then-effective Schedule which has not been previously terminated. YYYCompany may elect to terminate thisAgreement (and/or any Schedule) term without cause or without the occurrence of a Default, which terminationshall be effective upon ninety (90) days written notice of such cancellation. Except in cases of cancellation forDefault as specified in Section 13(b) of this Agreement, Microsoft will pay for all Services performed by Exodusuntil the date of termination of the Agreement (and/or applicable Schedule).(b)Early Termination and Default. The term of this Agreement is subject to early termination ofthe Agreement in accordance with the following:(1)This Agreement (and/or any Schedule) shall terminate automatically upon a Defaultunder Section 13(b)(ii)(D) below. Either party shall have the right to terminate this Agreement (and/or anySchedule) immediately upon a Default under Section 13(b)(ii)(A) or (B)
-        Classification: TermsandconditionsBlock
-
-        Example#3:
-        Text: The term of the Services provided under this Schedule shall commence on July 1,2000 and shall expire on theone year anniversary of such date. The parties may renew the Term of this Schedule upon mutual writtenagreement
-        Classification: TermsandconditionsBlock
-
-        Example#4:
-        Text: MASTER SERVICES AGREEMENTCONFIDENTIALThis Master Services Agreement ("Agreement") is made as of June 29, 2000 (the "Effective Date") by andbetween YYYCompany, a Washington corporation, with its chief executive offices at and amailing address of One Redmond, WA 98052 ("YYYCompany"), and XXXCompany, Inc. a ZZZ State corporation, with a mailing address of, and its chief executive offices at SantaClara, CA 95054 ("XXXCompany")
-        Classification: PreambleBlock
-        
-        Text: {text}
-                """.strip()
-
-        response = client.chat.completions.create(
-            model=os.getenv("AOPENAI_MODEL_DEPLOYMENT_NAME"),
-            messages=[
-                {"role": "system", "content": "You are an expert legal contract documents analysis assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=10,
-            temperature=0
-        )
-
-        classification = response.choices[0].message.content.strip()
+    for i, (chunk, classification) in enumerate(zip(chunks, classifications)):
         chunk["classification"] = classification
-
-        logger.info(f"Chunk {i}, Text: {text}, classification: {classification}")
-
-    return chunks
\ No newline at end of file
+        logger.info(f"Chunk {i}, Text: {chunk.get('text', '')}, classification: {classification}")
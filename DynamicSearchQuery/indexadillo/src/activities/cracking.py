@@ -1,65 +1,275 @@
 from application.app import app
+from application.payloadstore import offload_threshold, store_payload
+from application.clients import get_document_intelligence_client
+from application.ratelimit import get_rate_limiter
+from application.storage import get_container_client
+from activities.textformats import detect_format, parse_pages, sniff_format
+import asyncio
+import base64
+import datetime
+import json
+import logging
 import os
 from azure.identity import DefaultAzureCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeResult
-from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from urllib.parse import unquote, urlparse
-from typing import List, Dict
+from typing import List, Dict, Optional, Union
+
+logger = logging.getLogger("scripts")
+
+DI_MODEL_ID = os.getenv("DI_MODEL_ID", "prebuilt-layout")
+# The API version decides which version of the prebuilt model analyzes the document, it is part of the cache key
+DI_API_VERSION = os.getenv("DI_API_VERSION", "2024-07-31-preview")
+DI_CACHE_ENABLED = os.getenv("DI_CACHE_ENABLED", "true").lower() == "true"
+DI_CACHE_CONTAINER = os.getenv("DI_CACHE_CONTAINER", "cracking-cache")
+DI_CACHE_TTL_HOURS = float(os.getenv("DI_CACHE_TTL_HOURS", "720"))
+# PDF and TIFF documents are analyzed in ranges of this many pages, 0 analyzes every document with a single request
+DI_PAGE_RANGE_SIZE = int(os.getenv("DI_PAGE_RANGE_SIZE", "50"))
+DI_MAX_CONCURRENT_RANGES = int(os.getenv("DI_MAX_CONCURRENT_RANGES", "4"))
+
+PAGINATED_EXTENSIONS = (".pdf", ".tif", ".tiff")
+# Error codes Document Intelligence answers with when a page range starts after the last page of the document
+OUT_OF_RANGE_ERROR_CODES = {"InvalidContentRange"}
+
+# Parse text-native formats (txt, md, html, json, docx) in-process instead of sending them to Document Intelligence
+LOCAL_CRACKING_ENABLED = os.getenv("LOCAL_CRACKING_ENABLED", "true").lower() == "true"
+
+
+class CrackingCache:
+    """
+    Cache of the normalized Document Intelligence output (page texts with tables folded in), keyed by
+    the content hash of the source blob, the model id and the API version. Entries are shared by all
+    indexes and expire after DI_CACHE_TTL_HOURS.
+    """
+
+    def __init__(self, model_id: str, api_version: str, ttl_hours: float):
+        self.model_id = model_id
+        self.api_version = api_version
+        self.ttl = datetime.timedelta(hours=ttl_hours)
+        self._container_client = None
+
+    @property
+    def container_client(self):
+        # Created on first use, inside the error handling of get and put
+        if self._container_client is None:
+            self._container_client = get_container_client(DI_CACHE_CONTAINER)
+        return self._container_client
+
+    def entry_name(self, content_hash: str) -> str:
+        return f"{self.model_id}/{self.api_version}/{content_hash}.json"
+
+    def get(self, content_hash: str) -> Optional[List[str]]:
+        try:
+            entry = json.loads(self.container_client.download_blob(self.entry_name(content_hash)).readall())
+        except ResourceNotFoundError:
+            return None
+        except Exception as ex:
+            # The cache is optional, a storage outage only costs the Document Intelligence call
+            logger.warning(f"Cracking cache lookup failed, analyzing the document: {ex}")
+            return None
+        cached_at = datetime.datetime.fromisoformat(entry["cached_at"])
+        if datetime.datetime.now(datetime.timezone.utc) - cached_at > self.ttl:
+            return None
+        return entry["pages"]
+
+    def put(self, content_hash: str, pages: List[str]):
+        entry = {
+            "model_id": self.model_id,
+            "api_version": self.api_version,
+            "cached_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "pages": pages,
+        }
+        try:
+            self.container_client.upload_blob(self.entry_name(content_hash), json.dumps(entry), overwrite=True)
+        except Exception as ex:
+            logger.warning(f"Cracking cache write failed: {ex}")
+
+
+_cache = None
+
+
+def get_cracking_cache() -> Optional[CrackingCache]:
+    global _cache
+    if DI_CACHE_ENABLED and _cache is None:
+        _cache = CrackingCache(DI_MODEL_ID, DI_API_VERSION, DI_CACHE_TTL_HOURS)
+    return _cache
+
+
+def _source_storage():
+    # Imported on use, the listing imports the manifest, which takes the model id from here
+    from activities import listblob
+    return listblob
+
+
+def content_hash(blob: Dict) -> Optional[str]:
+    """
+    Hex MD5 of the blob content, taken from the listing or, for plain blob urls, the blob properties. None for
+    blobs uploaded in blocks without a stored MD5, they are not cached: hashing them would mean downloading
+    them just for the key.
+    """
+    if "content_md5" not in blob:
+        md5 = _source_storage().get_source_blob_client(blob["blob_url"]).get_blob_properties().content_settings.content_md5
+        return bytes(md5).hex() if md5 else None
+    # The listing already says whether there is a stored MD5
+    content_md5 = blob["content_md5"]
+    return base64.b64decode(content_md5).hex() if content_md5 else None
+
+
+def is_paginated(bloburl: str) -> bool:
+    """Only PDF and TIFF documents can be analyzed in page ranges."""
+    return unquote(urlparse(bloburl).path).lower().endswith(PAGINATED_EXTENSIONS)
+
+
+def page_range(index: int, range_size: int) -> str:
+    return f"{index * range_size + 1}-{(index + 1) * range_size}"
+
+
+def page_texts(results: List[AnalyzeResult]) -> List[str]:
+    """
+    Text of every page with its tables appended, merged from the results of one or more page ranges.
+    Page numbers in the results are absolute, so pages and tables are placed by their page number.
+    """
+    pages = {}
+    for result in results:
+        for page in result.pages:
+            pages[page.page_number] = "".join([line['content'] for line in page.lines or []])
 
-@app.function_name(name="document_cracking")
-@app.activity_trigger(input_name="bloburl")
-def document_cracking(bloburl: str) -> Dict:
-    endpoint = os.getenv("DI_ENDPOINT")
-    key = os.getenv("DI_KEY")  # Put your access key here
-
-    client = DocumentIntelligenceClient(endpoint, AzureKeyCredential(key))
-    poller = client.begin_analyze_document("prebuilt-layout", AnalyzeDocumentRequest(url_source=bloburl))
-    result: AnalyzeResult = poller.result()
-
-    # Get the number of pages in the document
-    num_pages = len(result.pages)
-    
-    # Initialize an array to store content for each page
-    page_contents = [""] * num_pages
-    
-    # Extract text from each page
-    for i, page in enumerate(result.pages):
-        page_contents[i] = "".join([line['content'] for line in page.lines])
-    
     # Process tables and place them in their corresponding pages
-    if result.tables:
-        for table in result.tables:
+    for result in results:
+        for table in result.tables or []:
             # Determine which page the table belongs to (using the first cell's page number)
             if table.cells and hasattr(table.cells[0], 'bounding_regions') and table.cells[0].bounding_regions:
-                table_page_num = table.cells[0].bounding_regions[0].page_number - 1  # Convert to 0-based index
-                
+                table_page_num = table.cells[0].bounding_regions[0].page_number
+
                 # Create a formatted representation of the table
                 table_text = []
-                
+
                 # Create a 2D array to store the table cells
                 rows = max(cell.row_index for cell in table.cells) + 1
                 cols = max(cell.column_index for cell in table.cells) + 1
                 table_array = [['' for _ in range(cols)] for _ in range(rows)]
-                
+
                 # Fill in the array with cell content
                 for cell in table.cells:
                     row_idx = cell.row_index
                     col_idx = cell.column_index
                     table_array[row_idx][col_idx] = cell.content
-                
+
                 # Format table as text
                 table_text.append("\n--- TABLE START ---")
                 for row in table_array:
                     table_text.append(" | ".join(row))
                 table_text.append("--- TABLE END ---\n")
-                
+
                 # Add the table to the appropriate page
-                if 0 <= table_page_num < num_pages:
-                    page_contents[table_page_num] += "\n" + "\n".join(table_text)
-    
+                if table_page_num in pages:
+                    pages[table_page_num] += "\n" + "\n".join(table_text)
+
+    return [pages[number] for number in sorted(pages)]
+
+
+def is_out_of_range(error: HttpResponseError) -> bool:
+    """Whether Document Intelligence rejected a page range because it lies past the end of the document."""
+    details = error.error
+    if details is None:
+        return False
+    codes = {details.code, (details.innererror or {}).get("code")}
+    codes.update(detail.code for detail in details.details)
+    return not OUT_OF_RANGE_ERROR_CODES.isdisjoint(codes)
+
+
+async def analyze_range(client: DocumentIntelligenceClient, bloburl: str, pages: Optional[str] = None) -> AnalyzeResult:
+    await get_rate_limiter("document_intelligence").acquire()
+    poller = await client.begin_analyze_document(DI_MODEL_ID, AnalyzeDocumentRequest(url_source=bloburl), pages=pages)
+    return await poller.result()
+
+
+async def analyze_layout(client: DocumentIntelligenceClient, bloburl: str,
+                         range_size: int = DI_PAGE_RANGE_SIZE, max_concurrent: int = DI_MAX_CONCURRENT_RANGES) -> List[str]:
+    """
+    Analyze a document and return the text of its pages. PDF and TIFF documents are analyzed in ranges of
+    `range_size` pages. The page count is not known up front, so the first range is analyzed alone and, if it
+    comes back full, the following ranges are analyzed `max_concurrent` at a time until one comes back short.
+    """
+    if range_size <= 0 or not is_paginated(bloburl):
+        return page_texts([await analyze_range(client, bloburl)])
+
+    results = [await analyze_range(client, bloburl, page_range(0, range_size))]
+    done = len(results[0].pages) < range_size
+    next_range = 1
+    while not done:
+        wave = [page_range(index, range_size) for index in range(next_range, next_range + max_concurrent)]
+        next_range += max_concurrent
+        wave_results = await asyncio.gather(*[analyze_range(client, bloburl, pages) for pages in wave], return_exceptions=True)
+        for result in wave_results:
+            # Ranges that start after the last page are rejected as invalid, every other error fails the document
+            if isinstance(result, HttpResponseError) and is_out_of_range(result):
+                done = True
+                break
+            if isinstance(result, BaseException):
+                raise result
+            results.append(result)
+            if len(result.pages) < range_size:
+                done = True
+                break
+
+    logger.info(f"Analyzed {bloburl.split('?')[0]} in {len(results)} page ranges")
+    return page_texts(results)
+
+
+def crack_locally(blob: Dict) -> Optional[List[str]]:
+    """Page texts of a text-native blob, None if the blob has to be analyzed by Document Intelligence."""
+    blob_client = _source_storage().get_source_blob_client(blob["blob_url"])
+    filename = unquote(urlparse(blob["blob_url"]).path.split("/")[-1])
+    format = detect_format(filename, blob.get("content_type"))
+    if format is None and "." not in filename and "content_type" not in blob:
+        # No extension to go by and no content type from the listing, ask the blob
+        format = detect_format(filename, blob_client.get_blob_properties().content_settings.content_type)
+    if format is None:
+        return None
+    data = blob_client.download_blob().readall()
+    # Scanned or mislabelled content still goes to Document Intelligence
+    if sniff_format(data, format) is None:
+        return None
+    return parse_pages(data, format)
+
+
+@app.function_name(name="document_cracking")
+@app.activity_trigger(input_name="bloburl")
+async def document_cracking(bloburl: Union[str, Dict]) -> Dict:
+    # Accepts the blob descriptor from the listing or a plain blob url
+    bloburl, threshold = offload_threshold(bloburl)
+    blob = bloburl if isinstance(bloburl, dict) else {"blob_url": bloburl}
+    return await asyncio.to_thread(store_payload, await crack_document(blob), "document", threshold)
+
+
+async def crack_document(blob: Dict) -> Dict:
+    """The page texts of a blob descriptor as `{"pages", "url", "filename"}`, the url is the one of the descriptor."""
+    url = blob["blob_url"]
+
+    page_contents = await asyncio.to_thread(crack_locally, blob) if LOCAL_CRACKING_ENABLED else None
+    if page_contents is not None:
+        logger.info(f"Parsed {blob.get('blob_name', url.split('?')[0])} locally")
+
+    cache = get_cracking_cache() if page_contents is None else None
+    cache_key = await asyncio.to_thread(content_hash, blob) if cache else None
+    if cache_key is None:
+        cache = None
+    if cache:
+        page_contents = await asyncio.to_thread(cache.get, cache_key)
+        if page_contents is not None:
+            logger.info(f"Using cached {DI_MODEL_ID} output for {blob.get('blob_name', cache_key)}")
+    if page_contents is None:
+        # Document Intelligence reads the blob by url, the SAS is not passed on with the cracked document
+        signed_url = await asyncio.to_thread(_source_storage().sign_blob_url, url)
+        page_contents = await analyze_layout(get_document_intelligence_client(DI_API_VERSION), signed_url)
+        if cache:
+            await asyncio.to_thread(cache.put, cache_key, page_contents)
+
     return {
         "pages": page_contents,
-        "url": bloburl,
-        "filename": unquote(urlparse(bloburl)[2].split("/")[-1])
-    }
\ No newline at end of file
+        "url": url,
+        "filename": unquote(urlparse(url)[2].split("/")[-1])
+    }
@@ -1,26 +1,110 @@
 from application.app import app
+from application.batching import pack_batches
+from application.embeddingcache import get_embedding_cache
+from application.payloadstore import load_payload, offload_threshold, store_payload
+from application.clients import get_openai_client
+from application.ratelimit import get_rate_limiter
+from application.vectorcodec import pack_embeddings
+import asyncio
+import logging
 import os
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from openai import AzureOpenAI
+import threading
+import tiktoken
+from openai import AsyncAzureOpenAI
 from typing import List, Dict
 
+logger = logging.getLogger("scripts")
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSIONS = 3072
+
+# Limits for a single embeddings request and the number of requests in flight per activity
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDING_BATCH_MAX_INPUTS", "256"))
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", "4"))
+# Tokenizer of the embedding model, the token counts of the chunker are gpt2 tokens
+EMBEDDING_TOKENIZER = "cl100k_base"
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """The tokenizer of the embedding model, None if it can not be loaded (tiktoken downloads it on first use)."""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                _encoding = tiktoken.get_encoding(EMBEDDING_TOKENIZER)
+            except Exception as error:
+                logger.warning(f"Could not load the {EMBEDDING_TOKENIZER} tokenizer, counting UTF-8 bytes instead: {error}")
+                _encoding = False
+        return _encoding or None
+
+
+def count_tokens(texts: List[str]) -> List[int]:
+    """Tokens of `texts` for the embedding model. Without the tokenizer the UTF-8 size is used, no text has more tokens than bytes."""
+    encoding = get_encoding()
+    if encoding is None:
+        return [len(text.encode("utf-8")) for text in texts]
+    return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
+
+
+async def embed_texts(client: AsyncAzureOpenAI, texts: List[str]) -> List[List[float]]:
+    """Embed `texts` in token budgeted batches with a bounded number of concurrent requests, keeping the input order."""
+    token_counts = await asyncio.to_thread(count_tokens, texts)
+    batches = pack_batches(token_counts, EMBEDDING_BATCH_MAX_TOKENS, EMBEDDING_BATCH_MAX_INPUTS)
+    semaphore = asyncio.Semaphore(EMBEDDING_MAX_IN_FLIGHT)
+    vectors: List[List[float]] = [None] * len(texts)
+
+    async def embed_batch(batch: List[int]):
+        async with semaphore:
+            await get_rate_limiter("embedding").acquire(sum(token_counts[i] for i in batch))
+            response = await client.embeddings.create(
+                input=[texts[i] for i in batch],
+                model=EMBEDDING_MODEL,
+                # Requested explicitly, the cache keys vectors by these dimensions
+                dimensions=EMBEDDING_DIMENSIONS
+            )
+        # The response carries the input position of every vector
+        for item in response.data:
+            vectors[batch[item.index]] = item.embedding
+
+    await asyncio.gather(*[embed_batch(batch) for batch in batches])
+    logger.info(f"Embedded {len(texts)} texts in {len(batches)} requests")
+    return vectors
+
+
 @app.function_name(name="embedding")
 @app.activity_trigger(input_name="chunks")
-def embedding(chunks: List[Dict]) -> List[Dict]:
-    endpoint = os.getenv("AOPENAI_ENDPOINT")
-    api_key = os.getenv("AOPENAI_API_KEY")
-
-    # Use key-based auth instead of token-based auth
-    client = AzureOpenAI(
-        api_version="2024-02-15-preview",
-        azure_endpoint=endpoint,
-        api_key=api_key
-    )
-
-    embeddings = client.embeddings.create(
-        input=[chunk["text"] for chunk in chunks],
-        model="text-embedding-3-large"
-    )
-    for i, chunk in enumerate(chunks):
-        chunk["embedding"] = embeddings.data[i].embedding
-    return chunks
\ No newline at end of file
+async def embedding(chunks: List[Dict]) -> List[Dict]:
+    chunks, threshold = offload_threshold(chunks)
+    chunks = await embed_chunks(await asyncio.to_thread(load_payload, chunks))
+    return await asyncio.to_thread(store_payload, pack_embeddings(chunks), "embeddings", threshold)
+
+
+async def embed_chunks(chunks: List[Dict]) -> List[Dict]:
+    """Set the "embedding" of every chunk, from the embedding cache where possible."""
+    vectors = await embed_cached([chunk["text"] for chunk in chunks])
+    for chunk, vector in zip(chunks, vectors):
+        chunk["embedding"] = vector
+    return chunks
+
+
+async def embed_cached(texts: List[str]) -> List[List[float]]:
+    """The embeddings of `texts`, only the ones missing from the embedding cache are requested."""
+    cache = get_embedding_cache(EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+    vectors = await asyncio.to_thread(cache.get_many, texts) if cache else [None] * len(texts)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+    if missing:
+        embedded = await embed_texts(get_openai_client("embedding"), [texts[i] for i in missing])
+        for i, vector in zip(missing, embedded):
+            vectors[i] = vector
+        if cache:
+            await asyncio.to_thread(cache.put_many, [texts[i] for i in missing], embedded)
+
+    logger.info(f"Embedded {len(missing)} of {len(texts)} texts, {len(texts) - len(missing)} served from cache")
+    if cache:
+        logger.info(f"Embedding cache totals for this worker: {cache.hits} hits, {cache.misses} misses")
+    return vectors
@@ -0,0 +1,39 @@
+from application.app import app
+from azure.durable_functions import DurableOrchestrationClient
+import logging
+
+logger = logging.getLogger("scripts")
+
+
+async def start_once(client: DurableOrchestrationClient, name: str, instance_id: str, client_input: dict) -> bool:
+    """
+    Starts an orchestration under a fixed instance id unless it exists already, True if this call started it.
+    Concurrent callers can both find the instance missing, the start of the slower one then fails because
+    the instance already exists, which counts as started.
+    """
+    status = await client.get_status(instance_id)
+    if status and status.runtime_status is not None:
+        return False
+    try:
+        await client.start_new(name, instance_id=instance_id, client_input=client_input)
+        return True
+    except Exception:
+        status = await client.get_status(instance_id)
+        if status and status.runtime_status is not None:
+            return False
+        raise
+
+
+@app.function_name(name="start_index_batch")
+@app.activity_trigger(input_name="batch")
+@app.durable_client_input(client_name="client")
+async def start_index_batch(batch: dict, client: DurableOrchestrationClient) -> str:
+    """
+    Starts an `index` orchestration for a batch of blob paths flushed from the event buffer. The instance id
+    is derived from the window and batch number, so a retried activity does not start the batch twice.
+    """
+    if await start_once(client, "index", batch["instance_id"], batch["input"]):
+        logger.info(f"Started indexing of {len(batch['input']['prefix_list'])} blobs with id: {batch['instance_id']}")
+    else:
+        logger.info(f"Indexing of event batch {batch['instance_id']} was already started")
+    return batch["instance_id"]
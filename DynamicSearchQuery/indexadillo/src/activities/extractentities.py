@@ -1,44 +1,86 @@
 from application.app import app
+from application.payloadstore import load_payload, offload_threshold, store_payload
+from application.vectorcodec import chunk_list
 from typing import List, Dict
+import os
 import re
 import logging
 
 logger = logging.getLogger("scripts")
 
+# Upper bound of values kept per entity type and chunk, long tables can otherwise produce thousands of matches
+ENTITY_MAX_PER_TYPE = int(os.getenv("ENTITY_MAX_PER_TYPE", "100"))
+
+DOMAIN_PATTERN = re.compile(r'(?:[a-zA-Z0-9-]+\.)+[a-zA-Z]{2,63}')
+
+# All entity types in a single pattern so every chunk is scanned once. Matches may only start where a token
+# starts, which lets the scanner skip the inside of words after a single lookbehind. The order of the
+# alternatives matters: at a given position the first one that matches wins, so URLs and e-mail addresses
+# are tried before the plain domains they contain, and zip codes before phone numbers.
+ENTITY_PATTERN = re.compile(
+    r'(?<![\w.%+-])(?:'
+    # URLs with http:// or https://
+    r'(?P<url>https?://(?:[-\w.]|%[\da-fA-F]{2})+)'
+    # E-mail addresses, including the format where "at" or "(at)" replaces the @ symbol
+    r'|(?P<user>[a-zA-Z0-9._%+-]+)(?:@(?P<email_domain>[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})\b'
+    r'|\s+(?:\(at\)|at)\s+(?P<at_domain>[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}))'
+    # Domains (e.g. example.com, sub.domain.org)
+    r'|(?P<domain>(?:[a-zA-Z0-9-]+\.)+[a-zA-Z]{2,63})\b'
+    # Zip codes like 12345 or 12345-6789
+    r'|(?P<zipcode>\d{5}(?:-\d{4})?)\b'
+    # Phone numbers with at least seven digits, every part has a bounded length to keep backtracking on numeric tables cheap
+    r'|(?P<phonenumber>(?:\+?\d{1,3}[\s.-])?(?:\(\d{1,4}\)|\d{1,4})[\s.-]?\d{2,4}[\s.-]?\d{4,9})\b'
+    r')'
+)
+
+ENTITY_TYPES = ["zipcodes", "domains", "urls", "phonenumbers", "emails"]
+
+
+def extract_entities(text: str, max_per_type: int = ENTITY_MAX_PER_TYPE) -> Dict[str, List[str]]:
+    """Extract the entities of `text` in a single scan, deduplicated in order of appearance and capped per type."""
+    # Dicts keep the first occurrence order while dropping duplicates
+    found = {entity_type: {} for entity_type in ENTITY_TYPES}
+
+    def add(entity_type: str, value: str):
+        values = found[entity_type]
+        if len(values) < max_per_type:
+            values[value] = None
+
+    for match in ENTITY_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == "url":
+            url = match.group("url")
+            add("urls", url)
+            host = DOMAIN_PATTERN.fullmatch(url.split("://", 1)[1])
+            if host:
+                add("domains", host.group())
+        elif kind == "email_domain":
+            add("emails", f"{match.group('user')}@{match.group('email_domain')}")
+            add("domains", match.group("email_domain"))
+        elif kind == "at_domain":
+            add("emails", f"{match.group('user')}@{match.group('at_domain')}")
+            add("domains", match.group("at_domain"))
+        elif kind == "domain":
+            add("domains", match.group("domain"))
+        elif kind == "zipcode":
+            add("zipcodes", match.group("zipcode"))
+        elif kind == "phonenumber":
+            add("phonenumbers", match.group("phonenumber"))
+
+    return {entity_type: list(values) for entity_type, values in found.items()}
+
+
 @app.function_name(name="extract_entities")
 @app.activity_trigger(input_name="chunks")
 def extractentities(chunks: List[Dict]) -> List[Dict]:
+    chunks, threshold = offload_threshold(chunks)
+    payload = load_payload(chunks)
+    chunks = chunk_list(payload)
 
     logger.info("Extracting entities from chunks with embeddings")
     logger.info(f"Number of chunks in the document: {len(chunks)}")
-    
-    for i, chunk in enumerate(chunks):
-        # This pattern matches zip codes like 12345 or 12345-6789, even if directly followed by letters (no space).
-        zipcodes = re.findall(r'\b(\d{5}(?:-\d{4})?)\b', chunk["text"])
-        chunk["zipcodes"] = zipcodes
-
-        # Extract domains (e.g. example.com, sub.domain.org)
-        domains = re.findall(r'\b(?:[a-zA-Z0-9-]+\.)+[a-zA-Z]{2,63}\b', chunk["text"])
-        chunk["domains"] = domains
-
-        # Extract URLs with http:// or https://
-        urls = re.findall(r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+', chunk["text"])
-        chunk["urls"] = urls
-
-        # Broader phone number pattern to include more formats
-        phone_pattern = r'\b(?:\+?\d{1,3}[\s.-]?)?\(?\d{1,4}\)?[\s.-]?\d{1,4}[\s.-]?\d{1,9}\b'
-        phonenumbers = re.findall(phone_pattern, chunk["text"])
-        chunk["phonenumbers"] = phonenumbers
-
-        # Extract email addresses - improved pattern to handle more formats
-        # This will match standard emails, emails in parentheses, and emails with "(at)" notation
-        emails = re.findall(r'\b[\(\[]?(?:at\s+)?([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})[\)\]]?\b', chunk["text"])
-        
-        # Also look for the format where "at" replaces the @ symbol
-        at_emails = re.findall(r'([a-zA-Z0-9._%+-]+)\s+(?:\(at\)|at)\s+([a-zA-Z0-9.-]+\.[a-zA-Z]{2,})', chunk["text"])
-        for username, domain in at_emails:
-            emails.append(f"{username}@{domain}")
-            
-        chunk["emails"] = emails
-
-    return chunks
\ No newline at end of file
+
+    for chunk in chunks:
+        chunk.update(extract_entities(chunk["text"]))
+
+    return store_payload(payload, "entities", threshold)
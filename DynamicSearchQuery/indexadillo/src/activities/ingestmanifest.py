@@ -0,0 +1,152 @@
+from application.app import app
+from activities.listblob import get_source_container_client, get_source_service_client
+from activities.manifest import IndexManifest
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+import csv
+import json
+import logging
+import os
+
+logger = logging.getLogger("scripts")
+
+# Bytes of the manifest read per request, a window is extended when a single line does not fit
+MANIFEST_WINDOW_BYTES = int(os.getenv("MANIFEST_WINDOW_BYTES", str(4 * 1024 * 1024)))
+
+NAME_COLUMNS = ("blob_name", "name", "path")
+DESCRIPTOR_COLUMNS = ("etag", "content_md5", "content_type", "size")
+
+
+def split_manifest_path(manifest: str) -> Tuple[str, str]:
+    """`<container>/<path of the manifest blob>` in the source storage account."""
+    container_name, _, blob_name = manifest.strip("/").partition("/")
+    if not blob_name:
+        raise ValueError(f"Manifest {manifest} is not of the form <container>/<blob>")
+    return container_name, blob_name
+
+
+def read_window(blob_client, offset: int, size: int, window_bytes: int) -> bytes:
+    """
+    The manifest from `offset` up to and including the last complete line of the window. The window
+    grows until it holds at least one complete line, at the end of the manifest the rest is returned.
+    """
+    length = window_bytes
+    while True:
+        length = min(length, size - offset)
+        data = blob_client.download_blob(offset=offset, length=length).readall()
+        if offset + length >= size:
+            return data
+        last_newline = data.rfind(b"\n")
+        if last_newline >= 0:
+            return data[:last_newline + 1]
+        length *= 2
+
+
+def parse_entry(line: str, columns: Optional[List[str]]) -> Optional[Dict]:
+    """
+    A manifest record as `{"blob_name", ...}`: a CSV row, a JSON object or a plain JSON string. Other columns are
+    ignored. None for records without a blob name, including lines that are not valid JSON or not an object.
+    """
+    if columns is not None:
+        entry = dict(zip(columns, next(csv.reader([line]))))
+    else:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        if isinstance(entry, str):
+            entry = {"blob_name": entry}
+        if not isinstance(entry, dict):
+            return None
+    name = next((entry[column] for column in NAME_COLUMNS if entry.get(column)), None)
+    if name is None:
+        return None
+    descriptor = {"blob_name": name}
+    for column in DESCRIPTOR_COLUMNS:
+        if entry.get(column):
+            descriptor[column] = entry[column]
+    if "size" in descriptor:
+        # Sizes from CSV manifests are text, blobs without a usable size are just not grouped
+        try:
+            descriptor["size"] = int(descriptor["size"])
+        except (TypeError, ValueError):
+            del descriptor["size"]
+    return descriptor
+
+
+@app.function_name(name="read_manifest_chunk")
+@app.activity_trigger(input_name="params")
+def read_manifest_chunk(params: dict):
+    """
+    Reads the next window of a JSONL or CSV manifest of blob names and returns them as blob descriptors,
+    in the same shape as `list_blobs_chunk`. The cursor holds the byte offset in the manifest and the
+    CSV header: `{"offset": <bytes>, "columns": [...]}`.
+    """
+    manifest_container, manifest_blob = split_manifest_path(params["manifest"])
+    container_name = params.get("container_name")
+    page_size = params.get("page_size", 5000)
+    window_bytes = params.get("window_bytes", MANIFEST_WINDOW_BYTES)
+    cursor = params.get("cursor") or {"offset": 0, "columns": None}
+    is_csv = manifest_blob.lower().endswith(".csv")
+
+    blob_client = get_source_service_client().get_blob_client(manifest_container, manifest_blob)
+    size = blob_client.get_blob_properties().size
+    entries = []
+    offset = cursor["offset"]
+    columns = cursor["columns"]
+    while len(entries) < page_size and offset < size:
+        window = read_window(blob_client, offset, size, window_bytes)
+        window_offset = offset
+        # A CSV record spans several lines when a quoted field contains a line break. Lines are collected until
+        # the quotes of the record are balanced, a record that is cut off by the window is read again with the next one.
+        record = ""
+        record_bytes = 0
+        lines = window.splitlines(keepends=True)
+        # An unbalanced record at the end of the manifest is taken as it is
+        last_line = len(lines) - 1 if window_offset + len(window) >= size else None
+        for number, line in enumerate(lines):
+            # Only advance past records that were consumed, the next call continues after the last one
+            if len(entries) >= page_size:
+                break
+            record += line.decode("utf-8-sig")
+            record_bytes += len(line)
+            if is_csv and record.count('"') % 2 and number != last_line:
+                continue
+            offset += record_bytes
+            text = record.strip()
+            record = ""
+            record_bytes = 0
+            if not text:
+                continue
+            if is_csv and columns is None:
+                columns = [column.strip().lower() for column in next(csv.reader([text]))]
+                continue
+            entry = parse_entry(text, columns if is_csv else None)
+            if entry is None:
+                logger.warning(f"Skipping malformed manifest record or one without blob name: {text[:200]}")
+                continue
+            entries.append(entry)
+        if offset == window_offset and offset < size:
+            # Not a single complete record in the window
+            window_bytes *= 2
+
+    container_client = get_source_container_client(container_name)
+    blobs = [
+        {**entry, "blob_url": f"{container_client.url}/{quote(entry['blob_name'])}"}
+        for entry in entries
+    ]
+
+    # Only hand out blobs that are new or changed since they were last indexed into this index
+    skipped = 0
+    if params.get("incremental") and params.get("index_name"):
+        changed = IndexManifest(params["index_name"]).filter_changed(blobs)
+        skipped = len(blobs) - len(changed)
+        blobs = changed
+        logger.info(f"Skipping {skipped} unchanged blobs")
+
+    return {
+        "blobs": blobs,
+        "cursor": {"offset": offset, "columns": columns},
+        "done": offset >= size,
+        "skipped": skipped
+    }
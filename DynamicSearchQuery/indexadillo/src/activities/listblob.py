@@ -2,63 +2,199 @@
 
 import azure.functions as func
 import azure.durable_functions as df
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobClient, BlobServiceClient, ContainerClient
+import base64
+import logging
 import os
+import threading
 from application.app import app
+from application.clients import get_client
+from activities.manifest import IndexManifest
 from azure.identity import DefaultAzureCredential
-from azure.storage.blob import generate_blob_sas, BlobSasPermissions
-from urllib.parse import quote
+from azure.storage.blob import generate_container_sas, ContainerSasPermissions
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from urllib.parse import quote, unquote, urlsplit
 import datetime
 
+logger = logging.getLogger("scripts")
+
+# Lifetime of the read SAS a blob url is signed with right before the blob is read, it has to cover its analysis
+LIST_SAS_EXPIRY_HOURS = float(os.getenv("LIST_SAS_EXPIRY_HOURS", "6"))
+# Longest lifetime of a user delegation key the storage service accepts, and so of a SAS signed with it
+MAX_DELEGATION_KEY_HOURS = 7 * 24
+
+_lock = threading.Lock()
+_delegation_key = None
+
+
+def get_source_service_client() -> BlobServiceClient:
+    """
+    Blob service client of the source storage account, shared by all invocations on this worker.
+    Uses SOURCE_STORAGE_CONNECTION_STRING when set and the managed identity otherwise.
+    """
+    def create_service_client() -> BlobServiceClient:
+        # Use connection string from Application Settings (local.settings.json for local dev)
+        source_connection_string = os.getenv("SOURCE_STORAGE_CONNECTION_STRING")
+        if source_connection_string:
+            return BlobServiceClient.from_connection_string(source_connection_string)
+        return BlobServiceClient(
+            account_url=f"https://{os.getenv('SOURCE_STORAGE_ACCOUNT_NAME')}.blob.core.windows.net",
+            credential=DefaultAzureCredential()
+        )
+
+    return get_client("source_blob_service", create_service_client)
+
+
+def get_source_container_client(container_name: str) -> ContainerClient:
+    return get_client(("source_container", container_name), lambda: get_source_service_client().get_container_client(container_name))
+
+
+def container_sas(container_name: str) -> str:
+    """
+    One read SAS for the whole container. It is signed with SOURCE_STORAGE_ACCOUNT_KEY when set,
+    otherwise it is a user delegation SAS signed with a delegation key that is cached per worker.
+    """
+    global _delegation_key
+    service_client = get_source_service_client()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    expiry = now + datetime.timedelta(hours=min(LIST_SAS_EXPIRY_HOURS, MAX_DELEGATION_KEY_HOURS))
+    account_key = os.getenv("SOURCE_STORAGE_ACCOUNT_KEY")
+    if account_key:
+        return generate_container_sas(
+            account_name=service_client.account_name,
+            container_name=container_name,
+            account_key=account_key,
+            permission=ContainerSasPermissions(read=True),
+            expiry=expiry
+        )
+
+    with _lock:
+        # A SAS can not outlive the key it was signed with
+        if _delegation_key is None or datetime.datetime.fromisoformat(_delegation_key.signed_expiry.replace("Z", "+00:00")) < expiry:
+            _delegation_key = service_client.get_user_delegation_key(
+                key_start_time=now - datetime.timedelta(minutes=5),
+                key_expiry_time=now + datetime.timedelta(hours=min(2 * LIST_SAS_EXPIRY_HOURS, MAX_DELEGATION_KEY_HOURS))
+            )
+        delegation_key = _delegation_key
+    return generate_container_sas(
+        account_name=service_client.account_name,
+        container_name=container_name,
+        user_delegation_key=delegation_key,
+        permission=ContainerSasPermissions(read=True),
+        expiry=expiry
+    )
+
+
+def source_blob_path(blob_url: str) -> Optional[Tuple[str, str]]:
+    """Container and blob name of an unsigned url of the source storage account, None for other urls."""
+    if urlsplit(blob_url).query:
+        return None
+    account_url = get_source_service_client().url.rstrip("/") + "/"
+    if not blob_url.startswith(account_url):
+        return None
+    container_name, _, blob_name = blob_url[len(account_url):].partition("/")
+    return unquote(container_name), unquote(blob_name)
+
+
+def sign_blob_url(blob_url: str) -> str:
+    """
+    `blob_url` with a read SAS of its container appended, for blobs of the source storage account. Listings hand
+    out urls without a SAS, so the token ends up neither in orchestration histories nor in stage payloads, it is
+    only added for services that read the blob by url. Urls with a query of their own or of other accounts are
+    returned as they are.
+    """
+    path = source_blob_path(blob_url)
+    if path is None:
+        return blob_url
+    return f"{blob_url}?{container_sas(path[0])}"
+
+
+def get_source_blob_client(blob_url: str) -> BlobClient:
+    """
+    Client of a blob by its url. Blobs of the source storage account go through the shared client of their
+    container and its credential, other urls get a client of their own.
+    """
+    path = source_blob_path(blob_url)
+    if path is None:
+        return BlobClient.from_blob_url(blob_url)
+    container_name, blob_name = path
+    return get_source_container_client(container_name).get_blob_client(blob_name)
+
+
+def list_lane(container_client: ContainerClient, prefix: str, continuation_token: Optional[str], page_size: int):
+    """One page of blobs below a prefix and the continuation token of the next page (None once the prefix is done)."""
+    pages = container_client.list_blobs(name_starts_with=prefix, results_per_page=page_size).by_page(continuation_token=continuation_token)
+    for page in pages:
+        return list(page), pages.continuation_token
+    return [], None
+
+
 @app.function_name(name="list_blobs_chunk")
 @app.activity_trigger(input_name="params")
 def list_blobs_chunk(params: dict):
+    """
+    Lists the next page of blobs of up to `prefix_parallelism` prefixes in parallel. The position in the
+    prefix list is kept in a cursor, pass the returned cursor to the next call until `done` is set:
+    `{"prefix_list_offset": <next prefix to start>, "lanes": [{"prefix_index", "continuation_token"}]}`
+    """
     container_name = params.get("container_name")
-    continuation_token = params.get("continuation_token")
-    prefix_list_offset = params.get("prefix_list_offset", 0)
-    chunk_size = params.get("chunk_size", 5000)
     prefix_list = params.get("prefix_list")
-    
-    if len(prefix_list) <= prefix_list_offset:
+    page_size = params.get("page_size", 5000)
+    prefix_parallelism = max(1, params.get("prefix_parallelism", 1))
+    cursor = params.get("cursor") or {"prefix_list_offset": 0, "lanes": []}
+
+    # Start new prefixes in the lanes freed up by prefixes that were listed completely
+    lanes = list(cursor["lanes"])
+    prefix_list_offset = cursor["prefix_list_offset"]
+    while len(lanes) < prefix_parallelism and prefix_list_offset < len(prefix_list):
+        lanes.append({"prefix_index": prefix_list_offset, "continuation_token": None})
+        prefix_list_offset += 1
+
+    if not lanes:
         return {
-            "blob_names": [],
-            "continuation_token": None,
-            "prefix_list_offset": prefix_list_offset
+            "blobs": [],
+            "cursor": {"prefix_list_offset": prefix_list_offset, "lanes": []},
+            "done": True,
+            "skipped": 0
         }
 
-    # Use connection string from Application Settings (local.settings.json for local dev)
-    source_connection_string = os.getenv("SOURCE_STORAGE_CONNECTION_STRING")
-    source_blob_service_client = BlobServiceClient.from_connection_string(source_connection_string)
-    container_client = source_blob_service_client.get_container_client(container_name)
+    container_client = get_source_container_client(container_name)
+    lane_page_size = max(1, page_size // len(lanes))
+    with ThreadPoolExecutor(max_workers=len(lanes)) as executor:
+        pages = list(executor.map(
+            lambda lane: list_lane(container_client, prefix_list[lane["prefix_index"]], lane["continuation_token"], lane_page_size),
+            lanes
+        ))
 
-    # List blobs in a segment (page) using a continuation token
-    blob_urls = []
-    result_segment = container_client.list_blobs(name_starts_with=prefix_list[prefix_list_offset], results_per_page=chunk_size)
-    
-    source_account_name = os.getenv("SOURCE_STORAGE_ACCOUNT_NAME")
-
-    new_continuation_token = None
-    pages = result_segment.by_page(continuation_token=continuation_token)
-    for page in pages:
+    blobs = []
+    next_lanes = []
+    for lane, (page, continuation_token) in zip(lanes, pages):
         for blob in page:
-            sas_token = generate_blob_sas(
-                account_name=source_account_name,
-                container_name=container_name,
-                account_key=os.getenv("SOURCE_STORAGE_ACCOUNT_KEY"),
-                blob_name=blob.name,
-                permission=BlobSasPermissions(read=True),
-                expiry=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
-            )
-            blob_urls.append(
-                f"https://{source_account_name}.blob.core.windows.net/{container_name}/{quote(blob.name)}?{sas_token}"
-            )
-        new_continuation_token = pages.continuation_token
-        if not new_continuation_token:
-            prefix_list_offset += 1
-        break
+            content_md5 = blob.content_settings.content_md5
+            blobs.append({
+                "blob_url": f"{container_client.url}/{quote(blob.name)}",
+                "blob_name": blob.name,
+                "etag": blob.etag,
+                "content_md5": base64.b64encode(content_md5).decode("ascii") if content_md5 else None,
+                "content_type": blob.content_settings.content_type,
+                "last_modified": blob.last_modified.isoformat() if blob.last_modified else None,
+                "size": blob.size
+            })
+        if continuation_token:
+            next_lanes.append({"prefix_index": lane["prefix_index"], "continuation_token": continuation_token})
+
+    # Only hand out blobs that are new or changed since they were last indexed into this index
+    skipped = 0
+    if params.get("incremental") and params.get("index_name"):
+        changed = IndexManifest(params["index_name"]).filter_changed(blobs)
+        skipped = len(blobs) - len(changed)
+        blobs = changed
+        logger.info(f"Skipping {skipped} unchanged blobs")
 
     return {
-        "blob_names": blob_urls,
-        "continuation_token": new_continuation_token,
-        "prefix_list_offset": prefix_list_offset
+        "blobs": blobs,
+        "cursor": {"prefix_list_offset": prefix_list_offset, "lanes": next_lanes},
+        "done": not next_lanes and prefix_list_offset >= len(prefix_list),
+        "skipped": skipped
     }
@@ -0,0 +1,130 @@
+from application.app import app
+from activities.classify import CLASSIFY_MODE
+from activities.cracking import DI_MODEL_ID
+from activities.embedding import EMBEDDING_DIMENSIONS, EMBEDDING_MODEL
+from application.storage import get_container_client
+from azure.core.exceptions import ResourceNotFoundError
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger("scripts")
+
+INDEX_MANIFEST_CONTAINER = os.getenv("INDEX_MANIFEST_CONTAINER", "index-manifest")
+MANIFEST_LOOKUP_PARALLEL = int(os.getenv("MANIFEST_LOOKUP_PARALLEL", "16"))
+# Bump when the chunker or another stage changes in a way that needs unchanged blobs to be indexed again.
+# The models in use are part of the pipeline version on their own.
+INDEX_PIPELINE_VERSION = os.getenv("INDEX_PIPELINE_VERSION", "1")
+
+# Entries listed beyond the ones looked up before falling back to reading every entry on its own
+MANIFEST_LIST_SLACK = 1000
+# Longest blob name accepted by the storage service
+MAX_BLOB_NAME_LENGTH = 1024
+
+
+def pipeline_version() -> str:
+    """Version of the indexing pipeline, changes with INDEX_PIPELINE_VERSION and the models of the stages."""
+    parts = [
+        INDEX_PIPELINE_VERSION, DI_MODEL_ID, EMBEDDING_MODEL, str(EMBEDDING_DIMENSIONS), CLASSIFY_MODE,
+        os.getenv("AOPENAI_MODEL_DEPLOYMENT_NAME", ""),
+    ]
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class IndexManifest:
+    """
+    Records which version of every source blob has been indexed into an index by which version of the
+    pipeline, so unchanged blobs can be skipped on the next run. Entries live in the AzureWebJobsStorage
+    account (Azurite locally), one small blob per index and source blob, named after the source blob so
+    the entries of a listing page can be read with a single listing. The versions are kept in the metadata.
+    """
+
+    def __init__(self, index_name: str):
+        self.index_name = index_name
+        self.container_client = get_container_client(INDEX_MANIFEST_CONTAINER)
+        self.pipeline_version = pipeline_version()
+
+    def entry_name(self, blob_name: str) -> str:
+        name = f"{self.index_name}/{blob_name}"
+        if len(name) > MAX_BLOB_NAME_LENGTH:
+            return f"{self.index_name}.hashed/{hashlib.sha256(blob_name.encode('utf-8')).hexdigest()}"
+        return name
+
+    def get(self, blob_name: str) -> Optional[Dict]:
+        try:
+            return self.container_client.get_blob_client(self.entry_name(blob_name)).get_blob_properties().metadata
+        except ResourceNotFoundError:
+            return None
+
+    def entries(self, blob_names: List[str]) -> Dict[str, Dict]:
+        """
+        The entries of `blob_names` by blob name. Listing returns thousands of entries per request, so the
+        range of entries the names span is listed when it holds not many more entries than names, as for a
+        page of a blob listing. Otherwise, e.g. for the unsorted names of a manifest file, every entry is read
+        on its own.
+        """
+        wanted = {self.entry_name(blob_name): blob_name for blob_name in blob_names}
+        listed = {name for name in wanted if name.startswith(f"{self.index_name}/")}
+        found = {}
+        if listed:
+            first, last = min(listed), max(listed)
+            budget = len(listed) + MANIFEST_LIST_SLACK
+            for scanned, entry in enumerate(self.container_client.list_blobs(
+                    name_starts_with=os.path.commonprefix([first, last]), include=["metadata"])):
+                if entry.name > last:
+                    break
+                if scanned >= budget:
+                    found = {}
+                    listed = set()
+                    break
+                if entry.name in wanted:
+                    found[wanted[entry.name]] = entry.metadata
+        missing = [blob_name for name, blob_name in wanted.items() if name not in listed]
+        if missing:
+            with ThreadPoolExecutor(max_workers=MANIFEST_LOOKUP_PARALLEL) as executor:
+                for blob_name, entry in zip(missing, executor.map(self.get, missing)):
+                    if entry is not None:
+                        found[blob_name] = entry
+        return found
+
+    def is_unchanged(self, blob: Dict, entry: Optional[Dict]) -> bool:
+        if entry is None or entry.get("pipeline_version") != self.pipeline_version:
+            return False
+        if blob.get("content_md5") and entry.get("content_md5") == blob["content_md5"]:
+            return True
+        return bool(blob.get("etag")) and entry.get("etag") == blob["etag"]
+
+    def filter_changed(self, blobs: List[Dict]) -> List[Dict]:
+        """The blobs that are new, changed or indexed by another pipeline version since they were last indexed, in their original order."""
+        if not blobs:
+            return blobs
+        entries = self.entries([blob["blob_name"] for blob in blobs])
+        return [blob for blob in blobs if not self.is_unchanged(blob, entries.get(blob["blob_name"]))]
+
+    def record(self, blob: Dict):
+        entry = {
+            "blob_name": blob["blob_name"],
+            "etag": blob.get("etag"),
+            "content_md5": blob.get("content_md5"),
+            "pipeline_version": self.pipeline_version,
+            "index_name": self.index_name,
+            "indexed_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        # Metadata values are ASCII, the blob name is only kept in the content
+        metadata = {key: entry[key] for key in ["etag", "content_md5", "pipeline_version"] if entry[key]}
+        self.container_client.upload_blob(
+            self.entry_name(blob["blob_name"]), json.dumps(entry), metadata=metadata, overwrite=True
+        )
+
+
+@app.function_name(name="record_manifest_entry")
+@app.activity_trigger(input_name="params")
+def record_manifest_entry(params: dict):
+    """Records `blob`, or every blob of `blobs` for document groups."""
+    manifest = IndexManifest(params["index_name"])
+    for blob in params.get("blobs", [params.get("blob")]):
+        manifest.record(blob)
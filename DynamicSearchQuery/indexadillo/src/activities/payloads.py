@@ -0,0 +1,18 @@
+from application.app import app
+from application.payloadstore import delete_payloads, missing_payloads
+from typing import Any, List
+import logging
+
+logger = logging.getLogger("scripts")
+
+@app.function_name(name="delete_payloads")
+@app.activity_trigger(input_name="references")
+def delete_payloads_activity(references: List[Any]):
+    logger.info(f"Deleting {len(references)} offloaded payloads")
+    delete_payloads(references)
+
+
+@app.function_name(name="missing_payloads")
+@app.activity_trigger(input_name="references")
+def missing_payloads_activity(references: List[Any]) -> List[Any]:
+    return missing_payloads(references)
@@ -0,0 +1,102 @@
+from application.app import app
+from activities.chuncking import chunk_document
+from activities.classify import classify_chunks
+from activities.cracking import crack_document
+from activities.embedding import embed_chunks
+from activities.extractentities import extract_entities
+from activities.search import get_search_manager
+from typing import Awaitable, Callable, Dict, List
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger("scripts")
+
+# Chunks that travel through the pipeline together, and windows buffered between two stages
+PIPELINE_WINDOW_CHUNKS = int(os.getenv("PIPELINE_WINDOW_CHUNKS", "64"))
+PIPELINE_QUEUE_WINDOWS = int(os.getenv("PIPELINE_QUEUE_WINDOWS", "2"))
+
+Stage = Callable[[List[Dict]], Awaitable[List[Dict]]]
+
+
+async def add_entities(window: List[Dict]) -> List[Dict]:
+    def extract():
+        for chunk in window:
+            chunk.update(extract_entities(chunk["text"]))
+        return window
+
+    return await asyncio.to_thread(extract)
+
+
+async def add_classifications(window: List[Dict]) -> List[Dict]:
+    await classify_chunks(window)
+    return window
+
+
+async def run_stage(stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue):
+    """Pass every window of `inbox` through `stage` into `outbox`, until the None that ends the stream."""
+    while True:
+        window = await inbox.get()
+        if window is None:
+            await outbox.put(None)
+            return
+        await outbox.put(await stage(window))
+
+
+async def run_pipeline(chunks: List[Dict], stages: List[Stage], window_chunks: int = PIPELINE_WINDOW_CHUNKS,
+                       queue_windows: int = PIPELINE_QUEUE_WINDOWS) -> List[Dict]:
+    """
+    Stream `chunks` in windows through `stages`, every stage working on its own window at the same time.
+    Queues between the stages hold at most `queue_windows` windows, so only a few windows are in memory.
+    Returns the outputs of the last stage in window order. The first failing stage cancels the others.
+    """
+    queues = [asyncio.Queue(maxsize=queue_windows) for _ in range(len(stages) + 1)]
+    outputs = []
+
+    async def feed():
+        for start in range(0, len(chunks), window_chunks):
+            await queues[0].put(chunks[start:start + window_chunks])
+        await queues[0].put(None)
+
+    async def drain():
+        while (window := await queues[-1].get()) is not None:
+            outputs.append(window)
+
+    tasks = [asyncio.ensure_future(feed()), asyncio.ensure_future(drain())] + [
+        asyncio.ensure_future(run_stage(stage, queues[i], queues[i + 1])) for i, stage in enumerate(stages)
+    ]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception():
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+    return outputs
+
+
+@app.function_name(name="process_document")
+@app.activity_trigger(input_name="document")
+async def process_document(document: Dict) -> Dict:
+    """
+    Cracks, chunks, embeds, extracts entities, classifies and uploads one document in a single activity.
+    Windows of chunks are streamed through the stages, so embedding, classifying and uploading overlap.
+    Returns the upload statistics of `add_documents`. Nothing is checkpointed, a failure redoes the document.
+    """
+    cracked = await crack_document({key: value for key, value in document.items() if key != "index_name"})
+    chunks = await asyncio.to_thread(chunk_document, cracked)
+    search_manager = get_search_manager(document["index_name"])
+    uploads = await run_pipeline(chunks, [embed_chunks, add_entities, add_classifications, search_manager.update_content])
+
+    failed_keys = [key for upload in uploads for key in upload["failed_keys"]]
+    stats = {
+        "documents": sum(upload["documents"] for upload in uploads),
+        "uploaded": sum(upload["uploaded"] for upload in uploads),
+        "failed": len(failed_keys),
+        "failed_keys": failed_keys,
+        "batches": sum(upload["batches"] for upload in uploads),
+        "retries": sum(upload["retries"] for upload in uploads),
+    }
+    logger.info(f"Processed {cracked['filename']} in {len(uploads)} windows of up to {PIPELINE_WINDOW_CHUNKS} chunks")
+    return stats
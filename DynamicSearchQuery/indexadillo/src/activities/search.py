@@ -1,7 +1,10 @@
+import asyncio
 import base64
+import json
 import logging
 import os
 import re
+from contextlib import nullcontext
 from typing import List, Union
 
 from azure.search.documents.indexes.models import (
@@ -26,6 +29,11 @@ from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.search.documents.indexes.aio import SearchIndexClient
 from application.app import app
+from application.batching import pack_batches
+from application.payloadstore import load_payload
+from application.clients import get_search_client, get_search_credential, get_search_index_client
+from application.ratelimit import get_rate_limiter
+from application.vectorcodec import unpack_embeddings
 from azure.identity import DefaultAzureCredential
 from urllib.parse import urlsplit
 from typing import List, Dict
@@ -51,6 +59,16 @@ class AzureOpenAIEmbeddingConfig():
 
 
 logger = logging.getLogger("scripts")
+
+# Request body limit for uploads, below the service maximum of 16 MB to leave room for the envelope
+SEARCH_UPLOAD_MAX_BYTES = int(os.getenv("SEARCH_UPLOAD_MAX_BYTES", str(12 * 1024 * 1024)))
+SEARCH_UPLOAD_MAX_DOCUMENTS = int(os.getenv("SEARCH_UPLOAD_MAX_DOCUMENTS", "1000"))
+SEARCH_UPLOAD_MAX_IN_FLIGHT = int(os.getenv("SEARCH_UPLOAD_MAX_IN_FLIGHT", "4"))
+SEARCH_UPLOAD_MAX_RETRIES = int(os.getenv("SEARCH_UPLOAD_MAX_RETRIES", "3"))
+SEARCH_UPLOAD_RETRY_SECONDS = float(os.getenv("SEARCH_UPLOAD_RETRY_SECONDS", "2"))
+# Per document statuses worth retrying, see https://learn.microsoft.com/rest/api/searchservice/addupdate-or-delete-documents
+RETRIABLE_INDEXING_STATUS_CODES = (409, 422, 429, 503)
+
 class SearchInfo:
     """
     Class representing a connection to a search service
@@ -62,11 +80,12 @@ class SearchInfo:
         self.credential = credential
         self.index_name = index_name
 
-    def create_search_client(self) -> SearchClient:
-        return SearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential)
+    def get_search_client(self) -> SearchClient:
+        # Clients are shared by all invocations on the worker, they must not be closed here
+        return get_search_client(self.index_name, self.endpoint, self.credential)
 
-    def create_search_index_client(self) -> SearchIndexClient:
-        return SearchIndexClient(endpoint=self.endpoint, credential=self.credential)
+    def get_search_index_client(self) -> SearchIndexClient:
+        return get_search_index_client(self.endpoint, self.credential)
 
 
 
@@ -87,7 +106,8 @@ class SearchManager:
     async def create_index(self):
         logger.info("Checking whether search index %s exists...", self.search_info.index_name)
 
-        async with self.search_info.create_search_index_client() as search_index_client:
+        # The index client is shared by the worker, nullcontext keeps it open
+        async with nullcontext(self.search_info.get_search_index_client()) as search_index_client:
 
             if self.search_info.index_name not in [name async for name in search_index_client.list_index_names()]:
                 logger.info("Creating new search index %s", self.search_info.index_name)
@@ -237,49 +257,109 @@ class SearchManager:
             else:
                 logger.info("Search index %s already exists", self.search_info.index_name)
 
+    async def upload_batch(self, search_client: SearchClient, documents: List[dict]) -> Dict:
+        """
+        Merge or upload one batch and retry the documents that failed with a retriable status, with
+        exponential backoff. Documents that still fail are reported, they do not fail the batch.
+        """
+        pending = documents
+        failed_keys = set()
+        retries = 0
+        for attempt in range(SEARCH_UPLOAD_MAX_RETRIES + 1):
+            await get_rate_limiter("search").acquire()
+            results = await search_client.merge_or_upload_documents(pending)
+            retriable_keys = set()
+            for result in results:
+                if result.succeeded:
+                    continue
+                if result.status_code in RETRIABLE_INDEXING_STATUS_CODES and attempt < SEARCH_UPLOAD_MAX_RETRIES:
+                    retriable_keys.add(result.key)
+                else:
+                    logger.warning(f"Indexing {result.key} failed with {result.status_code}: {result.error_message}")
+                    failed_keys.add(result.key)
+            pending = [document for document in pending if document["id"] in retriable_keys]
+            if not pending:
+                break
+            retries += 1
+            await asyncio.sleep(SEARCH_UPLOAD_RETRY_SECONDS * 2 ** attempt)
+        return {"uploaded": len(documents) - len(failed_keys), "failed_keys": sorted(failed_keys), "retries": retries}
+
     async def update_content(
-        self, chunks_with_embeddings: List[dict],
-    ):
-        MAX_BATCH_SIZE = 1000
-        section_batches = [chunks_with_embeddings[i : i + MAX_BATCH_SIZE] for i in range(0, len(chunks_with_embeddings), MAX_BATCH_SIZE)]
+        self, chunks_with_embeddings: Union[List[dict], dict], exclude_urls: List[str] = (),
+    ) -> Dict:
+        # Packed embeddings are only decoded here, right before they are sent to the index
+        chunks_with_embeddings = unpack_embeddings(chunks_with_embeddings)
+        if exclude_urls:
+            # Chunks of documents that must not be uploaded any more, e.g. superseded versions in a document group
+            excluded = set(exclude_urls)
+            chunks_with_embeddings = [chunk for chunk in chunks_with_embeddings if storage_url(chunk["url"]) not in excluded]
         
         def filename_to_id(filename: str):
             filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)
             filename_hash = base64.b16encode(filename.encode("utf-8")).decode("ascii")
         
             return f"file-{filename_ascii}-{filename_hash}"
-        async with self.search_info.create_search_client() as search_client:
-            for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{filename_to_id(section['filename'])}-chunk-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section['text'],
-                        "zipcodes": section['zipcodes'],
-                        "domains": section['domains'],
-                        "urls": section['urls'],
-                        "phonenumbers": section['phonenumbers'],
-                        "emails": section['emails'],
-                        "classification": section['classification'],
-                        "sourcepages": f"{section['filename']}#pages={','.join([f'{i}' for i in range(section['start_page'] + 1, section['end_page'] + 2)])}",
-                        "sourcefile": section['filename'],
-                        "storageUrl": urlsplit(section['url'])._replace(query=None).geturl(),
-                        "embedding": section['embedding'],
-                    }
-                    for section_index, section in enumerate(batch)
-                ]
+        documents = [
+            {
+                "id": f"{filename_to_id(section['filename'])}-chunk-{section.get('chunk_index', section_index)}",
+                "content": section['text'],
+                "zipcodes": section['zipcodes'],
+                "domains": section['domains'],
+                "urls": section['urls'],
+                "phonenumbers": section['phonenumbers'],
+                "emails": section['emails'],
+                "classification": section['classification'],
+                "sourcepages": f"{section['filename']}#pages={','.join([f'{i}' for i in range(section['start_page'] + 1, section['end_page'] + 2)])}",
+                "sourcefile": section['filename'],
+                "storageUrl": storage_url(section['url']),
+                "embedding": section['embedding'],
+            }
+            for section_index, section in enumerate(chunks_with_embeddings)
+        ]
+        # Batches are cut by the size of the request body, 3072 dimensional vectors take about 60 KB per document
+        sizes = [len(json.dumps(document, separators=(",", ":"))) for document in documents]
+        batches = pack_batches(sizes, SEARCH_UPLOAD_MAX_BYTES, SEARCH_UPLOAD_MAX_DOCUMENTS)
+        semaphore = asyncio.Semaphore(SEARCH_UPLOAD_MAX_IN_FLIGHT)
 
-                await search_client.upload_documents(documents)
-                
-                
+        async with nullcontext(self.search_info.get_search_client()) as search_client:
+            async def upload(batch: List[int]) -> Dict:
+                async with semaphore:
+                    return await self.upload_batch(search_client, [documents[i] for i in batch])
 
-@app.function_name(name="add_documents")
-@app.activity_trigger(input_name="documents")
-async def add_documents(documents: dict) -> List[str]:
-    searchManager = SearchManager(
+            results = await asyncio.gather(*[upload(batch) for batch in batches])
+
+        failed_keys = [key for result in results for key in result["failed_keys"]]
+        sourcefiles = {document["id"]: document["sourcefile"] for document in documents}
+        storage_urls = {}
+        for document in documents:
+            storage_urls.setdefault(document["id"], set()).add(document["storageUrl"])
+        stats = {
+            "documents": len(documents),
+            "uploaded": sum(result["uploaded"] for result in results),
+            "failed": len(failed_keys),
+            "failed_keys": failed_keys,
+            # Source files with at least one failed chunk, for uploads that span several documents
+            "failed_files": sorted({sourcefiles[key] for key in failed_keys if key in sourcefiles}),
+            # Blob urls of those files, file names alone are ambiguous across folders
+            "failed_urls": sorted({url for key in failed_keys for url in storage_urls.get(key, ())}),
+            "batches": len(batches),
+            "retries": sum(result["retries"] for result in results),
+        }
+        logger.info(f"Uploaded {stats['uploaded']} of {len(documents)} documents to {self.search_info.index_name} in {len(batches)} batches, {stats['failed']} failed")
+        return stats
+
+
+def storage_url(url: str) -> str:
+    """Blob url without its SAS token, as stored in the storageUrl field."""
+    return urlsplit(url)._replace(query=None).geturl()
+
+
+def get_search_manager(index_name: str) -> SearchManager:
+    return SearchManager(
         SearchInfo(
             endpoint=os.getenv("SEARCH_SERVICE_ENDPOINT"),
-            credential=AzureKeyCredential(os.getenv("SEARCH_SERVICE_KEY")),  # Changed here
-            index_name=documents["index_name"]
+            credential=get_search_credential(),
+            index_name=index_name
         ), AzureOpenAIEmbeddingConfig(
             open_ai_dimensions=3072,
             open_ai_deployment="embedding",
@@ -287,21 +367,16 @@ async def add_documents(documents: dict) -> List[str]:
             open_ai_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
         )
     )
-    await searchManager.update_content(documents["chunks"])
+
+
+@app.function_name(name="add_documents")
+@app.activity_trigger(input_name="documents")
+async def add_documents(documents: dict) -> Dict:
+    searchManager = get_search_manager(documents["index_name"])
+    return await searchManager.update_content(await asyncio.to_thread(load_payload, documents["chunks"]), documents.get("exclude_urls", []))
     
 @app.function_name(name="ensure_index_exists")
 @app.activity_trigger(input_name="name")
 async def ensure_index_exists(name: str) -> List[str]:
-    searchManager = SearchManager(
-        SearchInfo(
-            endpoint=os.getenv("SEARCH_SERVICE_ENDPOINT"),
-            credential=AzureKeyCredential(os.getenv("SEARCH_SERVICE_KEY")),  # Changed here
-            index_name=name
-        ), AzureOpenAIEmbeddingConfig(
-            open_ai_dimensions=3072,
-            open_ai_deployment="embedding",
-            open_ai_model_name="text-embedding-3-large",
-            open_ai_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
-    )
+    searchManager = get_search_manager(name)
     await searchManager.create_index()
@@ -0,0 +1,189 @@
+import io
+import json
+import os
+import re
+import zipfile
+from html.parser import HTMLParser
+from typing import List, Optional
+from xml.etree import ElementTree
+
+# Text-native documents have no layout pages, their text is split into pages of about this many characters
+LOCAL_PAGE_CHARS = int(os.getenv("LOCAL_PAGE_CHARS", "3000"))
+
+FORMATS_BY_EXTENSION = {
+    ".txt": "text",
+    ".text": "text",
+    ".log": "text",
+    ".csv": "text",
+    ".md": "markdown",
+    ".markdown": "markdown",
+    ".html": "html",
+    ".htm": "html",
+    ".json": "json",
+    ".docx": "docx",
+}
+
+FORMATS_BY_CONTENT_TYPE = {
+    "text/plain": "text",
+    "text/csv": "text",
+    "text/markdown": "markdown",
+    "text/html": "html",
+    "application/json": "json",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+}
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+BLOCK_TAGS = {
+    "p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article",
+    "header", "footer", "blockquote", "pre", "table", "ul", "ol", "dt", "dd",
+}
+
+
+def detect_format(filename: str, content_type: Optional[str] = None) -> Optional[str]:
+    """The local format of a blob by its extension or content type, None if it has to go to Document Intelligence."""
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in FORMATS_BY_EXTENSION:
+        return FORMATS_BY_EXTENSION[extension]
+    if not extension and content_type:
+        return FORMATS_BY_CONTENT_TYPE.get(content_type.split(";")[0].strip().lower())
+    return None
+
+
+def sniff_format(data: bytes, format: str) -> Optional[str]:
+    """Check the content against the expected format, returns None when it is not what the name suggests."""
+    if data.startswith(b"%PDF") or data.startswith(b"II*\x00") or data.startswith(b"MM\x00*"):
+        return None
+    if format == "docx":
+        return format if data.startswith(b"PK\x03\x04") else None
+    if data.startswith(b"PK\x03\x04") or b"\x00" in data[:4096]:
+        return None
+    return format
+
+
+def decode_text(data: bytes) -> str:
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1252", errors="replace")
+
+
+def split_pages(text: str, page_chars: int = LOCAL_PAGE_CHARS) -> List[str]:
+    """
+    Split text into pages. Form feeds are taken as page breaks, longer pages are cut at paragraph
+    boundaries (or line boundaries for very long paragraphs) into pages of about `page_chars` characters.
+    """
+    pages = []
+    for section in text.split("\f"):
+        page = ""
+        for paragraph in re.split(r"\n\s*\n", section):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if len(paragraph) <= page_chars:
+                parts, separator = [paragraph], "\n\n"
+            else:
+                parts, separator = paragraph.splitlines(), "\n"
+            for i, part in enumerate(parts):
+                if page and len(page) + len(part) > page_chars:
+                    pages.append(page)
+                    page = ""
+                page = part if not page else page + (separator if i else "\n\n") + part
+        if page:
+            pages.append(page)
+    # Like Document Intelligence, an empty document has a single empty page
+    return pages or [""]
+
+
+class _HTMLText(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "head", "noscript", "template"):
+            self.skip += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+        elif tag in ("td", "th"):
+            self.parts.append(" | ")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "head", "noscript", "template"):
+            self.skip = max(0, self.skip - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(re.sub(r"\s+", " ", data))
+
+
+def html_text(data: bytes) -> str:
+    parser = _HTMLText()
+    parser.feed(decode_text(data))
+    parser.close()
+    lines = [line.strip() for line in "".join(parser.parts).splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def json_text(data: bytes) -> str:
+    try:
+        return json.dumps(json.loads(decode_text(data)), indent=2, ensure_ascii=False)
+    except ValueError:
+        return decode_text(data)
+
+
+def _docx_paragraph(paragraph: ElementTree.Element, page_break: str) -> str:
+    parts = []
+    for element in paragraph.iter():
+        if element.tag == WORD_NAMESPACE + "t":
+            parts.append(element.text or "")
+        elif element.tag == WORD_NAMESPACE + "tab":
+            parts.append("\t")
+        elif element.tag == WORD_NAMESPACE + "br":
+            parts.append(page_break if element.get(WORD_NAMESPACE + "type") == "page" else "\n")
+        elif element.tag == WORD_NAMESPACE + "lastRenderedPageBreak":
+            parts.append(page_break)
+    return "".join(parts)
+
+
+def _docx_table(table: ElementTree.Element) -> str:
+    # Same layout as the tables extracted by Document Intelligence
+    rows = ["\n--- TABLE START ---"]
+    for row in table.iter(WORD_NAMESPACE + "tr"):
+        cells = [
+            " ".join(_docx_paragraph(paragraph, " ") for paragraph in cell.iter(WORD_NAMESPACE + "p")).strip()
+            for cell in row.iter(WORD_NAMESPACE + "tc")
+        ]
+        rows.append(" | ".join(cells))
+    rows.append("--- TABLE END ---\n")
+    return "\n".join(rows)
+
+
+def docx_text(data: bytes) -> str:
+    """Body text of a Word document with page breaks (explicit or last rendered by Word) as form feeds."""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    body = root.find(WORD_NAMESPACE + "body")
+    blocks = []
+    for element in body if body is not None else []:
+        if element.tag == WORD_NAMESPACE + "p":
+            blocks.append(_docx_paragraph(element, "\f"))
+        elif element.tag == WORD_NAMESPACE + "tbl":
+            blocks.append(_docx_table(element))
+    return "\n\n".join(blocks)
+
+
+def parse_pages(data: bytes, format: str, page_chars: int = LOCAL_PAGE_CHARS) -> List[str]:
+    """Page texts of a text-native document, in the same shape as the Document Intelligence output."""
+    if format == "docx":
+        text = docx_text(data)
+    elif format == "html":
+        text = html_text(data)
+    elif format == "json":
+        text = json_text(data)
+    else:
+        text = decode_text(data)
+    return split_pages(text, page_chars)
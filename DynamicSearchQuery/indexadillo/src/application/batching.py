@@ -0,0 +1,22 @@
+from typing import List
+
+
+def pack_batches(sizes: List[int], max_size: int, max_items: int) -> List[List[int]]:
+    """
+    Greedily pack items, in order, into batches that stay within the size and item limits, e.g. tokens per
+    embeddings request or bytes per index upload. Returns the item positions of every batch. An item larger
+    than `max_size` gets a batch of its own.
+    """
+    batches = []
+    current = []
+    current_size = 0
+    for position, size in enumerate(sizes):
+        if current and (current_size + size > max_size or len(current) >= max_items):
+            batches.append(current)
+            current = []
+            current_size = 0
+        current.append(position)
+        current_size += size
+    if current:
+        batches.append(current)
+    return batches
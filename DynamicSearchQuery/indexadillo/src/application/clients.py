@@ -0,0 +1,156 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
+from openai import AsyncAzureOpenAI
+
+logger = logging.getLogger("scripts")
+
+# Version of the Azure OpenAI API per purpose, the chat version is configured by AOPENAI_API_VERSION
+OPENAI_API_VERSIONS = {
+    "embedding": os.getenv("AOPENAI_EMBEDDING_API_VERSION", "2024-02-15-preview"),
+    "chat": os.getenv("AOPENAI_API_VERSION"),
+}
+
+# Time the async clients get to close their connections when the worker exits
+ASYNC_CLOSE_TIMEOUT_SECONDS = 5
+
+# Sync clients are shared by all threads of the worker process. Async clients hold connections that belong
+# to the event loop they were first used on, so they are shared per event loop.
+_lock = threading.RLock()
+_clients: Dict[Hashable, Any] = {}
+_async_clients: Dict[Tuple[Hashable, int], Tuple[asyncio.AbstractEventLoop, Any]] = {}
+
+
+def get_client(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """The sync client registered under `key`, created with `factory` on first use."""
+    with _lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def get_async_client(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """
+    The async client registered under `key` for the running event loop, created with `factory` on first use.
+    Callers must not close it (no `async with`), it is closed when the worker process exits.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        # Clients of event loops that are gone can not be used anymore
+        for stale in [entry for entry, (entry_loop, _) in _async_clients.items() if entry_loop.is_closed()]:
+            del _async_clients[stale]
+        entry = (key, id(loop))
+        if entry not in _async_clients:
+            _async_clients[entry] = (loop, factory())
+        return _async_clients[entry][1]
+
+
+async def close_async_clients(clients: List[Any]):
+    for client in clients:
+        try:
+            await client.close()
+        except Exception as error:
+            logger.warning(f"Could not close {type(client).__name__}: {error}")
+
+
+@atexit.register
+def close_clients():
+    """
+    Close the sync clients, and the async clients on the event loop they belong to, runs when the worker
+    process exits. The Python worker has no shutdown hook for function apps, atexit is the last chance.
+    """
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        async_clients: Dict[asyncio.AbstractEventLoop, List[Any]] = {}
+        for loop, client in _async_clients.values():
+            async_clients.setdefault(loop, []).append(client)
+        _async_clients.clear()
+    for client in clients:
+        close = getattr(client, "close", None)
+        if close is None:
+            continue
+        try:
+            close()
+        except Exception as error:
+            logger.warning(f"Could not close {type(client).__name__}: {error}")
+    for loop, loop_clients in async_clients.items():
+        if loop.is_closed():
+            continue
+        try:
+            if loop.is_running():
+                # The worker's event loop runs in another thread
+                asyncio.run_coroutine_threadsafe(close_async_clients(loop_clients), loop).result(ASYNC_CLOSE_TIMEOUT_SECONDS)
+            else:
+                loop.run_until_complete(close_async_clients(loop_clients))
+        except Exception as error:
+            logger.warning(f"Could not close the async clients: {error}")
+
+
+def _rate_limiting():
+    # Imported on use, the rate limiter keeps its shared state in storage, which gets its clients from here
+    from application import ratelimit
+    return ratelimit
+
+
+def get_openai_client(purpose: str) -> AsyncAzureOpenAI:
+    """Azure OpenAI client for `embedding` or `chat`, reporting throttling to the rate limiter of that purpose."""
+    ratelimit = _rate_limiting()
+    return get_async_client(("openai", purpose), lambda: AsyncAzureOpenAI(
+        api_version=OPENAI_API_VERSIONS[purpose],
+        azure_endpoint=os.getenv("AOPENAI_ENDPOINT"),
+        api_key=os.getenv("AOPENAI_API_KEY"),
+        http_client=ratelimit.openai_http_client(ratelimit.get_rate_limiter(purpose))
+    ))
+
+
+def get_document_intelligence_client(api_version: str) -> DocumentIntelligenceClient:
+    ratelimit = _rate_limiting()
+    return get_async_client(("document_intelligence", api_version), lambda: DocumentIntelligenceClient(
+        os.getenv("DI_ENDPOINT"), AzureKeyCredential(os.getenv("DI_KEY")), api_version=api_version,
+        per_retry_policies=[ratelimit.RateLimitPolicy(ratelimit.get_rate_limiter("document_intelligence"))]
+    ))
+
+
+def get_identity_credential():
+    """Async credential of the identity of the function app."""
+    def create_credential():
+        from azure.identity.aio import DefaultAzureCredential
+        return DefaultAzureCredential()
+
+    return get_async_client("identity_credential", create_credential)
+
+
+def get_search_credential():
+    """SEARCH_SERVICE_KEY when set, otherwise the identity of the function app."""
+    key = os.getenv("SEARCH_SERVICE_KEY")
+    if key:
+        return get_client(("search_key_credential", key), lambda: AzureKeyCredential(key))
+    return get_identity_credential()
+
+
+def get_search_client(index_name: str, endpoint: str = None, credential=None) -> SearchClient:
+    """Search client per endpoint, index and credential, `get_search_credential()` unless a credential is passed."""
+    endpoint = endpoint or os.getenv("SEARCH_SERVICE_ENDPOINT")
+    credential = credential or get_search_credential()
+    ratelimit = _rate_limiting()
+    return get_async_client(("search", endpoint, index_name, credential), lambda: SearchClient(
+        endpoint=endpoint, index_name=index_name, credential=credential,
+        per_retry_policies=[ratelimit.RateLimitPolicy(ratelimit.get_rate_limiter("search"))]
+    ))
+
+
+def get_search_index_client(endpoint: str = None, credential=None) -> SearchIndexClient:
+    endpoint = endpoint or os.getenv("SEARCH_SERVICE_ENDPOINT")
+    credential = credential or get_search_credential()
+    return get_async_client(("search_index", endpoint, credential), lambda: SearchIndexClient(
+        endpoint=endpoint, credential=credential
+    ))
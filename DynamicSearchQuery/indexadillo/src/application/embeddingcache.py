@@ -0,0 +1,194 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+from azure.core.exceptions import ResourceNotFoundError
+from application.storage import get_container_client
+
+logger = logging.getLogger("scripts")
+
+
+def embedding_cache_key(text: str, model: str, dimensions: int) -> str:
+    return hashlib.sha256(f"{model}\n{dimensions}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _to_bytes(vector: List[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def _from_bytes(data: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class EmbeddingCacheBackend(ABC):
+    """
+    Storage behind the embedding cache. Vectors are stored as packed float32, which is
+    the precision the embedding service works with.
+    """
+
+    @abstractmethod
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """The vectors stored for `keys`, keys without a vector are left out."""
+
+    @abstractmethod
+    def put_many(self, items: Dict[str, List[float]]):
+        """Store the vectors of `items` by key."""
+
+
+class SqliteEmbeddingCacheBackend(EmbeddingCacheBackend):
+    """
+    Local disk cache in a single SQLite file. Entries are evicted least recently used first
+    once more than `max_entries` are stored.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._connection.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's host parameter limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update({key: _from_bytes(vector) for key, vector in rows})
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self._connection.commit()
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, _to_bytes(vector), now) for key, vector in items.items()],
+            )
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._connection.commit()
+
+
+class BlobEmbeddingCacheBackend(EmbeddingCacheBackend):
+    """
+    Cache shared by all instances, one blob per vector. Size is not enforced here, use a
+    storage lifecycle management rule on the container to expire entries.
+    """
+
+    def __init__(self, container_name: str, setting: str = "AzureWebJobsStorage", max_concurrency: int = 32):
+        self.container_client = get_container_client(container_name, setting)
+        # Every key is one request, they are sent this many at a time
+        self.max_concurrency = max_concurrency
+
+    def download(self, key: str) -> Optional[List[float]]:
+        try:
+            return _from_bytes(self.container_client.download_blob(key).readall())
+        except ResourceNotFoundError:
+            return None
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        if not keys:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(keys))) as executor:
+            vectors = list(executor.map(self.download, keys))
+        return {key: vector for key, vector in zip(keys, vectors) if vector is not None}
+
+    def put_many(self, items: Dict[str, List[float]]):
+        if not items:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as executor:
+            # list() raises the first upload error
+            list(executor.map(lambda item: self.container_client.upload_blob(item[0], _to_bytes(item[1]), overwrite=True), items.items()))
+
+
+class EmbeddingCache:
+    """
+    Content addressed cache for embeddings. Keys are derived from the chunk text, the model
+    and the dimensions, so a changed chunk or a different model never hits a stale vector.
+    """
+
+    def __init__(self, backend: EmbeddingCacheBackend, model: str, dimensions: int):
+        self.backend = backend
+        self.model = model
+        self.dimensions = dimensions
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        return embedding_cache_key(text, self.model, self.dimensions)
+
+    def get_many(self, texts: Iterable[str]) -> List[Optional[List[float]]]:
+        """Look up the embeddings for `texts`, returning None for every miss."""
+        keys = [self.key(text) for text in texts]
+        try:
+            found = self.backend.get_many(list(dict.fromkeys(keys)))
+        except Exception as ex:
+            logger.warning(f"Embedding cache lookup failed, embedding everything: {ex}")
+            found = {}
+        result = [found.get(key) for key in keys]
+        hits = sum(1 for vector in result if vector is not None)
+        self.hits += hits
+        self.misses += len(result) - hits
+        return result
+
+    def put_many(self, texts: Iterable[str], vectors: Iterable[List[float]]):
+        try:
+            self.backend.put_many({self.key(text): vector for text, vector in zip(texts, vectors)})
+        except Exception as ex:
+            logger.warning(f"Embedding cache write failed: {ex}")
+
+
+_caches: Dict[tuple, EmbeddingCache] = {}
+
+
+def get_embedding_cache(model: str, dimensions: int) -> Optional[EmbeddingCache]:
+    """
+    Return the process wide embedding cache configured through EMBEDDING_CACHE_BACKEND
+    ("sqlite", "blob" or "none"), or None if caching is disabled.
+    """
+    backend_name = os.getenv("EMBEDDING_CACHE_BACKEND", "sqlite").lower()
+    if backend_name == "none":
+        return None
+    if (backend_name, model, dimensions) not in _caches:
+        if backend_name == "sqlite":
+            backend = SqliteEmbeddingCacheBackend(
+                path=os.getenv("EMBEDDING_CACHE_PATH", os.path.join(tempfile.gettempdir(), "embedding-cache.sqlite")),
+                max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000")),
+            )
+        elif backend_name == "blob":
+            backend = BlobEmbeddingCacheBackend(
+                container_name=os.getenv("EMBEDDING_CACHE_CONTAINER", "embedding-cache"),
+                setting=os.getenv("EMBEDDING_CACHE_STORAGE_SETTING", "AzureWebJobsStorage"),
+                max_concurrency=int(os.getenv("EMBEDDING_CACHE_BLOB_PARALLEL", "32")),
+            )
+        else:
+            raise ValueError(f"Unknown EMBEDDING_CACHE_BACKEND {backend_name}")
+        _caches[(backend_name, model, dimensions)] = EmbeddingCache(backend, model, dimensions)
+    return _caches[(backend_name, model, dimensions)]
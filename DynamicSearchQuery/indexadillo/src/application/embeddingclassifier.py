@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+from collections import Counter
+from typing import Awaitable, Callable, List, Dict, Optional, Tuple
+import numpy as np
+
+logger = logging.getLogger("scripts")
+
+CLASSIFICATION_EXAMPLES_PATH = os.getenv(
+    "CLASSIFICATION_EXAMPLES_PATH",
+    os.path.join(os.path.dirname(__file__), "classification_examples.json")
+)
+# Chunks whose best label does not beat the runner-up by this cosine margin are sent to the chat model
+CLASSIFY_EMBEDDING_MIN_MARGIN = float(os.getenv("CLASSIFY_EMBEDDING_MIN_MARGIN", "0.05"))
+# Labels with fewer examples get centroids that hardly generalize
+MIN_EXAMPLES_PER_LABEL = 5
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class EmbeddingClassifier:
+    """
+    Nearest centroid classifier over chunk embeddings. Every label is represented by the
+    normalized mean of its example embeddings and chunks are scored by cosine similarity.
+    """
+
+    def __init__(self, labels: List[str], centroids: np.ndarray):
+        self.labels = labels
+        self.centroids = normalize_rows(np.asarray(centroids, dtype=np.float32))
+
+    @classmethod
+    def from_examples(cls, vectors: np.ndarray, labels: List[str]) -> "EmbeddingClassifier":
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        label_set = sorted(set(labels))
+        label_array = np.asarray(labels)
+        centroids = np.stack([vectors[label_array == label].mean(axis=0) for label in label_set])
+        return cls(label_set, centroids)
+
+    def predict(self, vectors: np.ndarray) -> Tuple[List[str], np.ndarray]:
+        """
+        Classify every row of `vectors`. Returns the labels and a confidence per row, the margin
+        between the best and the second best cosine similarity.
+        """
+        scores = normalize_rows(np.asarray(vectors, dtype=np.float32)) @ self.centroids.T
+        if len(self.labels) == 1:
+            return [self.labels[0]] * len(scores), np.ones(len(scores), dtype=np.float32)
+        top_two = np.partition(scores, -2, axis=1)[:, -2:]
+        confidence = top_two[:, 1] - top_two[:, 0]
+        return [self.labels[i] for i in scores.argmax(axis=1)], confidence
+
+
+def load_examples(path: str = CLASSIFICATION_EXAMPLES_PATH) -> List[Dict]:
+    with open(path, encoding="utf-8") as examples_file:
+        return json.load(examples_file)
+
+
+_classifier: Optional[EmbeddingClassifier] = None
+
+
+async def get_embedding_classifier(embed: Callable[[List[str]], Awaitable[List[List[float]]]]) -> EmbeddingClassifier:
+    """Build the classifier from the labelled examples once per worker, `embed` returns the embeddings of texts."""
+    global _classifier
+    if _classifier is None:
+        examples = load_examples()
+        labels = [example["classification"] for example in examples]
+        few = {label: count for label, count in Counter(labels).items() if count < MIN_EXAMPLES_PER_LABEL}
+        if few:
+            logger.warning(f"Labels with fewer than {MIN_EXAMPLES_PER_LABEL} examples in {CLASSIFICATION_EXAMPLES_PATH}: {few}")
+        vectors = await embed([example["text"] for example in examples])
+        _classifier = EmbeddingClassifier.from_examples(np.asarray(vectors), labels)
+        logger.info(f"Built embedding classifier from {len(examples)} examples for labels {_classifier.labels}")
+    return _classifier
@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+import uuid
+from typing import Any, List, Optional, Tuple
+from azure.core.exceptions import ResourceNotFoundError
+from application.storage import get_container_client
+
+logger = logging.getLogger("scripts")
+
+# Activity outputs larger than this are written to blob storage and replaced by a claim check, 0 disables offloading
+PAYLOAD_OFFLOAD_THRESHOLD_BYTES = int(os.getenv("PAYLOAD_OFFLOAD_THRESHOLD_BYTES", "262144"))
+PAYLOAD_CONTAINER = os.getenv("PAYLOAD_CONTAINER", "pipeline-payloads")
+
+CLAIM_CHECK_KEY = "claim_check"
+OFFLOAD_KEY = "offload_output"
+
+def is_claim_check(value: Any) -> bool:
+    """Whether `value` is a reference to an offloaded payload. Safe to call from orchestrators."""
+    return isinstance(value, dict) and CLAIM_CHECK_KEY in value
+
+
+def force_offload(value: Any) -> Any:
+    """Wrap an activity input so the activity returns its output as a claim check. Safe to call from orchestrators."""
+    return {OFFLOAD_KEY: value}
+
+
+def offload_threshold(value: Any) -> Tuple[Any, Optional[int]]:
+    """The activity input and the offload threshold its output is stored with, 0 if it was wrapped by `force_offload`."""
+    if isinstance(value, dict) and set(value) == {OFFLOAD_KEY}:
+        return value[OFFLOAD_KEY], 0
+    return value, None
+
+
+def store_payload(payload: Any, stage: str, threshold: Optional[int] = None) -> Any:
+    """
+    Return `payload` unchanged if it is small, otherwise write it to blob storage and return a claim check.
+    Every output gets a blob of its own, two runs of the same document must not delete each other's
+    payloads. `threshold` overrides PAYLOAD_OFFLOAD_THRESHOLD_BYTES, 0 offloads every payload.
+    """
+    if threshold is None:
+        if PAYLOAD_OFFLOAD_THRESHOLD_BYTES <= 0:
+            return payload
+        threshold = PAYLOAD_OFFLOAD_THRESHOLD_BYTES
+    data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    if len(data) <= threshold:
+        return payload
+    blob_name = f"{stage}/{uuid.uuid4().hex}.json"
+    get_container_client(PAYLOAD_CONTAINER).upload_blob(blob_name, data, overwrite=True)
+    logger.info(f"Offloaded {len(data)} bytes of {stage} output to {PAYLOAD_CONTAINER}/{blob_name}")
+    return {CLAIM_CHECK_KEY: {"container": PAYLOAD_CONTAINER, "blob": blob_name, "size": len(data)}}
+
+
+def load_payload(value: Any) -> Any:
+    """Resolve a claim check to the payload it refers to, other values are returned unchanged."""
+    if not is_claim_check(value):
+        return value
+    blob_name = value[CLAIM_CHECK_KEY]["blob"]
+    return json.loads(get_container_client(PAYLOAD_CONTAINER).download_blob(blob_name).readall())
+
+
+def delete_payloads(values: List[Any]):
+    for value in values:
+        if is_claim_check(value):
+            try:
+                get_container_client(PAYLOAD_CONTAINER).delete_blob(value[CLAIM_CHECK_KEY]["blob"])
+            except ResourceNotFoundError:
+                pass
+
+
+def missing_payloads(values: List[Any]) -> List[Any]:
+    """The claim checks of `values` whose blob is gone, e.g. expired by a lifecycle rule."""
+    container_client = get_container_client(PAYLOAD_CONTAINER)
+    return [value for value in values
+            if is_claim_check(value) and not container_client.get_blob_client(value[CLAIM_CHECK_KEY]["blob"]).exists()]
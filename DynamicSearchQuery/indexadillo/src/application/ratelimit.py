@@ -0,0 +1,272 @@
+import asyncio
+import email.utils
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+import openai
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+from application.storage import get_container_client
+
+logger = logging.getLogger("scripts")
+
+# Limits are configured per service as RATE_LIMIT_<NAME>_RPM and RATE_LIMIT_<NAME>_TPM, e.g.
+# RATE_LIMIT_EMBEDDING_TPM=350000. 0 (the default) leaves that dimension unlimited, throttling
+# responses still pause all callers of the service for the Retry-After interval.
+RATE_LIMITED_SERVICES = ["embedding", "chat", "document_intelligence", "search"]
+
+# "blob" shares the limits and the backoff state between all instances through the AzureWebJobsStorage account.
+# Only services with a limit are coordinated, without one there is nothing to split between the instances.
+RATE_LIMIT_COORDINATION = os.getenv("RATE_LIMIT_COORDINATION", "blob").lower()
+RATE_LIMIT_CONTAINER = os.getenv("RATE_LIMIT_CONTAINER", "rate-limits")
+RATE_LIMIT_SYNC_SECONDS = float(os.getenv("RATE_LIMIT_SYNC_SECONDS", "10"))
+# AIMD: a throttling response halves the rate (down to the minimum factor), every quiet sync interval adds the increase back
+RATE_LIMIT_MIN_FACTOR = float(os.getenv("RATE_LIMIT_MIN_FACTOR", "0.1"))
+RATE_LIMIT_INCREASE = float(os.getenv("RATE_LIMIT_INCREASE", "0.05"))
+
+THROTTLE_STATUS_CODES = (429, 503)
+DEFAULT_RETRY_AFTER_SECONDS = 1.0
+# Buckets hold up to this many seconds of their rate, so short bursts do not have to wait
+BURST_SECONDS = 10
+
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Seconds to wait according to the retry-after-ms, x-ms-retry-after-ms or Retry-After header."""
+    for header, scale in [("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001), ("retry-after", 1.0)]:
+        value = headers.get(header)
+        if not value:
+            continue
+        try:
+            return float(value) * scale
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                continue
+    return None
+
+
+class TokenBucket:
+    """
+    Refills at `per_minute / 60` per second. A reservation always succeeds and may leave the bucket in
+    debt, the caller waits until the debt is paid off. Requests larger than the bucket just wait longer.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.level = self.rate * BURST_SECONDS
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.rate * BURST_SECONDS, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, per_minute: float, now: float):
+        self.refill(now)
+        self.rate = per_minute / 60
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.refill(now)
+        self.level -= amount
+        return -self.level / self.rate if self.level < 0 else 0.0
+
+
+class BlobRateCoordinator:
+    """
+    Shares a rate limiter between instances through small blobs: every instance refreshes a heartbeat blob
+    so the limits can be split by the number of live instances, and the AIMD factor and pause are kept in
+    a state blob that is updated with ETag optimistic concurrency.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.instance_id = uuid.uuid4().hex
+        self._container_client = None
+
+    @property
+    def container_client(self):
+        # Created on the first sync, which runs outside of the event loop
+        if self._container_client is None:
+            self._container_client = get_container_client(RATE_LIMIT_CONTAINER)
+        return self._container_client
+
+    def count_instances(self, now: float) -> int:
+        prefix = f"{self.name}/instances/"
+        self.container_client.upload_blob(prefix + self.instance_id, b"", overwrite=True)
+        live = 0
+        for blob in self.container_client.list_blobs(name_starts_with=prefix):
+            age = now - blob.last_modified.timestamp()
+            if age <= 3 * RATE_LIMIT_SYNC_SECONDS:
+                live += 1
+            elif age > 100 * RATE_LIMIT_SYNC_SECONDS:
+                # Heartbeat of an instance that was scaled in long ago
+                try:
+                    self.container_client.delete_blob(blob.name)
+                except ResourceNotFoundError:
+                    pass
+        return max(1, live)
+
+    def sync(self, factor: float, paused_until: float, throttled: bool) -> Tuple[float, float, int]:
+        """Merge the local backoff into the shared state, returns the shared factor, pause and number of instances."""
+        now = time.time()
+        instances = self.count_instances(now)
+        state_name = f"{self.name}/state.json"
+        for _ in range(5):
+            try:
+                downloader = self.container_client.download_blob(state_name)
+                state = json.loads(downloader.readall())
+                etag = downloader.properties.etag
+            except ResourceNotFoundError:
+                state = {"factor": 1.0, "paused_until": 0.0, "updated_at": 0.0}
+                etag = None
+
+            updated = dict(state)
+            if throttled:
+                updated["factor"] = min(state["factor"], factor)
+                updated["paused_until"] = max(state["paused_until"], paused_until)
+            elif state["factor"] < 1.0 and now - state["updated_at"] >= RATE_LIMIT_SYNC_SECONDS and now >= state["paused_until"]:
+                updated["factor"] = min(1.0, state["factor"] + RATE_LIMIT_INCREASE)
+            if updated == state:
+                return state["factor"], state["paused_until"], instances
+
+            updated["updated_at"] = now
+            try:
+                if etag is None:
+                    self.container_client.upload_blob(state_name, json.dumps(updated))
+                else:
+                    self.container_client.upload_blob(state_name, json.dumps(updated), overwrite=True,
+                                                      etag=etag, match_condition=MatchConditions.IfNotModified)
+                return updated["factor"], updated["paused_until"], instances
+            except (ResourceExistsError, ResourceModifiedError):
+                # Another instance updated the state in between, merge into its version
+                continue
+        return factor, paused_until, instances
+
+
+class RateLimiter:
+    """
+    Client side limit for one service: token buckets for requests and tokens per minute, scaled by an AIMD
+    factor that is halved on throttling responses and recovers while the service is quiet. With a
+    coordinator the configured limits are shared by all instances.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float,
+                 coordinator: Optional[BlobRateCoordinator] = None):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.coordinator = coordinator
+        self.factor = 1.0
+        self.instances = 1
+        # Wall clock time, so it can be shared with other instances
+        self.paused_until = 0.0
+        self.throttled_since_sync = False
+        self.last_sync = 0.0
+        self.syncing = False
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.lock = threading.Lock()
+
+    def apply_rates(self):
+        now = time.monotonic()
+        share = self.factor / self.instances
+        if self.requests:
+            self.requests.set_rate(self.requests_per_minute * share, now)
+        if self.tokens:
+            self.tokens.set_rate(self.tokens_per_minute * share, now)
+
+    def sync(self):
+        with self.lock:
+            throttled = self.throttled_since_sync
+            self.throttled_since_sync = False
+            factor, paused_until = self.factor, self.paused_until
+        if self.coordinator:
+            factor, paused_until, instances = self.coordinator.sync(factor, paused_until, throttled)
+        else:
+            instances = 1
+            if not throttled and time.time() >= paused_until:
+                factor = min(1.0, factor + RATE_LIMIT_INCREASE)
+        with self.lock:
+            # Throttling reported while syncing is merged on the next sync
+            if not self.throttled_since_sync:
+                self.factor = factor
+            self.paused_until = max(self.paused_until, paused_until)
+            self.instances = instances
+            self.apply_rates()
+
+    async def acquire(self, tokens: int = 0):
+        """Wait until one more request with `tokens` tokens fits into the limits."""
+        if time.time() - self.last_sync >= RATE_LIMIT_SYNC_SECONDS and not self.syncing:
+            self.syncing = True
+            self.last_sync = time.time()
+            try:
+                await asyncio.to_thread(self.sync)
+            except Exception as error:
+                logger.warning(f"Could not sync rate limit state of {self.name}: {error}")
+            finally:
+                self.syncing = False
+
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - time.time())
+            if self.requests:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens and tokens:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def throttled(self, retry_after: Optional[float]):
+        """Report a throttling response: pause for Retry-After and halve the rate once per throttling episode."""
+        retry_after = DEFAULT_RETRY_AFTER_SECONDS if retry_after is None else retry_after
+        with self.lock:
+            now = time.time()
+            if now >= self.paused_until:
+                self.factor = max(RATE_LIMIT_MIN_FACTOR, self.factor / 2)
+                logger.warning(f"{self.name} is throttled, pausing {retry_after:.1f}s and lowering the rate to {self.factor:.2f}")
+            self.paused_until = max(self.paused_until, now + retry_after)
+            self.throttled_since_sync = True
+            self.apply_rates()
+
+
+class RateLimitPolicy(SansIOHTTPPolicy):
+    """Reports throttling responses of an Azure SDK client to a rate limiter, including the ones the SDK retries."""
+
+    def __init__(self, limiter: RateLimiter):
+        self.limiter = limiter
+
+    def on_response(self, request, response):
+        http_response = response.http_response
+        if http_response.status_code in THROTTLE_STATUS_CODES:
+            self.limiter.throttled(retry_after_seconds(http_response.headers))
+
+
+def openai_http_client(limiter: RateLimiter) -> openai.DefaultAsyncHttpxClient:
+    """HTTP client for AsyncAzureOpenAI that reports throttling responses, including the ones openai retries."""
+    async def report(response):
+        if response.status_code in THROTTLE_STATUS_CODES:
+            limiter.throttled(retry_after_seconds(response.headers))
+
+    return openai.DefaultAsyncHttpxClient(event_hooks={"response": [report]})
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str) -> RateLimiter:
+    """The rate limiter of a service (one of RATE_LIMITED_SERVICES), shared by all invocations on this worker."""
+    with _limiters_lock:
+        if name not in _limiters:
+            requests_per_minute = float(os.getenv(f"RATE_LIMIT_{name.upper()}_RPM", "0"))
+            tokens_per_minute = float(os.getenv(f"RATE_LIMIT_{name.upper()}_TPM", "0"))
+            limited = requests_per_minute > 0 or tokens_per_minute > 0
+            coordinator = BlobRateCoordinator(name) if RATE_LIMIT_COORDINATION == "blob" and limited else None
+            _limiters[name] = RateLimiter(name, requests_per_minute, tokens_per_minute, coordinator)
+        return _limiters[name]
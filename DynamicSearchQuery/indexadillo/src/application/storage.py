@@ -0,0 +1,49 @@
+import os
+from azure.core.exceptions import ResourceExistsError
+from azure.identity import DefaultAzureCredential
+from azure.storage.blob import BlobServiceClient, ContainerClient
+from application.clients import get_client
+
+# The storage SDK does not understand the "UseDevelopmentStorage=true" shortcut used by local.settings.json
+AZURITE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"
+    "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+)
+
+
+def get_blob_service_client(setting: str = "AzureWebJobsStorage") -> BlobServiceClient:
+    """
+    The blob service client of the storage account configured under `setting`, shared by the worker process.
+    Supports plain connection strings, the Azurite shortcut and identity based connections
+    (`<setting>__accountName` / `<setting>__clientId`) as used by the deployed function app.
+    """
+    return get_client(("blob_service", setting), lambda: create_blob_service_client(setting))
+
+
+def create_blob_service_client(setting: str) -> BlobServiceClient:
+    connection_string = os.getenv(setting)
+    if connection_string:
+        if connection_string.strip().lower().startswith("usedevelopmentstorage=true"):
+            connection_string = AZURITE_CONNECTION_STRING
+        return BlobServiceClient.from_connection_string(connection_string)
+
+    account_name = os.getenv(f"{setting}__accountName")
+    if account_name is None:
+        raise ValueError(f"{setting} is not set")
+    credential = DefaultAzureCredential(managed_identity_client_id=os.getenv(f"{setting}__clientId"))
+    return BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net", credential=credential)
+
+
+def get_container_client(container_name: str, setting: str = "AzureWebJobsStorage", create: bool = True) -> ContainerClient:
+    """Shared client of a container, which is created on first use when `create` is set."""
+    def create_container_client() -> ContainerClient:
+        container_client = get_blob_service_client(setting).get_container_client(container_name)
+        if create and not container_client.exists():
+            try:
+                container_client.create_container()
+            except ResourceExistsError:
+                pass
+        return container_client
+
+    return get_client(("container", setting, container_name, create), create_container_client)
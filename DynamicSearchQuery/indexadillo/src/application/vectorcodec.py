@@ -0,0 +1,60 @@
+import base64
+import os
+from typing import Any, Dict, List
+import numpy as np
+
+# How embeddings travel between activities: "json" keeps a list of floats per chunk,
+# "float32" and "float16" pack all vectors of a document into one base64 encoded buffer
+EMBEDDING_ENCODING = os.getenv("EMBEDDING_ENCODING", "float32").lower()
+
+PACKED_EMBEDDINGS_KEY = "packed_embeddings"
+
+_DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+
+def is_packed(payload: Any) -> bool:
+    return isinstance(payload, dict) and PACKED_EMBEDDINGS_KEY in payload
+
+
+def pack_embeddings(chunks: List[Dict], encoding: str = EMBEDDING_ENCODING) -> Any:
+    """
+    Move the "embedding" of every chunk into a single contiguous buffer of the given encoding.
+    Returns `{"chunks": [...], "packed_embeddings": {...}}`, or the chunks unchanged for "json".
+    """
+    if encoding == "json":
+        return chunks
+    if encoding not in _DTYPES:
+        raise ValueError(f"Unknown embedding encoding {encoding}")
+    matrix = np.asarray([chunk.pop("embedding") for chunk in chunks], dtype=_DTYPES[encoding])
+    return {
+        "chunks": chunks,
+        PACKED_EMBEDDINGS_KEY: {
+            "encoding": encoding,
+            "dimensions": matrix.shape[1] if matrix.ndim == 2 else 0,
+            "data": base64.b64encode(matrix.tobytes()).decode("ascii"),
+        },
+    }
+
+
+def chunk_list(payload: Any) -> List[Dict]:
+    """The chunks of a packed or plain payload, without decoding the embeddings."""
+    return payload["chunks"] if is_packed(payload) else payload
+
+
+def embedding_matrix(payload: Any) -> np.ndarray:
+    """All embeddings of a packed or plain payload as a float32 matrix with one row per chunk."""
+    if not is_packed(payload):
+        return np.asarray([chunk["embedding"] for chunk in payload], dtype=np.float32)
+    packed = payload[PACKED_EMBEDDINGS_KEY]
+    vectors = np.frombuffer(base64.b64decode(packed["data"]), dtype=_DTYPES[packed["encoding"]])
+    return vectors.reshape(len(payload["chunks"]), packed["dimensions"]).astype(np.float32)
+
+
+def unpack_embeddings(payload: Any) -> List[Dict]:
+    """Restore the "embedding" list of every chunk, plain payloads are returned unchanged."""
+    if not is_packed(payload):
+        return payload
+    chunks = payload["chunks"]
+    for chunk, vector in zip(chunks, embedding_matrix(payload).tolist()):
+        chunk["embedding"] = vector
+    return chunks
@@ -0,0 +1,35 @@
+import azure.durable_functions as df
+from application.app import app
+from typing import Dict
+import hashlib
+
+
+def checkpoint_key(document: Dict) -> str:
+    """
+    Entity key of a document's stage checkpoints: the index, the blob and the version of its content,
+    so a changed blob starts from scratch instead of resuming from outputs of the old content.
+    """
+    blob = document.get("blob_name") or document["blob_url"].split("?")[0]
+    version = document.get("content_md5") or document.get("etag") or ""
+    return hashlib.sha256(f"{document['index_name']}|{blob}|{version}".encode("utf-8")).hexdigest()
+
+
+@app.function_name(name="document_checkpoint")
+@app.entity_trigger(context_name="context")
+def document_checkpoint(context: df.DurableEntityContext):
+    """
+    Outputs of the completed pipeline stages of one document, so a retried `index_document` resumes at
+    the first incomplete stage. Only claim checks are stored, the payloads stay in blob storage, so the
+    entity state and its history stay small. Operations: `get` returns `{stage: output}`, `set` stores
+    `{"stage", "output"}`, `delete` removes the entity.
+    """
+    outputs = context.get_state(lambda: {})
+    operation = context.operation_name
+    if operation == "get":
+        context.set_result(outputs)
+    elif operation == "set":
+        checkpoint = context.get_input()
+        outputs[checkpoint["stage"]] = checkpoint["output"]
+        context.set_state(outputs)
+    elif operation == "delete":
+        context.destruct_on_exit()
@@ -0,0 +1,28 @@
+import azure.durable_functions as df
+from application.app import app
+
+
+@app.function_name(name="event_buffer")
+@app.entity_trigger(context_name="context")
+def event_buffer(context: df.DurableEntityContext):
+    """
+    Blob paths reported by Event Grid that are waiting to be indexed, as `{path: etag}`, so repeated events
+    for the same blob are coalesced into one entry with the latest ETag.
+    Operations: `add` stores `{"path", "etag"}`, `flush` removes and returns up to `max_items` entries, or
+    none while fewer than `max_items` are buffered if `full_only` is set.
+    """
+    blobs = context.get_state(lambda: {})
+    operation = context.operation_name
+    if operation == "add":
+        event = context.get_input()
+        blobs[event["path"]] = event.get("etag")
+        context.set_state(blobs)
+    elif operation == "flush":
+        options = context.get_input()
+        if options.get("full_only") and len(blobs) < options["max_items"]:
+            context.set_result({})
+            return
+        # Oldest entries first, dicts keep the insertion order in the serialized state
+        paths = list(blobs)[:options["max_items"]]
+        context.set_result({path: blobs.pop(path) for path in paths})
+        context.set_state(blobs)
@@ -0,0 +1,38 @@
+import azure.durable_functions as df
+from application.app import app
+import datetime
+import os
+
+LANE_BUDGET_KEY = "global"
+# Reports of runs that stopped reporting, e.g. because their orchestration was terminated, are dropped after this many seconds
+LANE_REPORT_TIMEOUT_SECONDS = int(os.getenv("LANE_REPORT_TIMEOUT_SECONDS", "600"))
+
+
+@app.function_name(name="lane_budget")
+@app.entity_trigger(context_name="context")
+def lane_budget(context: df.DurableEntityContext):
+    """
+    Documents in the works per priority lane, as reported by the `index` orchestrations of that lane, so bulk
+    runs can make room while interactive documents are waiting. State: `{lane: {instance_id: {"active", "at"}}}`.
+    Operations: `report` stores `{"lane", "instance_id", "active", "at"}` (0 removes the run), `get` takes
+    `{"at"}` and returns `{lane: active documents}`.
+    """
+    lanes = context.get_state(lambda: {})
+    operation = context.operation_name
+    if operation == "report":
+        report = context.get_input()
+        runs = lanes.setdefault(report["lane"], {})
+        if report["active"]:
+            runs[report["instance_id"]] = {"active": report["active"], "at": report["at"]}
+        else:
+            runs.pop(report["instance_id"], None)
+        context.set_state(lanes)
+    elif operation == "get":
+        # Timestamps come from the orchestrations, the entity itself has no replay safe clock
+        now = datetime.datetime.fromisoformat(context.get_input()["at"])
+        for runs in lanes.values():
+            for instance_id in [instance_id for instance_id, run in runs.items()
+                                if (now - datetime.datetime.fromisoformat(run["at"])).total_seconds() > LANE_REPORT_TIMEOUT_SECONDS]:
+                del runs[instance_id]
+        context.set_state(lanes)
+        context.set_result({lane: sum(run["active"] for run in runs.values()) for lane, runs in lanes.items()})
@@ -1,28 +1,54 @@
+import datetime
 import json
 import logging
 import os
 import azure.functions as func
-from azure.durable_functions import DurableOrchestrationClient
+from azure.durable_functions import DurableOrchestrationClient, EntityId
 from application.app import app
-from azure.search.documents.indexes.aio import SearchIndexClient
+from application.clients import get_identity_credential, get_search_client
 from azure.search.documents.models import VectorQuery
-from azure.identity import DefaultAzureCredential
 from orchestrators.index import index
+from orchestrators.eventwindow import EVENT_BATCH_MAX_ITEMS, EVENT_BUFFER_KEY, event_window, event_window_input, index_event_window
 from activities.listblob import list_blobs_chunk
+from activities.ingestmanifest import read_manifest_chunk
 from activities.cracking import document_cracking
-from activities.chuncking import chunking
+from activities.chuncking import chunking, chunk_documents
 from activities.classify import classifychunks
 from activities.embedding import embedding
 from activities.extractentities import extractentities
 from activities.search import ensure_index_exists, add_documents
+from activities.payloads import delete_payloads_activity, missing_payloads_activity
+from activities.pipeline import process_document
+from activities.manifest import record_manifest_entry
+from activities.eventbatch import start_index_batch, start_once
+from activities.claims import claim_documents, check_document_claim, release_document_claims
+from entities.checkpoint import document_checkpoint
+from entities.eventbuffer import event_buffer
+from entities.lanes import lane_budget
 
 
 defaults = {
     "BLOB_AMOUNT_PARALLEL": int(os.environ.get("BLOB_AMOUNT_PARALLEL", "20")),
+    "LIST_PAGE_SIZE": int(os.environ.get("LIST_PAGE_SIZE", "5000")),
+    "LIST_PREFIX_PARALLELISM": int(os.environ.get("LIST_PREFIX_PARALLELISM", "4")),
+    "DOCUMENTS_PER_GENERATION": int(os.environ.get("DOCUMENTS_PER_GENERATION", "5000")),
     "SEARCH_INDEX_NAME": os.environ.get("SEARCH_INDEX_NAME", "lumen-contracts-index"),
-    "BLOB_CONTAINER_NAME": os.environ.get("BLOB_CONTAINER_NAME", "contracts")
+    "BLOB_CONTAINER_NAME": os.environ.get("BLOB_CONTAINER_NAME", "contracts"),
+    "INCREMENTAL_INDEXING": os.environ.get("INCREMENTAL_INDEXING", "false").lower() == "true",
+    "STAGE_CHECKPOINTS": os.environ.get("STAGE_CHECKPOINTS", "false").lower() == "true",
+    "PIPELINE_MODE": os.environ.get("PIPELINE_MODE", "stages").lower(),
+    "DEDUPLICATE_DOCUMENTS": os.environ.get("DEDUPLICATE_DOCUMENTS", "false").lower() == "true",
+    "INTERACTIVE_WINDOW_SIZE": int(os.environ.get("INTERACTIVE_WINDOW_SIZE", "50")),
+    "BULK_WINDOW_SIZE_WHEN_BUSY": int(os.environ.get("BULK_WINDOW_SIZE_WHEN_BUSY", "2")),
+    "LANE_CHECK_SECONDS": int(os.environ.get("LANE_CHECK_SECONDS", "15")),
+    "SMALL_DOCUMENT_BYTES": int(os.environ.get("SMALL_DOCUMENT_BYTES", "262144")),
+    "DOCUMENT_GROUP_MAX_BYTES": int(os.environ.get("DOCUMENT_GROUP_MAX_BYTES", "4194304")),
+    "DOCUMENT_GROUP_MAX_DOCUMENTS": int(os.environ.get("DOCUMENT_GROUP_MAX_DOCUMENTS", "25"))
 }
 
+# Events received by this worker per batching window
+_window_events = {}
+
 
 @app.function_name(name='index_event_grid')
 @app.event_grid_trigger(arg_name='event')
@@ -35,8 +61,20 @@ async def index_event_grid(event: func.EventGridEvent, client: DurableOrchestrat
     path_in_container = extract_path(event)
     logging.info(f'Python EventGrid trigger processed a BlobCreated event. Path: {path_in_container}')
 
-    instance_id = await client.start_new("index", client_input={"prefix_list": [path_in_container], "defaults": defaults})
-    logging.info(f'Started indexing with id: {instance_id}')
+    # Events are buffered and indexed in batches by one orchestration per window instead of one per blob
+    await client.signal_entity(EntityId("event_buffer", EVENT_BUFFER_KEY), "add",
+                               {"path": path_in_container, "etag": event.get_json().get("eTag")})
+    window = event_window(datetime.datetime.now(datetime.timezone.utc))
+    instance_id = f"event-window-{window}"
+    if await start_once(client, "index_event_window", instance_id, event_window_input(window, defaults)):
+        logging.info(f'Started event window with id: {instance_id}')
+
+    # Counted per worker, with several workers a batch fills up before any of them notices
+    _window_events[window] = _window_events.get(window, 0) + 1
+    for stale in [key for key in _window_events if key < window]:
+        del _window_events[stale]
+    if _window_events[window] % EVENT_BATCH_MAX_ITEMS == 0:
+        await client.raise_event(instance_id, "full")
 
 def extract_path(event: func.EventGridEvent):
     subject = event.subject
@@ -79,9 +117,16 @@ async def status_id(req: func.HttpRequest, client: DurableOrchestrationClient) -
 async def index_http(req: func.HttpRequest, client: DurableOrchestrationClient) -> func.HttpResponse:
     logging.info('Kick off indexing process.')
     input = req.get_json()
+    if "prefix_list" not in input and "manifest" not in input:
+        return func.HttpResponse("Either prefix_list or manifest is required", status_code=400)
+    client_input = {"index_name": input['index_name'], "defaults": defaults}
+    # A manifest ("<container>/<blob>.jsonl" or ".csv") of blob names replaces listing the prefixes
+    for option in ["prefix_list", "manifest", "incremental", "prefix_parallelism", "window_size", "pipeline_mode", "priority"]:
+        if option in input:
+            client_input[option] = input[option]
     instance_id = await client.start_new(
         orchestration_function_name="index",
-        client_input={"prefix_list": input['prefix_list'], "index_name": input['index_name'], "defaults": defaults})
+        client_input=client_input)
     return func.HttpResponse(instance_id, status_code=200)
 
 @app.function_name(name='orchestration_health')
@@ -113,11 +158,9 @@ async def search_index(req: func.HttpRequest) -> func.HttpResponse:
         if not endpoint or not index_name:
             raise Exception("Missing search service configuration.")
 
-        # Create the async search client
-        search_index_client = SearchIndexClient(endpoint=endpoint, credential=DefaultAzureCredential())
-
-        # Execute the search query (using the provided query text)
-        search_client = search_index_client.get_search_client(index_name=index_name)
+        # Execute the search query (using the provided query text) with the client shared by the worker. Queries
+        # run as the identity of the function app, not with the admin key the indexing activities may use.
+        search_client = get_search_client(index_name, endpoint, get_identity_credential())
         results = await search_client.search(search_text=query,
                                              query_type="semantic",
                                              select="content, sourcepages, id, storageUrl",
@@ -127,10 +170,6 @@ async def search_index(req: func.HttpRequest) -> func.HttpResponse:
             # Each result has a 'document' property that contains the actual document.
             docs.append(result)
 
-        # Ensure the client is closed properly
-        await search_client.close()  
-        await search_index_client.close()
-
         return func.HttpResponse(
             json.dumps(docs), status_code=200, mimetype="application/json"
         )
@@ -0,0 +1,88 @@
+from azure.durable_functions import DurableOrchestrationContext, EntityId
+from application.app import app
+import datetime
+import os
+
+# Event Grid events are collected for this many seconds, or until EVENT_BATCH_MAX_ITEMS blobs are buffered,
+# before one `index` orchestration is started for all of them
+EVENT_BATCH_WINDOW_SECONDS = int(os.getenv("EVENT_BATCH_WINDOW_SECONDS", "30"))
+EVENT_BATCH_MAX_ITEMS = int(os.getenv("EVENT_BATCH_MAX_ITEMS", "1000"))
+# Time after the end of a window for the last signals of the window to reach the buffer
+EVENT_BATCH_GRACE_SECONDS = int(os.getenv("EVENT_BATCH_GRACE_SECONDS", "5"))
+# Batches up to this size are indexed as interactive runs, larger ones (bulk uploads) as bulk runs
+EVENT_BATCH_INTERACTIVE_MAX_ITEMS = int(os.getenv("EVENT_BATCH_INTERACTIVE_MAX_ITEMS", "50"))
+
+EVENT_BUFFER_KEY = "events"
+
+
+def event_window(now: datetime.datetime) -> int:
+    """Number of the batching window `now` falls into."""
+    return int(now.timestamp()) // max(EVENT_BATCH_WINDOW_SECONDS, 1)
+
+
+def event_window_input(window: int, defaults: dict) -> dict:
+    window_end = (window + 1) * max(EVENT_BATCH_WINDOW_SECONDS, 1) + EVENT_BATCH_GRACE_SECONDS
+    return {
+        "window_end": datetime.datetime.fromtimestamp(window_end, datetime.timezone.utc).isoformat(),
+        "max_items": EVENT_BATCH_MAX_ITEMS,
+        "grace_seconds": EVENT_BATCH_GRACE_SECONDS,
+        "interactive_max_items": EVENT_BATCH_INTERACTIVE_MAX_ITEMS,
+        "defaults": defaults
+    }
+
+
+@app.function_name(name="index_event_window")
+@app.orchestration_trigger(context_name="context")
+def index_event_window(context: DurableOrchestrationContext):
+    return (yield from run_event_window(context))
+
+
+def run_event_window(context: DurableOrchestrationContext):
+    """
+    Started once per batching window with the instance id `event-window-<window>`. Waits for the end of the
+    window, or for a `full` event raised when EVENT_BATCH_MAX_ITEMS events were received, flushes the
+    `event_buffer` entity and starts one `index` orchestration per batch of up to `max_items` blob paths, interactive
+    for batches of up to `interactive_max_items` blobs and bulk for larger ones.
+    """
+    input = context.get_input()
+    buffer = EntityId("event_buffer", EVENT_BUFFER_KEY)
+    window_end = datetime.datetime.fromisoformat(input["window_end"])
+    grace = datetime.timedelta(seconds=input.get("grace_seconds", EVENT_BATCH_GRACE_SECONDS))
+    batches = 0
+    final = False
+    while not final:
+        timer = context.create_timer(window_end)
+        full = context.wait_for_external_event("full")
+        winner = yield context.task_any([timer, full])
+        final = winner == timer
+        if not final:
+            timer.cancel()
+
+        # Before the end of the window only full batches are started, the rest waits for more events
+        flushed, batches = yield from flush_buffer(context, buffer, input, batches, full_only=not final)
+
+    flushed = True
+    while flushed:
+        yield context.create_timer(context.current_utc_datetime + grace)
+        flushed, batches = yield from flush_buffer(context, buffer, input, batches, full_only=False)
+
+    return batches
+
+
+def flush_buffer(context: DurableOrchestrationContext, buffer: EntityId, input: dict, batches: int, full_only: bool):
+    """Starts an `index` orchestration per batch flushed from the buffer, returns the number of flushed blobs and batches."""
+    flushed = 0
+    while True:
+        blobs = yield context.call_entity(buffer, "flush", {"max_items": input["max_items"], "full_only": full_only})
+        if not blobs:
+            break
+        priority = "interactive" if len(blobs) <= input.get("interactive_max_items", EVENT_BATCH_INTERACTIVE_MAX_ITEMS) else "bulk"
+        yield context.call_activity("start_index_batch", {
+            "instance_id": f"{context.instance_id}-{batches}",
+            "input": {"prefix_list": list(blobs), "defaults": input["defaults"], "priority": priority}
+        })
+        batches += 1
+        flushed += len(blobs)
+        if len(blobs) < input["max_items"]:
+            break
+    return flushed, batches
@@ -1,14 +1,31 @@
-from azure.durable_functions import DurableOrchestrationContext, RetryOptions
+from azure.durable_functions import DurableOrchestrationContext, EntityId, RetryOptions
 from application.app import app
-import os
+from entities.checkpoint import checkpoint_key
+from entities.lanes import LANE_BUDGET_KEY
+from application.payloadstore import force_offload, is_claim_check
+from collections import deque
+from urllib.parse import urlsplit
+import datetime
 
 @app.function_name(name="index")  # The name used by client.start_new("index")
 @app.orchestration_trigger(context_name="context")
 def index(context: DurableOrchestrationContext):
+    return (yield from run_index(context))
+
+
+def run_index(context: DurableOrchestrationContext):
+    """
+    Body of the `index` orchestrator, kept as a plain generator so it can be driven without the Durable
+    Functions runtime. After DOCUMENTS_PER_GENERATION listed blobs the orchestrator finishes the current
+    listing page and restarts itself with continue_as_new, carrying the listing cursor and counters,
+    so its history (and the replay cost of every step) stays bounded on very large containers.
+    """
     # Resolver resolves list of prefixes to iterable ( needs to store state of iterable e.g. marker and array position)
     input = context.get_input()
-    continuation_token = None
-    array_position = 0
+    # State handed over by the previous generation of this instance
+    continuation = input.get("continuation") or {}
+    cursor = continuation.get("cursor")
+    counters = {"generation": 0, "listed": 0, "skipped": 0, "deduplicated": 0, "documents": 0, "failed": 0, **continuation.get("counters", {})}
     container_name = input.get("defaults").get("BLOB_CONTAINER_NAME")
     if container_name is None:
         raise ValueError("BLOB_CONTAINER_NAME is not set")
@@ -18,40 +35,428 @@ def index(context: DurableOrchestrationContext):
     blob_amount_parallel = input.get("defaults").get("BLOB_AMOUNT_PARALLEL")
     if blob_amount_parallel is None:
         raise ValueError("BLOB_AMOUNT_PARALLEL is not set")
-    
-    yield context.call_activity(name="ensure_index_exists", input_=index_name)
+    # "interactive" runs (single uploads someone waits for) get their own budget, "bulk" runs make room for them
+    priority = input.get("priority", "bulk")
+    if priority not in ("interactive", "bulk"):
+        raise ValueError(f"Unknown priority {priority}")
+    # Documents indexed at the same time, BLOB_AMOUNT_PARALLEL (INTERACTIVE_WINDOW_SIZE for interactive runs) unless set for this run
+    if priority == "interactive":
+        window_size = input.get("window_size", input.get("defaults").get("INTERACTIVE_WINDOW_SIZE", blob_amount_parallel))
+    else:
+        window_size = input.get("window_size", blob_amount_parallel)
+    if window_size < 1:
+        raise ValueError(f"Window size must be at least 1, got {window_size}")
+    # Window of a bulk run while interactive documents are in the works, checked every LANE_CHECK_SECONDS (0 disables lanes)
+    busy_window_size = min(window_size, input.get("defaults").get("BULK_WINDOW_SIZE_WHEN_BUSY", window_size))
+    if busy_window_size < 1:
+        raise ValueError(f"BULK_WINDOW_SIZE_WHEN_BUSY must be at least 1, got {busy_window_size}")
+    lane_check_seconds = input.get("defaults").get("LANE_CHECK_SECONDS", 0)
+    lanes = EntityId("lane_budget", LANE_BUDGET_KEY)
+    list_page_size = input.get("defaults").get("LIST_PAGE_SIZE", blob_amount_parallel)
+    prefix_parallelism = input.get("prefix_parallelism", input.get("defaults").get("LIST_PREFIX_PARALLELISM", 1))
+    # Skip blobs that have not changed since they were last indexed into this index
+    incremental = input.get("incremental", input.get("defaults").get("INCREMENTAL_INDEXING", False))
+    # Persist the output of every stage so a retried document resumes at the failed stage
+    stage_checkpoints = input.get("defaults").get("STAGE_CHECKPOINTS", False)
+    # "fused" processes every document in one pipelined activity, "stages" with one activity per stage
+    pipeline_mode = input.get("pipeline_mode", input.get("defaults").get("PIPELINE_MODE", "stages"))
+    # Claim every document for this run, so documents already in the works for another run are not processed twice
+    deduplicate = input.get("defaults").get("DEDUPLICATE_DOCUMENTS", False)
+    # Blobs up to SMALL_DOCUMENT_BYTES are indexed together in document groups of limited size, 0 disables groups
+    small_document_bytes = input.get("defaults").get("SMALL_DOCUMENT_BYTES", 0)
+    group_max_bytes = input.get("defaults").get("DOCUMENT_GROUP_MAX_BYTES", small_document_bytes)
+    group_max_documents = input.get("defaults").get("DOCUMENT_GROUP_MAX_DOCUMENTS", 1)
+    # Blobs listed before the orchestrator continues as new, 0 keeps a single generation
+    generation_size = input.get("defaults").get("DOCUMENTS_PER_GENERATION", 0)
+
+    if not continuation:
+        yield context.call_activity(name="ensure_index_exists", input_=index_name)
+    # Blobs come from a manifest of blob names when one is given, otherwise the prefixes are listed
+    if "manifest" in input:
+        source_activity = "read_manifest_chunk"
+        source_params = {"manifest": input["manifest"]}
+    else:
+        source_activity = "list_blobs_chunk"
+        source_params = {
+            "prefix_list": [""] if "prefix_list" not in input else input["prefix_list"],
+            "prefix_parallelism": prefix_parallelism
+        }
     # For every item in iterable create a sub orchestrator ( should be every file in the blob storage)
-    while True:
-        prefix_list = [""] if "prefix_list" not in input else input["prefix_list"] 
-        blob_list_result = yield context.call_activity("list_blobs_chunk", {
-                    "container_name": container_name,
-                    "continuation_token": continuation_token,
-                    "chunk_size": blob_amount_parallel,
-                    "prefix_list_offset": array_position,
-                    "prefix_list": prefix_list
-            })
-        if(len(blob_list_result["blob_names"]) == 0):
+    # Up to window_size documents are in flight, a slot is refilled as soon as any document finishes.
+    # The next listing page is requested while the current one is still being worked off.
+    queue = deque()
+    in_flight = []
+    # Documents of every task in flight, document groups take one slot for several documents
+    in_flight_documents = {}
+    # Input of every index_document in flight, to clean up after documents that fail for good
+    in_flight_inputs = {}
+    listing = None
+    listing_done = False
+    # Blobs listed (or skipped as unchanged) by this generation
+    generation_listed = 0
+    lanes_checked_at = None
+    interactive_busy = False
+    reported_active = 0
+    reported_at = None
+    # Wakes an interactive run up to refresh its report while its documents take longer than LANE_CHECK_SECONDS
+    report_timer = None
+    # A failed interactive run must not keep bulk runs throttled until its report times out. Not a finally:
+    # the runtime closes a generator that waits for a task, which must not report anything.
+    try:
+        while True:
+            if lane_check_seconds and priority == "bulk" and (lanes_checked_at is None or (context.current_utc_datetime - lanes_checked_at).total_seconds() >= lane_check_seconds):
+                lanes_checked_at = context.current_utc_datetime
+                active = yield context.call_entity(lanes, "get", {"at": lanes_checked_at.isoformat()})
+                interactive_busy = bool((active or {}).get("interactive"))
+            generation_full = generation_size > 0 and generation_listed >= generation_size
+            if listing is None and not listing_done and not generation_full and len(queue) <= window_size:
+                listing = context.call_activity(source_activity, {
+                        **source_params,
+                        "container_name": container_name,
+                        "cursor": cursor,
+                        "page_size": list_page_size,
+                        "index_name": index_name,
+                        "incremental": incremental
+                })
+            while queue and len(in_flight) < (busy_window_size if interactive_busy else window_size):
+                document_retry_options = RetryOptions(first_retry_interval_in_milliseconds=60_000, max_number_of_attempts=3)
+                blob = queue.popleft()
+                group = take_group(blob, queue, small_document_bytes, group_max_bytes, group_max_documents)
+                if len(group) > 1:
+                    task = context.call_sub_orchestrator_with_retry(
+                        name="index_document_group",
+                        retry_options=document_retry_options,
+                        input_={"documents": group, "index_name": index_name})
+                else:
+                    document_input = {**blob, "index_name": index_name, "stage_checkpoints": stage_checkpoints, "pipeline_mode": pipeline_mode}
+                    task = context.call_sub_orchestrator_with_retry(
+                        name="index_document",
+                        retry_options=document_retry_options,
+                        input_=document_input,
+                        instance_id=blob.get("instance_id"))
+                    in_flight_inputs[id(task)] = document_input
+                in_flight.append(task)
+                in_flight_documents[id(task)] = len(group)
+            if lane_check_seconds and priority == "interactive":
+                active_documents = sum(in_flight_documents.values()) + len(queue)
+                # Reported on every tick, not only on changes, so the report does not time out while documents run long
+                due = reported_at is None or (context.current_utc_datetime - reported_at).total_seconds() >= lane_check_seconds
+                if active_documents != reported_active or (active_documents and due):
+                    reported_active = active_documents
+                    reported_at = context.current_utc_datetime
+                    context.signal_entity(lanes, "report", {"lane": priority, "instance_id": context.instance_id,
+                                                            "active": reported_active, "at": reported_at.isoformat()})
+            waiting = in_flight + ([listing] if listing is not None else [])
+            if not waiting:
+                break
+            if reported_active and report_timer is None:
+                report_timer = context.create_timer(reported_at + datetime.timedelta(seconds=lane_check_seconds))
+            finished = yield context.task_any(waiting + ([report_timer] if report_timer is not None else []))
+            if finished is report_timer:
+                report_timer = None
+                continue
+            # task_any hands back failed tasks too, fail like the batch did
+            if isinstance(finished.result, Exception):
+                failed = in_flight_inputs.get(id(finished))
+                if failed is not None and failed["stage_checkpoints"]:
+                    # All retries are used up, nothing resumes from the checkpoint of this document any more
+                    checkpoint = EntityId("document_checkpoint", checkpoint_key(failed))
+                    outputs = (yield context.call_entity(checkpoint, "get")) or {}
+                    claim_checks = [payload for payload in outputs.values() if is_claim_check(payload)]
+                    if claim_checks:
+                        yield context.call_activity("delete_payloads", claim_checks)
+                    context.signal_entity(checkpoint, "delete")
+                raise finished.result
+            if finished is listing:
+                blobs = finished.result["blobs"]
+                if deduplicate and blobs:
+                    # Claimed blobs carry the deterministic instance id of their index_document orchestration
+                    claimed = yield context.call_activity("claim_documents", {"index_name": index_name, "owner": context.instance_id, "blobs": blobs,
+                                                                             "page": f"{counters['generation']}-{counters['listed']}"})
+                    counters["deduplicated"] += claimed["deduplicated"]
+                    blobs = claimed["blobs"]
+                queue.extend(blobs)
+                cursor = finished.result["cursor"]
+                # A page can be empty because all of its blobs were skipped, only stop once the source is exhausted
+                listing_done = finished.result["done"]
+                listing = None
+                counters["listed"] += len(finished.result["blobs"])
+                counters["skipped"] += finished.result.get("skipped", 0)
+                generation_listed += len(finished.result["blobs"]) + finished.result.get("skipped", 0)
+                context.set_custom_status(counters)
+            else:
+                in_flight.remove(finished)
+                in_flight_inputs.pop(id(finished), None)
+                # Blobs a group could not crack are indexed on their own, with the retries and failure handling of single documents
+                ungrouped = (finished.result or {}).get("ungrouped", [])
+                queue.extendleft(reversed([{**document, "single": True} for document in ungrouped]))
+                counters["documents"] += in_flight_documents.pop(id(finished)) - len(ungrouped)
+                # Chunks that could not be uploaded do not fail the document, they are counted and retried by the next run
+                failed = failed_documents(finished.result)
+                if failed:
+                    counters["failed"] += failed
+                    context.set_custom_status(counters)
+    except Exception:
+        if reported_active:
+            context.signal_entity(lanes, "report", {"lane": priority, "instance_id": context.instance_id,
+                                                    "active": 0, "at": context.current_utc_datetime.isoformat()})
+        raise
+    if report_timer is not None and not report_timer.is_completed:
+        report_timer.cancel()
+
+    if not listing_done:
+        # Start over with an empty history, the next generation picks up the listing at the cursor
+        counters["generation"] += 1
+        context.set_custom_status(counters)
+        context.continue_as_new({**input, "continuation": {"cursor": cursor, "counters": counters}})
+        return counters
+    context.set_custom_status(counters)
+    return counters
+
+
+def failed_documents(result) -> int:
+    """Documents of an `index_document` or `index_document_group` result with chunks that failed to upload."""
+    if not result:
+        return 0
+    if "group" in result:
+        return result["group"] - result["indexed"] - result.get("superseded", 0)
+    return 1 if result.get("failed") else 0
+
+
+def take_group(blob, queue, small_document_bytes, group_max_bytes, group_max_documents):
+    """
+    `blob` alone, or together with the next small blobs of the queue when it is small itself, as many as fit
+    into the group limits. Grouped blobs are removed from the queue, the others keep their order. Blobs handed
+    back by a group are not grouped again, and a group holds one blob per file name, the ids of the index
+    documents are derived from it.
+    """
+    def is_small(candidate):
+        return small_document_bytes > 0 and not candidate.get("single") \
+            and candidate.get("size") is not None and candidate["size"] <= small_document_bytes
+
+    group = [blob]
+    if not is_small(blob):
+        return group
+    group_bytes = blob["size"]
+    filenames = {file_name(blob)}
+    remaining = deque()
+    # Only look a little ahead, so a queue of mostly large blobs is not scanned for every document
+    scanned = 0
+    while queue and scanned < 4 * group_max_documents:
+        candidate = queue.popleft()
+        scanned += 1
+        if len(group) < group_max_documents and is_small(candidate) and group_bytes + candidate["size"] <= group_max_bytes \
+                and file_name(candidate) not in filenames:
+            group.append(candidate)
+            group_bytes += candidate["size"]
+            filenames.add(file_name(candidate))
+        else:
+            remaining.append(candidate)
+        if len(group) >= group_max_documents:
             break
-        continuation_token = blob_list_result["continuation_token"]
-        array_position = blob_list_result["prefix_list_offset"]
-        task_list = []
-        for blob_name in blob_list_result["blob_names"]:
-            document_retry_options = RetryOptions(first_retry_interval_in_milliseconds=60_000, max_number_of_attempts=3)
-            task_list.append(context.call_sub_orchestrator_with_retry(
-                name="index_document",
-                retry_options=document_retry_options,
-                input_={"blob_url": blob_name, "index_name": index_name}))
-        yield context.task_all(task_list)
-    
+    queue.extendleft(reversed(remaining))
+    return group
+
+
+def file_name(blob) -> str:
+    return blob["blob_name"].rsplit("/", 1)[-1]
+
 
 @app.function_name(name="index_document")  # The name used by client.start_new("index")
 @app.orchestration_trigger(context_name="context")
 def index_document(context: DurableOrchestrationContext):
+    return (yield from run_document(context))
+
+
+def run_document(context: DurableOrchestrationContext):
+    """Body of the `index_document` orchestrator, a plain generator like `run_index`."""
+    input = context.get_input()
+    service_retry_options = RetryOptions(first_retry_interval_in_milliseconds=3000, max_number_of_attempts=3)
+
+    # With stage checkpoints a retry of this sub orchestration skips the stages that already completed
+    checkpoint = None
+    completed = {}
+    if input.get("stage_checkpoints"):
+        checkpoint = EntityId("document_checkpoint", checkpoint_key(input))
+        completed = (yield context.call_entity(checkpoint, "get")) or {}
+        if completed:
+            # A checkpoint whose payloads are gone can not be resumed from, the stages run again
+            missing = yield context.call_activity("missing_payloads", list(completed.values()))
+            if missing:
+                context.signal_entity(checkpoint, "delete")
+                completed = {}
+
+    def superseded(outputs):
+        """
+        Whether a run for a newer version of the blob took over the claim of this instance. A superseded
+        instance cleans up the stage outputs it offloaded and its checkpoint.
+        """
+        if "instance_id" not in input:
+            return False
+        current = yield context.call_activity("check_document_claim", {key: input[key] for key in ["index_name", "blob_name", "instance_id"]})
+        if current:
+            return False
+        context.set_custom_status("superseded")
+        claim_checks = [payload for payload in outputs if is_claim_check(payload)]
+        if claim_checks:
+            yield context.call_activity("delete_payloads", claim_checks)
+        if checkpoint is not None:
+            context.signal_entity(checkpoint, "delete")
+        return True
+
+    blob = {key: input.get(key) for key in ["blob_url", "blob_name", "content_md5", "content_type"] if key in input}
+    if input.get("pipeline_mode") == "fused" and not completed:
+        if (yield from superseded([])):
+            return {"superseded": True}
+        try:
+            upload = yield context.call_activity_with_retry("process_document", service_retry_options, {**blob, "index_name": input["index_name"]})
+        except Exception:
+            # The per stage activities, with their checkpoints, are the durable fallback
+            upload = None
+        if upload is not None:
+            if not upload["failed"]:
+                yield from record_indexed(context, input)
+            return upload
+
+    # Offloaded outputs of this attempt
+    produced = []
+
+    def run_stage(name, stage_input, retry_options=None):
+        if name in completed:
+            return completed[name]
+        # Checkpointed outputs are always claim checks, so neither the entity nor the histories hold payloads
+        if checkpoint is not None:
+            stage_input = force_offload(stage_input)
+        if retry_options is None:
+            output = yield context.call_activity(name, stage_input)
+        else:
+            output = yield context.call_activity_with_retry(name, retry_options, stage_input)
+        if is_claim_check(output):
+            produced.append(output)
+            if checkpoint is not None:
+                context.signal_entity(checkpoint, "set", {"stage": name, "output": output})
+        return output
+
+    # Not a finally, see run_index
+    try:
+        document = yield from run_stage("document_cracking", blob, service_retry_options)
+        chunks = yield from run_stage("chunking", document)
+        chunks_with_embeddings = yield from run_stage("embedding", chunks, service_retry_options)
+        chunks_with_embeddings_entities = yield from run_stage("extract_entities", chunks_with_embeddings, service_retry_options)
+        chunks_with_embeddings_entities_classification = yield from run_stage("classify", chunks_with_embeddings_entities, service_retry_options)
+        outputs = [document, chunks, chunks_with_embeddings, chunks_with_embeddings_entities, chunks_with_embeddings_entities_classification]
+        # A superseded version must not overwrite the chunks of the newer one, the claim is checked once before the upload
+        if (yield from superseded(outputs)):
+            return {"superseded": True}
+        upload = yield context.call_activity_with_retry("add_documents",  service_retry_options,{"chunks": chunks_with_embeddings_entities_classification, "index_name": input["index_name"]})
+    except Exception:
+        # Without a checkpoint the next attempt starts from scratch, with one the index orchestrator cleans
+        # up once the document has used up its retries
+        if checkpoint is None and produced:
+            yield context.call_activity("delete_payloads", produced)
+        raise
+    if upload and upload["failed"]:
+        # Keep the stage outputs and leave the blob out of the manifest, the next run retries the document
+        return upload
+    yield from record_indexed(context, input)
+    # Large stage outputs were passed as claim checks, remove the blobs they refer to
+    claim_checks = [payload for payload in outputs if is_claim_check(payload)]
+    if claim_checks:
+        yield context.call_activity("delete_payloads", claim_checks)
+    if checkpoint is not None:
+        context.signal_entity(checkpoint, "delete")
+    return upload
+
+
+def record_indexed(context: DurableOrchestrationContext, input):
+    """Record the indexed version of the blob in the manifest, so incremental runs skip it until it changes."""
+    if "blob_name" in input:
+        yield context.call_activity("record_manifest_entry", {"index_name": input["index_name"], "blob": {key: input.get(key) for key in ["blob_name", "etag", "content_md5"]}})
+
+
+@app.function_name(name="index_document_group")
+@app.orchestration_trigger(context_name="context")
+def index_document_group(context: DurableOrchestrationContext):
+    return (yield from run_document_group(context))
+
+
+def run_document_group(context: DurableOrchestrationContext):
+    """
+    Indexes a group of small documents: every blob is cracked on its own, chunking, embedding, entity
+    extraction, classification and upload run once for the chunks of the whole group. Blobs whose chunks
+    were all uploaded are recorded in the manifest, the others are retried by the next incremental run.
+    Blobs that fail to crack are left out and handed back as `ungrouped`, the index orchestrator indexes
+    them on their own. Groups have no stage checkpoints (a retry cracks its small documents again) and always run the stage
+    activities, whatever the pipeline mode. Superseded documents are left out of the upload.
+    """
     input = context.get_input()
+    documents = input["documents"]
     service_retry_options = RetryOptions(first_retry_interval_in_milliseconds=3000, max_number_of_attempts=3)
-    document = yield context.call_activity_with_retry("document_cracking", service_retry_options, input["blob_url"])
-    chunks = yield context.call_activity("chunking", document)
-    chunks_with_embeddings = yield context.call_activity_with_retry("embedding", service_retry_options, chunks)
-    chunks_with_embeddings_entities = yield context.call_activity_with_retry("extract_entities", service_retry_options, chunks_with_embeddings)
-    chunks_with_embeddings_entities_classification = yield context.call_activity_with_retry("classify", service_retry_options, chunks_with_embeddings_entities)
-    yield context.call_activity_with_retry("add_documents",  service_retry_options,{"chunks": chunks_with_embeddings_entities_classification, "index_name": input["index_name"]})
\ No newline at end of file
+
+    # Cracked documents are passed on as claim checks, so the input of chunk_documents stays small for the whole group
+    cracking = [
+        context.call_activity_with_retry("document_cracking", service_retry_options, force_offload(
+                                         {key: document[key] for key in ["blob_url", "blob_name", "content_md5", "content_type"] if key in document}))
+        for document in documents
+    ]
+    # Not task_all, one blob that can not be cracked must not fail the whole group
+    pending = list(cracking)
+    while pending:
+        finished = yield context.task_any(pending)
+        pending.remove(finished)
+    ungrouped = [document for document, task in zip(documents, cracking) if isinstance(task.result, Exception)]
+    documents = [document for document, task in zip(documents, cracking) if not isinstance(task.result, Exception)]
+    cracked = [task.result for task in cracking if not isinstance(task.result, Exception)]
+    if not documents:
+        return {"group": 0, "indexed": 0, "superseded": 0, "ungrouped": ungrouped}
+    outputs = list(cracked)
+    # Not a finally, see run_index. A retry of the group cracks its documents again, the outputs of this attempt are not needed anymore.
+    try:
+        chunks = yield context.call_activity("chunk_documents", cracked)
+        outputs.append(chunks)
+        chunks_with_embeddings = yield context.call_activity_with_retry("embedding", service_retry_options, chunks)
+        outputs.append(chunks_with_embeddings)
+        chunks_with_embeddings_entities = yield context.call_activity_with_retry("extract_entities", service_retry_options, chunks_with_embeddings)
+        outputs.append(chunks_with_embeddings_entities)
+        chunks_with_embeddings_entities_classification = yield context.call_activity_with_retry("classify", service_retry_options, chunks_with_embeddings_entities)
+        outputs.append(chunks_with_embeddings_entities_classification)
+
+        claimed = [document for document in documents if "instance_id" in document]
+        superseded = []
+        if claimed:
+            current = yield context.call_activity("check_document_claim", {"index_name": input["index_name"], "blobs": [
+                {key: document[key] for key in ["blob_name", "instance_id"]} for document in claimed
+            ]})
+            superseded = [document for document, holds in zip(claimed, current) if not holds]
+        upload = yield context.call_activity_with_retry("add_documents", service_retry_options, {
+            "chunks": chunks_with_embeddings_entities_classification,
+            "index_name": input["index_name"],
+            "exclude_urls": [source_url(document) for document in superseded],
+        })
+    except Exception:
+        claim_checks = [payload for payload in outputs if is_claim_check(payload)]
+        if claim_checks:
+            yield context.call_activity("delete_payloads", claim_checks)
+        raise
+
+    # Uploads report failures by the blob url of the source file, without its SAS token
+    failed_urls = set(upload.get("failed_urls", [])) if upload else set()
+    indexed = [document for document in documents if document not in superseded and source_url(document) not in failed_urls]
+    recorded = [document for document in indexed if "blob_name" in document]
+    if recorded:
+        yield context.call_activity("record_manifest_entry", {"index_name": input["index_name"], "blobs": [
+            {key: document.get(key) for key in ["blob_name", "etag", "content_md5"]} for document in recorded
+        ]})
+    if claimed:
+        yield context.call_activity("release_document_claims", {"index_name": input["index_name"], "blobs": [
+            {key: document[key] for key in ["blob_name", "instance_id"]} for document in claimed
+        ]})
+    claim_checks = [payload for payload in outputs if is_claim_check(payload)]
+    if claim_checks:
+        yield context.call_activity("delete_payloads", claim_checks)
+    return {**(upload or {}), "group": len(documents), "indexed": len(indexed), "superseded": len(superseded), "ungrouped": ungrouped}
+
+
+def source_url(document) -> str:
+    """Blob url of a document without its SAS token, as reported by add_documents."""
+    return urlsplit(document["blob_url"])._replace(query=None).geturl()
@@ -0,0 +1,90 @@
+"""
+Benchmark of the chunking activity on a synthetic 1,000 page document: page number lookup with
+the previous linear walk against the bisect over cumulative page offsets, and the cost of building
+a new chunker per call against reusing the warm one.
+
+    python tests/benchmarks/bench_chunking.py --pages 1000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from activities.chuncking import get_chunker, get_page_number, page_offsets  # noqa: E402
+
+SENTENCES = [
+    "The Supplier shall provide the Services in accordance with the Service Levels.",
+    "Either party may terminate this Agreement upon ninety (90) days written notice.",
+    "All fees are exclusive of taxes and payable within thirty (30) days of invoice.",
+    "Confidential Information shall not be disclosed to any third party.",
+]
+
+
+def synthetic_pages(count: int, seed: int = 42):
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(SENTENCES, k=rng.randint(20, 40))) for _ in range(count)]
+
+
+def legacy_get_page_number(position: int, pages):
+    """The previous implementation, walking all pages for every lookup."""
+    position -= 1
+    for page_number, page_content in enumerate(pages):
+        if position < len(page_content):
+            return page_number
+        position -= len(page_content)
+    raise ValueError("Position out of range")
+
+
+def chunk_boundaries(total_length: int, chunk_chars: int = 2000, overlap_chars: int = 500):
+    """Start and end offsets shaped like the chunker output (512 tokens with 128 tokens overlap)."""
+    boundaries = []
+    start = 0
+    while start < total_length:
+        end = min(start + chunk_chars, total_length)
+        boundaries.append((start, end))
+        start = end - overlap_chars if end < total_length else end
+    return boundaries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    args = parser.parse_args()
+
+    pages = synthetic_pages(args.pages)
+    boundaries = chunk_boundaries(sum(map(len, pages)))
+    print(f"pages: {len(pages)}, chunks: {len(boundaries)}")
+
+    start = time.perf_counter()
+    legacy = [(legacy_get_page_number(s, pages), legacy_get_page_number(e, pages)) for s, e in boundaries]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    page_ends = page_offsets(pages)
+    current = [(get_page_number(s, page_ends), get_page_number(e, page_ends)) for s, e in boundaries]
+    current_seconds = time.perf_counter() - start
+
+    assert legacy == current, "page numbers differ between implementations"
+    print(f"page mapping before (linear walk): {legacy_seconds * 1000:10.2f} ms")
+    print(f"page mapping after (bisect):       {current_seconds * 1000:10.2f} ms")
+    print(f"speedup:                           {legacy_seconds / current_seconds:10.1f}x")
+
+    try:
+        start = time.perf_counter()
+        get_chunker()
+        cold_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        get_chunker()
+        warm_seconds = time.perf_counter() - start
+    except Exception as ex:
+        print(f"chunker construction skipped, tokenizer not available: {ex}")
+        return
+    print(f"chunker first call (loads tokenizer): {cold_seconds * 1000:10.2f} ms")
+    print(f"chunker later calls (warm):           {warm_seconds * 1000:10.4f} ms")
+
+
+if __name__ == "__main__":
+    main()
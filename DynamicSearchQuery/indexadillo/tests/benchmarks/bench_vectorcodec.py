@@ -0,0 +1,59 @@
+"""
+Payload size and serialization time of the chunk list passed between activities, with embeddings
+as JSON float lists against packed base64 float32 / float16 buffers.
+
+    python tests/benchmarks/bench_vectorcodec.py --chunks 300
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from application.vectorcodec import embedding_matrix, pack_embeddings  # noqa: E402
+
+
+def synthetic_chunks(count: int, dimensions: int = 3072, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(scale=0.02, size=(count, dimensions)).astype(np.float32)
+    return [
+        {"filename": "contract.pdf", "text": "lorem ipsum " * 150, "token_count": 450, "embedding": vector.tolist()}
+        for vector in vectors
+    ]
+
+
+def measure(chunks, encoding: str, repeat: int):
+    """Size of the JSON payload and best time for one hop: pack, dumps, loads and decoding the vectors."""
+    best = float("inf")
+    size = 0
+    for _ in range(repeat):
+        working_copy = copy.deepcopy(chunks)
+        start = time.perf_counter()
+        data = json.dumps(pack_embeddings(working_copy, encoding))
+        embedding_matrix(json.loads(data))
+        best = min(best, time.perf_counter() - start)
+        size = len(data)
+    return size, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    chunks = synthetic_chunks(args.chunks)
+    print(f"chunks: {args.chunks}, dimensions: 3072")
+    print(f"{'encoding':10} {'payload size':>14} {'per chunk':>12} {'hop time':>10}")
+    for encoding in ["json", "float32", "float16"]:
+        size, seconds = measure(chunks, encoding, args.repeat)
+        print(f"{encoding:10} {size / 2 ** 20:11.2f} MB {size / args.chunks / 1024:9.1f} KB {seconds * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+# The function app is not a package, its modules import each other relative to src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from azure.core.exceptions import ResourceNotFoundError  # noqa: E402
+
+from application import ratelimit  # noqa: E402
+
+
+class FakeContainer:
+    """
+    Blob container in memory. Counts listings and properties lookups, and how many requests run at the same
+    time, every upload and download takes `latency` seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.blobs = {}
+        self.metadata = {}
+        self.lists = 0
+        self.gets = 0
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def request(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+
+    def upload_blob(self, name, data, metadata=None, overwrite=False):
+        self.request()
+        self.blobs[name] = data
+        self.metadata[name] = dict(metadata or {})
+
+    def download_blob(self, name):
+        self.request()
+        if name not in self.blobs:
+            raise ResourceNotFoundError(name)
+        data = self.blobs[name]
+        return SimpleNamespace(readall=lambda: data)
+
+    def delete_blob(self, name):
+        if name not in self.blobs:
+            raise ResourceNotFoundError(name)
+        del self.blobs[name]
+        del self.metadata[name]
+
+    def list_blobs(self, name_starts_with="", include=None):
+        self.lists += 1
+        for name in sorted(self.blobs):
+            if name.startswith(name_starts_with):
+                yield SimpleNamespace(name=name, metadata=self.metadata[name])
+
+    def get_blob_client(self, name):
+        def get_blob_properties():
+            self.gets += 1
+            if name not in self.blobs:
+                raise ResourceNotFoundError(name)
+            return SimpleNamespace(metadata=self.metadata[name])
+
+        return SimpleNamespace(get_blob_properties=get_blob_properties, exists=lambda: name in self.blobs)
+
+
+@pytest.fixture
+def blob_container():
+    return FakeContainer()
+
+
+@pytest.fixture(autouse=True)
+def local_rate_limiters(monkeypatch):
+    """Every test gets rate limiters of its own, unlimited and not coordinated through storage."""
+    monkeypatch.setattr(ratelimit, "_limiters", {})
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_COORDINATION", "none")
+    for service in ratelimit.RATE_LIMITED_SERVICES:
+        monkeypatch.delenv(f"RATE_LIMIT_{service.upper()}_RPM", raising=False)
+        monkeypatch.delenv(f"RATE_LIMIT_{service.upper()}_TPM", raising=False)
@@ -0,0 +1,11 @@
+from application.batching import pack_batches
+
+
+def test_batches_keep_the_order_within_size_and_item_limits():
+    assert pack_batches([3, 3, 3, 3, 3], max_size=7, max_items=10) == [[0, 1], [2, 3], [4]]
+    assert pack_batches([1, 1, 1, 1, 1], max_size=100, max_items=2) == [[0, 1], [2, 3], [4]]
+
+
+def test_oversized_item_gets_a_batch_of_its_own():
+    assert pack_batches([2, 50, 2], max_size=10, max_items=10) == [[0], [1], [2]]
+    assert pack_batches([], max_size=10, max_items=10) == []
@@ -0,0 +1,119 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+from azure.durable_functions import OrchestrationRuntimeStatus
+
+from activities.claims import DocumentClaims, claim_document, document_instance_id, unique_blobs
+
+
+class MemoryClaims(DocumentClaims):
+    """DocumentClaims on a dict, with a counter as storage ETag."""
+
+    def __init__(self, index_name):
+        self.index_name = index_name
+        self.entries = {}
+
+    def read(self, blob_name):
+        return self.entries.get(blob_name, (None, None))
+
+    def write(self, blob_name, claim, etag):
+        if self.entries.get(blob_name, (None, None))[1] != etag:
+            return False
+        self.entries[blob_name] = (claim, (etag or 0) + 1)
+        return True
+
+
+class FakeClient:
+    def __init__(self, statuses=None, outputs=None):
+        self.statuses = statuses or {}
+        self.outputs = outputs or {}
+
+    async def get_status(self, instance_id):
+        return SimpleNamespace(runtime_status=self.statuses.get(instance_id), output=self.outputs.get(instance_id))
+
+
+def blob(etag, last_modified="2026-01-01T00:00:00+00:00"):
+    return {"blob_name": "contract.pdf", "blob_url": "https://account/source/contract.pdf", "etag": etag, "last_modified": last_modified}
+
+
+def claim(client, claims, blob_, owner="run-1", page="0-0"):
+    return asyncio.run(claim_document(client, claims, blob_, owner, page))
+
+
+def test_instance_id_depends_on_index_blob_and_version():
+    assert document_instance_id("index", blob("1")) == document_instance_id("index", blob("1"))
+    assert document_instance_id("index", blob("1")) != document_instance_id("index", blob("2"))
+    assert document_instance_id("index", blob("1")) != document_instance_id("other", blob("1"))
+
+
+def test_running_document_is_deduplicated():
+    claims = MemoryClaims("index")
+    assert claim(FakeClient(), claims, blob("1")) == "claimed"
+
+    running = FakeClient({document_instance_id("index", blob("1")): OrchestrationRuntimeStatus.Running})
+    assert claim(running, claims, blob("1"), owner="run-2") == "deduplicated"
+    # Claimed by another run but not started yet
+    assert claim(FakeClient(), claims, blob("1"), owner="run-2") == "deduplicated"
+
+
+def test_indexed_document_is_deduplicated():
+    claims = MemoryClaims("index")
+    claim(FakeClient(), claims, blob("1"))
+    instance_id = document_instance_id("index", blob("1"))
+
+    completed = FakeClient({instance_id: OrchestrationRuntimeStatus.Completed}, {instance_id: {"failed": 0}})
+    assert claim(completed, claims, blob("1"), owner="run-2") == "deduplicated"
+    # A new version is indexed again
+    assert claim(completed, claims, blob("2", last_modified="2026-01-01T00:05:00+00:00"), owner="run-2") == "claimed"
+
+
+def test_failed_document_can_be_claimed_again():
+    claims = MemoryClaims("index")
+    claim(FakeClient(), claims, blob("1"))
+    instance_id = document_instance_id("index", blob("1"))
+
+    for status, output in [(OrchestrationRuntimeStatus.Failed, None), (OrchestrationRuntimeStatus.Completed, {"failed": 2})]:
+        finished = FakeClient({instance_id: status}, {instance_id: output})
+        assert claim(finished, claims, blob("1"), owner="run-2") == "claimed"
+        assert claims.read("contract.pdf")[0]["owner"] == "run-2"
+        claims.entries.clear()
+        claim(FakeClient(), claims, blob("1"))
+
+
+def test_blob_listed_twice_by_the_same_run_is_deduplicated():
+    claims = MemoryClaims("index")
+    assert claim(FakeClient(), claims, blob("1"), page="0-0") == "claimed"
+    assert claim(FakeClient(), claims, blob("1"), page="0-100") == "deduplicated"
+
+
+def test_retried_claim_of_the_same_page_is_claimed_again():
+    claims = MemoryClaims("index")
+    assert claim(FakeClient(), claims, blob("1")) == "claimed"
+    assert claim(FakeClient(), claims, blob("1")) == "claimed"
+
+
+def test_duplicates_within_a_page_are_claimed_once():
+    other = {**blob("1"), "blob_name": "other.pdf"}
+    assert unique_blobs([blob("1"), other, blob("1")]) == [blob("1"), other]
+
+
+def test_newer_version_supersedes_the_running_one():
+    claims = MemoryClaims("index")
+    claim(FakeClient(), claims, blob("1"))
+    running = FakeClient({document_instance_id("index", blob("1")): OrchestrationRuntimeStatus.Running})
+
+    newer = blob("2", last_modified="2026-01-01T00:05:00+00:00")
+    assert claim(running, claims, newer, owner="run-2") == "superseded"
+    assert claims.read("contract.pdf")[0]["instance_id"] == document_instance_id("index", newer)
+    # A stale listing of the old version does not take the claim back
+    assert claim(FakeClient(), claims, blob("1"), owner="run-3") == "deduplicated"
+
+
+def test_expired_claim_of_a_document_that_never_started_is_taken_over():
+    claims = MemoryClaims("index")
+    claim(FakeClient(), claims, blob("1"))
+    entry, etag = claims.entries["contract.pdf"]
+    entry["claimed_at"] = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)).isoformat()
+
+    assert claim(FakeClient(), claims, blob("1"), owner="run-2") == "claimed"
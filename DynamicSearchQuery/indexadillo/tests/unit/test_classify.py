@@ -0,0 +1,89 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from activities import classify
+from activities.classify import classify_batch, classify_text, parse_batch_response
+from application.embeddingclassifier import EmbeddingClassifier
+
+
+class FakeChatClient:
+    """Answers chat completions from `answers` in order and keeps the messages of every request."""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, max_tokens, temperature):
+        self.requests.append(messages)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.answers.pop(0)))])
+
+
+def test_parse_batch_response_accepts_json_arrays_of_known_labels():
+    assert parse_batch_response('["SignatureBlock", " Other "]', 2) == ["SignatureBlock", "Other"]
+    assert parse_batch_response('```json\n["PricingBlock"]\n```', 1) == ["PricingBlock"]
+
+
+@pytest.mark.parametrize("content", [
+    '["SignatureBlock"]',                   # wrong count
+    '["SignatureBlock", "Contract"]',       # unknown label
+    '{"labels": ["Other", "Other"]}',       # not an array
+    'SignatureBlock, Other',                # not JSON
+    '["Other", 1]',
+])
+def test_parse_batch_response_rejects_malformed_answers(content):
+    assert parse_batch_response(content, 2) is None
+
+
+def test_single_and_batch_requests_share_the_system_message():
+    client = FakeChatClient(["SignatureBlock", json.dumps(["Other", "PricingBlock", "Other"])])
+
+    asyncio.run(classify_text(client, "By: Rex Smith"))
+    asyncio.run(classify_batch(client, ["a", "b", "c"]))
+
+    single, batch = client.requests
+    assert single[0] == batch[0] == {"role": "system", "content": classify.SYSTEM_PROMPT}
+    assert classify.CLASSIFICATION_GUIDELINES in classify.SYSTEM_PROMPT
+    assert "exactly 3 entries" in batch[1]["content"]
+
+
+def test_unknown_single_label_falls_back_to_other():
+    client = FakeChatClient(["SignatureBlock.", "The text is a preamble"])
+
+    assert asyncio.run(classify_text(client, "By: Rex Smith")) == "SignatureBlock"
+    assert asyncio.run(classify_text(client, "Whereas")) == "Other"
+
+
+def test_malformed_batch_is_classified_one_by_one():
+    client = FakeChatClient(['["Other"]', "PreambleBlock", "PricingBlock"])
+
+    assert asyncio.run(classify_batch(client, ["a", "b"])) == ["PreambleBlock", "PricingBlock"]
+    assert len(client.requests) == 3
+
+
+def test_uncertain_chunks_go_to_the_chat_model(monkeypatch):
+    classifier = EmbeddingClassifier(["Other", "PricingBlock"], np.array([[1, 0], [0, 1]]))
+
+    async def get_classifier(embed):
+        return classifier
+
+    client = FakeChatClient(["SignatureBlock"])
+    monkeypatch.setattr(classify, "CLASSIFY_MODE", "embedding")
+    monkeypatch.setattr(classify, "CLASSIFY_EMBEDDING_MIN_MARGIN", 0.1)
+    monkeypatch.setattr(classify, "get_embedding_classifier", get_classifier)
+    monkeypatch.setattr(classify, "get_openai_client", lambda purpose: client)
+    chunks = [
+        {"text": "page 4", "embedding": [1.0, 0.0]},
+        {"text": "By: Rex Smith", "embedding": [1.0, 1.0]},
+        {"text": "$5,000", "embedding": [0.0, 1.0]},
+    ]
+
+    asyncio.run(classify.classify_chunks(chunks))
+
+    assert [chunk["classification"] for chunk in chunks] == ["Other", "SignatureBlock", "PricingBlock"]
+    assert len(client.requests) == 1
+    assert "By: Rex Smith" in client.requests[0][1]["content"]
@@ -0,0 +1,35 @@
+import asyncio
+
+from application import clients
+
+
+class FakeAsyncClient:
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def test_async_clients_are_closed_on_their_event_loop_at_exit():
+    loop = asyncio.new_event_loop()
+
+    async def register():
+        return clients.get_async_client("fake", FakeAsyncClient)
+
+    client = loop.run_until_complete(register())
+    try:
+        clients.close_clients()
+        assert client.closed
+    finally:
+        loop.close()
+
+
+def test_search_clients_are_cached_per_credential():
+    async def create():
+        first = clients.get_search_client("index", "https://search", credential=clients.AzureKeyCredential("a"))
+        second = clients.get_search_client("index", "https://search", credential=clients.AzureKeyCredential("b"))
+        return first, second
+
+    first, second = asyncio.run(create())
+
+    assert first is not second
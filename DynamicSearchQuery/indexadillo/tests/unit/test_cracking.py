@@ -0,0 +1,137 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+from activities import cracking
+from activities.cracking import analyze_layout, page_texts
+
+URL = "https://account/source/report.pdf?sas"
+
+
+def page(number):
+    return SimpleNamespace(page_number=number, lines=[{"content": f"page {number}"}])
+
+
+def cell(row, column, content, page_number):
+    return SimpleNamespace(row_index=row, column_index=column, content=content,
+                           bounding_regions=[SimpleNamespace(page_number=page_number)])
+
+
+def range_error(code, inner_code=None):
+    error = {"error": {"code": code, "message": "Invalid request."}}
+    if inner_code:
+        error["error"]["innererror"] = {"code": inner_code, "message": "Input content range is not valid."}
+    response = SimpleNamespace(status_code=400, reason="Bad Request", headers={}, text=lambda: json.dumps(error), request=None)
+    return HttpResponseError(response=response)
+
+
+class FakePoller:
+    def __init__(self, result):
+        self._result = result
+
+    async def result(self):
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+
+class FakeClient:
+    """Document Intelligence client for a document with `page_count` pages, `errors` fails chosen ranges."""
+
+    def __init__(self, page_count, errors=None):
+        self.page_count = page_count
+        self.errors = errors or {}
+        self.requested = []
+
+    async def begin_analyze_document(self, model_id, request, pages=None):
+        self.requested.append(pages)
+        if pages in self.errors:
+            return FakePoller(self.errors[pages])
+        first, last = (int(number) for number in pages.split("-")) if pages else (1, self.page_count)
+        if first > self.page_count:
+            return FakePoller(range_error("InvalidRequest", "InvalidContentRange"))
+        numbers = range(first, min(last, self.page_count) + 1)
+        return FakePoller(SimpleNamespace(pages=[page(number) for number in numbers], tables=[]))
+
+
+def analyze(client, url=URL, range_size=2, max_concurrent=2):
+    return asyncio.run(analyze_layout(client, url, range_size, max_concurrent))
+
+
+def test_ranges_are_merged_until_a_short_range():
+    client = FakeClient(page_count=7)
+
+    assert analyze(client) == [f"page {number}" for number in range(1, 8)]
+    assert client.requested == ["1-2", "3-4", "5-6", "7-8", "9-10"]
+
+
+def test_range_past_the_last_page_ends_the_document():
+    client = FakeClient(page_count=4)
+
+    assert analyze(client) == ["page 1", "page 2", "page 3", "page 4"]
+    assert client.requested == ["1-2", "3-4", "5-6"]
+
+
+def test_other_bad_requests_fail_the_document():
+    client = FakeClient(page_count=6, errors={"3-4": range_error("InvalidRequest", "InvalidPageRange")})
+
+    with pytest.raises(HttpResponseError):
+        analyze(client)
+
+
+def test_documents_that_are_not_paginated_are_analyzed_at_once():
+    client = FakeClient(page_count=3)
+
+    assert analyze(client, url="https://account/source/slides.pptx") == ["page 1", "page 2", "page 3"]
+    assert client.requested == [None]
+
+
+def test_page_texts_places_tables_by_page_number_across_ranges():
+    first = SimpleNamespace(pages=[page(1), page(2)], tables=[])
+    second = SimpleNamespace(pages=[page(3)], tables=[
+        SimpleNamespace(cells=[cell(0, 0, "a", 3), cell(0, 1, "b", 3), cell(1, 0, "c", 3)])
+    ])
+
+    texts = page_texts([second, first])
+
+    assert texts[:2] == ["page 1", "page 2"]
+    assert texts[2] == "page 3\n\n--- TABLE START ---\na | b\nc | \n--- TABLE END ---\n"
+
+
+class FailingContainer:
+    def download_blob(self, name):
+        raise HttpResponseError("storage is down")
+
+    def upload_blob(self, name, data, overwrite=False):
+        raise HttpResponseError("storage is down")
+
+
+def test_cache_errors_do_not_fail_cracking(monkeypatch):
+    monkeypatch.setattr(cracking, "get_container_client", lambda name: FailingContainer())
+    cache = cracking.CrackingCache("prebuilt-layout", "2024-07-31-preview", 1)
+
+    assert cache.get("0" * 32) is None
+    cache.put("0" * 32, ["page 1"])
+
+
+def test_unreachable_cache_storage_does_not_fail_cracking(monkeypatch):
+    def get_container_client(name):
+        raise HttpResponseError("storage is down")
+
+    monkeypatch.setattr(cracking, "get_container_client", get_container_client)
+    cache = cracking.CrackingCache("prebuilt-layout", "2024-07-31-preview", 1)
+
+    assert cache.get("0" * 32) is None
+    cache.put("0" * 32, ["page 1"])
+
+
+def test_content_hash_comes_from_the_listing():
+    assert cracking.content_hash({"blob_url": URL, "content_md5": "AAECAw=="}) == "00010203"
+
+
+def test_listed_blob_without_md5_is_not_looked_up(monkeypatch):
+    monkeypatch.setattr(cracking, "_source_storage", None)
+    assert cracking.content_hash({"blob_url": URL, "content_md5": None}) is None
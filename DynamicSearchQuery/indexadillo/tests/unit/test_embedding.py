@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from activities import embedding
+from activities.embedding import count_tokens, embed_texts
+
+
+class FakeEncoding:
+    """One token per word."""
+
+    def encode_ordinary_batch(self, texts):
+        return [text.split() for text in texts]
+
+
+class FakeEmbeddingsClient:
+    """Returns the input position of every text as its vector, in reverse order, and tracks concurrent requests."""
+
+    def __init__(self):
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.embeddings = SimpleNamespace(create=self.create)
+
+    async def create(self, input, model, dimensions):
+        self.requests.append({"input": input, "model": model, "dimensions": dimensions})
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[float(int(text.split()[0]))])
+                                     for i, text in reversed(list(enumerate(input)))])
+
+
+@pytest.fixture
+def words(monkeypatch):
+    monkeypatch.setattr(embedding, "get_encoding", lambda: FakeEncoding())
+
+
+def test_tokens_are_counted_with_the_embedding_tokenizer(words):
+    assert count_tokens(["one two three", ""]) == [3, 0]
+
+
+def test_utf8_size_bounds_the_tokens_without_the_tokenizer(monkeypatch):
+    monkeypatch.setattr(embedding, "get_encoding", lambda: None)
+    assert count_tokens(["abc", "äö"]) == [3, 4]
+
+
+def test_tokenizer_is_only_loaded_once(monkeypatch):
+    loads = []
+
+    def get_encoding(name):
+        loads.append(name)
+        raise ConnectionError("offline")
+
+    monkeypatch.setattr(embedding, "_encoding", None)
+    monkeypatch.setattr(embedding.tiktoken, "get_encoding", get_encoding)
+    assert embedding.get_encoding() is None
+    assert embedding.get_encoding() is None
+    assert loads == [embedding.EMBEDDING_TOKENIZER]
+
+
+def test_texts_are_embedded_in_token_budgeted_batches_in_order(words, monkeypatch):
+    monkeypatch.setattr(embedding, "EMBEDDING_BATCH_MAX_TOKENS", 10)
+    monkeypatch.setattr(embedding, "EMBEDDING_BATCH_MAX_INPUTS", 3)
+    texts = [f"{i} " + "word " * (i % 4) for i in range(12)]
+    client = FakeEmbeddingsClient()
+
+    vectors = asyncio.run(embed_texts(client, texts))
+
+    assert vectors == [[float(i)] for i in range(12)]
+    for request in client.requests:
+        assert len(request["input"]) <= 3
+        assert sum(len(text.split()) for text in request["input"]) <= 10
+        assert (request["model"], request["dimensions"]) == (embedding.EMBEDDING_MODEL, embedding.EMBEDDING_DIMENSIONS)
+    assert sorted(text for request in client.requests for text in request["input"]) == sorted(texts)
+
+
+def test_requests_in_flight_are_bounded(words, monkeypatch):
+    monkeypatch.setattr(embedding, "EMBEDDING_BATCH_MAX_INPUTS", 1)
+    monkeypatch.setattr(embedding, "EMBEDDING_MAX_IN_FLIGHT", 2)
+    client = FakeEmbeddingsClient()
+
+    asyncio.run(embed_texts(client, [str(i) for i in range(6)]))
+
+    assert len(client.requests) == 6
+    assert client.max_in_flight == 2
@@ -0,0 +1,104 @@
+import pytest
+
+from application import embeddingcache
+from application.embeddingcache import (
+    BlobEmbeddingCacheBackend, EmbeddingCache, EmbeddingCacheBackend, SqliteEmbeddingCacheBackend, embedding_cache_key
+)
+
+
+class MemoryBackend(EmbeddingCacheBackend):
+
+    def __init__(self):
+        self.items = {}
+
+    def get_many(self, keys):
+        return {key: self.items[key] for key in keys if key in self.items}
+
+    def put_many(self, items):
+        self.items.update(items)
+
+
+class FailingBackend(EmbeddingCacheBackend):
+
+    def get_many(self, keys):
+        raise OSError("disk full")
+
+    def put_many(self, items):
+        raise OSError("disk full")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Every call to time.time in the cache module returns the next second."""
+    ticks = iter(range(1, 1000))
+    monkeypatch.setattr(embeddingcache.time, "time", lambda: next(ticks))
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        EmbeddingCacheBackend()
+
+
+def test_key_depends_on_text_model_and_dimensions():
+    key = embedding_cache_key("text", "model", 3072)
+    assert key == embedding_cache_key("text", "model", 3072)
+    assert len({
+        key,
+        embedding_cache_key("other text", "model", 3072),
+        embedding_cache_key("text", "other model", 3072),
+        embedding_cache_key("text", "model", 256),
+    }) == 4
+
+
+def test_hits_and_misses_are_counted_per_text():
+    cache = EmbeddingCache(MemoryBackend(), "model", 2)
+    assert cache.get_many(["a", "b"]) == [None, None]
+    cache.put_many(["a"], [[0.5, 1.0]])
+    assert cache.get_many(["a", "b", "a"]) == [[0.5, 1.0], None, [0.5, 1.0]]
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_backend_errors_count_as_misses():
+    cache = EmbeddingCache(FailingBackend(), "model", 2)
+    cache.put_many(["a"], [[0.5, 1.0]])
+    assert cache.get_many(["a"]) == [None]
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_sqlite_round_trips_float32_vectors(tmp_path):
+    backend = SqliteEmbeddingCacheBackend(str(tmp_path / "cache.sqlite"), max_entries=10)
+    backend.put_many({"a": [0.25, -1.5], "b": [0.1]})
+    found = backend.get_many(["a", "b", "c"])
+    assert found["a"] == [0.25, -1.5]
+    assert found["b"] == pytest.approx([0.1])
+    assert "c" not in found
+
+
+def test_sqlite_evicts_least_recently_used(tmp_path, clock):
+    backend = SqliteEmbeddingCacheBackend(str(tmp_path / "cache.sqlite"), max_entries=2)
+    backend.put_many({"a": [1.0]})
+    backend.put_many({"b": [2.0]})
+    # Reading "a" makes "b" the least recently used entry
+    backend.get_many(["a"])
+    backend.put_many({"c": [3.0]})
+    assert sorted(backend.get_many(["a", "b", "c"])) == ["a", "c"]
+
+
+def test_sqlite_keeps_entries_across_connections(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    SqliteEmbeddingCacheBackend(path, max_entries=10).put_many({"a": [1.0]})
+    assert SqliteEmbeddingCacheBackend(path, max_entries=10).get_many(["a"]) == {"a": [1.0]}
+
+
+
+def test_blob_backend_sends_a_bounded_number_of_requests_at_a_time(monkeypatch, blob_container):
+    container = blob_container
+    container.latency = 0.01
+    monkeypatch.setattr(embeddingcache, "get_container_client", lambda name, setting: container)
+    backend = BlobEmbeddingCacheBackend("embedding-cache", max_concurrency=4)
+
+    backend.put_many({str(i): [float(i)] for i in range(20)})
+    found = backend.get_many([str(i) for i in range(25)])
+
+    assert found == {str(i): [float(i)] for i in range(20)}
+    assert container.max_in_flight == 4
@@ -0,0 +1,67 @@
+import asyncio
+import json
+from collections import Counter
+
+import numpy as np
+
+from activities import classify
+from application import embeddingclassifier
+from application.embeddingclassifier import EmbeddingClassifier, get_embedding_classifier, load_examples
+
+
+def test_centroids_are_the_normalized_mean_of_their_examples():
+    classifier = EmbeddingClassifier.from_examples(
+        np.array([[2, 0], [0, 1], [0, 3]]), ["Other", "PricingBlock", "PricingBlock"]
+    )
+    assert classifier.labels == ["Other", "PricingBlock"]
+    np.testing.assert_allclose(classifier.centroids, [[1, 0], [0, 1]])
+
+
+def test_predict_returns_the_nearest_label_and_the_margin():
+    classifier = EmbeddingClassifier(["Other", "PricingBlock"], np.array([[1, 0], [0, 1]]))
+
+    labels, confidence = classifier.predict(np.array([[3, 0], [1, 2], [1, 1]]))
+
+    assert labels[:2] == ["Other", "PricingBlock"]
+    np.testing.assert_allclose(confidence, [1.0, 2 / np.sqrt(5) - 1 / np.sqrt(5), 0.0], atol=1e-6)
+
+
+def test_zero_vectors_are_not_confident():
+    classifier = EmbeddingClassifier(["Other", "PricingBlock"], np.array([[1, 0], [0, 1]]))
+    _, confidence = classifier.predict(np.zeros((1, 2)))
+    assert confidence[0] == 0.0
+
+
+def test_single_label_is_always_confident():
+    classifier = EmbeddingClassifier(["Other"], np.array([[1, 0]]))
+    labels, confidence = classifier.predict(np.array([[0, 1], [1, 0]]))
+    assert labels == ["Other", "Other"]
+    assert confidence.tolist() == [1.0, 1.0]
+
+
+def test_shipped_examples_cover_every_label():
+    counts = Counter(example["classification"] for example in load_examples())
+    assert set(counts) == set(classify.LABELS)
+    assert min(counts.values()) >= embeddingclassifier.MIN_EXAMPLES_PER_LABEL
+
+
+def test_classifier_is_built_once_from_the_examples(monkeypatch, tmp_path):
+    path = tmp_path / "examples.json"
+    path.write_text(json.dumps([
+        {"text": "fees", "classification": "PricingBlock"},
+        {"text": "page 4", "classification": "Other"},
+    ]))
+    monkeypatch.setattr(embeddingclassifier, "CLASSIFICATION_EXAMPLES_PATH", str(path))
+    monkeypatch.setattr(embeddingclassifier.load_examples, "__defaults__", (str(path),))
+    monkeypatch.setattr(embeddingclassifier, "_classifier", None)
+    calls = []
+
+    async def embed(texts):
+        calls.append(texts)
+        return [[0.0, 1.0] if text == "fees" else [1.0, 0.0] for text in texts]
+
+    classifier = asyncio.run(get_embedding_classifier(embed))
+    assert asyncio.run(get_embedding_classifier(embed)) is classifier
+    assert calls == [["fees", "page 4"]]
+    assert classifier.predict(np.array([[0.1, 1.0]]))[0] == ["PricingBlock"]
+
@@ -0,0 +1,143 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from activities.eventbatch import start_once
+from orchestrators.eventwindow import run_event_window
+
+
+class FakeTask:
+    def __init__(self, name, result=None):
+        self.name = name
+        self.result = result
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeContext:
+    """
+    Stands in for DurableOrchestrationContext. `wakeups` says what ends every wait of the orchestrator,
+    "full" or "timer", and `buffer` plays the event_buffer entity. `late` reaches the buffer during the
+    first grace period after the end of the window.
+    """
+
+    instance_id = "event-window-7"
+    current_utc_datetime = datetime.datetime(2026, 1, 1, 0, 0, 35, tzinfo=datetime.timezone.utc)
+
+    def __init__(self, buffer, wakeups, max_items=3, late=None):
+        self.input = {"window_end": "2026-01-01T00:00:35+00:00", "max_items": max_items, "grace_seconds": 5,
+                      "defaults": {"BLOB_CONTAINER_NAME": "source"}}
+        self.buffer = dict(buffer)
+        self.wakeups = list(wakeups)
+        self.late = dict(late or {})
+        self.started = []
+        self.timers = []
+
+    def get_input(self):
+        return self.input
+
+    def create_timer(self, fire_at):
+        if not self.wakeups:
+            self.buffer.update(self.late)
+            self.late = {}
+        timer = FakeTask("timer")
+        self.timers.append(timer)
+        return timer
+
+    def wait_for_external_event(self, name):
+        return FakeTask(name)
+
+    def task_any(self, tasks):
+        wakeup = self.wakeups.pop(0)
+        return FakeTask("any", next(task for task in tasks if task.name == wakeup))
+
+    def call_entity(self, entity_id, operation, options):
+        if options["full_only"] and len(self.buffer) < options["max_items"]:
+            return FakeTask("flush", {})
+        paths = list(self.buffer)[:options["max_items"]]
+        return FakeTask("flush", {path: self.buffer.pop(path) for path in paths})
+
+    def call_activity(self, name, input_):
+        self.started.append(input_)
+        return FakeTask(name, input_["instance_id"])
+
+
+def run(context):
+    generator = run_event_window(context)
+    value = None
+    while True:
+        try:
+            task = generator.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value = task.result
+
+
+def blobs(count):
+    return {f"doc{i}.pdf": f"etag{i}" for i in range(count)}
+
+
+def test_flushes_everything_in_batches_at_the_end_of_the_window():
+    context = FakeContext(blobs(7), ["timer"])
+
+    assert run(context) == 3
+    assert [batch["input"]["prefix_list"] for batch in context.started] == [
+        ["doc0.pdf", "doc1.pdf", "doc2.pdf"], ["doc3.pdf", "doc4.pdf", "doc5.pdf"], ["doc6.pdf"]
+    ]
+    assert [batch["instance_id"] for batch in context.started] == [f"event-window-7-{i}" for i in range(3)]
+    assert context.buffer == {}
+
+
+def test_full_event_only_starts_full_batches_before_the_window_ends():
+    context = FakeContext(blobs(4), ["full", "timer"])
+
+    assert run(context) == 2
+    assert context.timers[0].cancelled
+    assert context.started[0]["input"]["prefix_list"] == ["doc0.pdf", "doc1.pdf", "doc2.pdf"]
+    assert context.started[1]["input"]["prefix_list"] == ["doc3.pdf"]
+
+
+def test_signals_that_arrive_after_the_final_flush_are_flushed():
+    context = FakeContext(blobs(2), ["timer"], late={"late.pdf": "etag"})
+
+    assert run(context) == 2
+    assert [batch["input"]["prefix_list"] for batch in context.started] == [["doc0.pdf", "doc1.pdf"], ["late.pdf"]]
+    # Window timer, the grace period that found the late path and the one that found the buffer empty
+    assert len(context.timers) == 3
+    assert context.buffer == {}
+
+
+class StartClient:
+    """Durable client whose instance is started by a concurrent invocation between status check and start."""
+
+    def __init__(self, exists_after_start):
+        self.statuses = []
+        self.exists_after_start = exists_after_start
+
+    async def get_status(self, instance_id):
+        return SimpleNamespace(runtime_status=self.statuses[-1] if self.statuses else None)
+
+    async def start_new(self, name, instance_id=None, client_input=None):
+        if self.exists_after_start:
+            self.statuses.append("Running")
+        raise Exception("An Orchestration instance with the status Running already exists.")
+
+
+def test_start_of_an_instance_that_already_exists_counts_as_started():
+    assert asyncio.run(start_once(StartClient(exists_after_start=True), "index_event_window", "event-window-7", {})) is False
+
+    with pytest.raises(Exception):
+        asyncio.run(start_once(StartClient(exists_after_start=False), "index_event_window", "event-window-7", {}))
+
+
+def test_large_batches_are_indexed_as_bulk_runs():
+    context = FakeContext(blobs(4), ["timer"])
+    context.input["interactive_max_items"] = 2
+
+    run(context)
+
+    assert [batch["input"]["priority"] for batch in context.started] == ["bulk", "interactive"]
@@ -0,0 +1,64 @@
+import pytest
+
+from activities.extractentities import extract_entities
+
+
+def test_urls_and_their_host():
+    entities = extract_entities("See https://contracts.contoso.com/notices for details.")
+    assert entities["urls"] == ["https://contracts.contoso.com"]
+    assert entities["domains"] == ["contracts.contoso.com"]
+
+
+def test_emails_and_their_domain():
+    entities = extract_entities("Write to legal@contoso.com or to counsel (at) fabrikam.com and jane at example.org.")
+    assert entities["emails"] == ["legal@contoso.com", "counsel@fabrikam.com", "jane@example.org"]
+    assert entities["domains"] == ["contoso.com", "fabrikam.com", "example.org"]
+
+
+def test_user_part_of_an_email_is_not_a_domain():
+    entities = extract_entities("Contact first.last@contoso.com")
+    assert entities["emails"] == ["first.last@contoso.com"]
+    assert entities["domains"] == ["contoso.com"]
+
+
+def test_plain_domains():
+    assert extract_entities("Policies at www.fabrikam.com/terms apply.")["domains"] == ["www.fabrikam.com"]
+
+
+@pytest.mark.parametrize("text, zipcodes, phonenumbers", [
+    ("Redmond, WA 98052", ["98052"], []),
+    ("Santa Clara, CA 95054-1234", ["95054-1234"], []),
+    ("Call (425) 555-0100", [], ["(425) 555-0100"]),
+    ("Call +1 425 555 0199", [], ["+1 425 555 0199"]),
+    ("Call 555-0100", [], ["555-0100"]),
+    # Phone numbers need at least seven digits
+    ("Section 13 of 90 days, 1.5% per month", [], []),
+    ("Ext. 555-01", [], []),
+])
+def test_zipcodes_and_phonenumbers(text, zipcodes, phonenumbers):
+    entities = extract_entities(text)
+    assert entities["zipcodes"] == zipcodes
+    assert entities["phonenumbers"] == phonenumbers
+
+
+def test_matches_do_not_overlap():
+    # The zip code is not also reported as the start of a phone number, nor the URL host as a second URL
+    entities = extract_entities("98052 https://contoso.com")
+    assert entities == {
+        "zipcodes": ["98052"],
+        "domains": ["contoso.com"],
+        "urls": ["https://contoso.com"],
+        "phonenumbers": [],
+        "emails": [],
+    }
+
+
+def test_values_are_deduplicated_in_order_and_capped():
+    text = " ".join(f"{zipcode} 98052" for zipcode in range(10000, 10005))
+    assert extract_entities(text)["zipcodes"] == ["10000", "98052", "10001", "10002", "10003", "10004"]
+    assert extract_entities(text, max_per_type=3)["zipcodes"] == ["10000", "98052", "10001"]
+
+
+def test_matches_only_start_at_token_starts():
+    assert extract_entities("ID12345 x98052") == {entity_type: [] for entity_type in
+                                                   ["zipcodes", "domains", "urls", "phonenumbers", "emails"]}
@@ -0,0 +1,418 @@
+import datetime
+
+import pytest
+
+from application.payloadstore import force_offload
+from entities.checkpoint import checkpoint_key
+from orchestrators.index import run_document, run_document_group, run_index
+
+
+class FakeTask:
+    def __init__(self, name, input_, result, duration=1):
+        self.name = name
+        self.input = input_
+        self.result = result
+        self.duration = duration
+
+
+class FakeTimer(FakeTask):
+    def __init__(self, started_at, duration):
+        super().__init__("timer", None, None, duration)
+        self.started_at = started_at
+        self.is_completed = False
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeAnyTask:
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+
+class FakeContext:
+    """
+    Stands in for DurableOrchestrationContext. Listing pages are served from `pages` with the page index as
+    cursor, documents take `durations[blob_name]` time units (1 by default) and task_any completes the task
+    that finishes first on a simulated clock. Other activities return `results[name](input)`, documents in
+    `failures` fail and `checkpoints` holds the state of the document_checkpoint entities.
+    """
+
+    def __init__(self, input_, pages, durations=None, results=None, failures=None, checkpoints=None):
+        self.input = input_
+        self.pages = pages
+        self.durations = durations or {}
+        self.now = 0
+        self.activities = []
+        self.documents = []
+        self.started = []
+        self.groups = []
+        self.max_in_flight = 0
+        self.custom_status = None
+        self.continued_with = None
+        self.instance_id = "run"
+        # Active documents per lane returned by the lane_budget entity, by simulated time
+        self.lanes = lambda now: {}
+        self.lane_reports = []
+        self.results = results or {}
+        self.failures = failures or set()
+        self.checkpoints = checkpoints or {}
+        self.signals = []
+        self.timers = []
+
+    @property
+    def current_utc_datetime(self):
+        return datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(seconds=self.now)
+
+    def call_entity(self, entity_id, operation, input_=None):
+        if entity_id.name == "document_checkpoint":
+            result = self.checkpoints.get(entity_id.key)
+        else:
+            result = self.lanes(self.now)
+        task = FakeTask("call_entity", input_, result)
+        task.started_at = self.now
+        return task
+
+    def signal_entity(self, entity_id, operation, input_=None):
+        if operation == "report":
+            self.lane_reports.append(input_["active"])
+        else:
+            self.signals.append((entity_id.name, entity_id.key, operation, input_))
+
+    def get_input(self):
+        return self.input
+
+    def call_activity(self, name, input_=None):
+        self.activities.append((name, input_))
+        result = self.results[name](input_) if name in self.results else None
+        if name == "list_blobs_chunk":
+            position = input_["cursor"] or 0
+            result = {"blobs": self.pages[position], "cursor": position + 1, "done": position + 1 >= len(self.pages), "skipped": 0}
+        task = FakeTask(name, input_, result)
+        task.started_at = self.now
+        return task
+
+    def call_activity_with_retry(self, name, retry_options, input_=None):
+        return self.call_activity(name, input_)
+
+    def task_all(self, tasks):
+        return FakeTask("task_all", None, [task.result for task in tasks])
+
+    def call_sub_orchestrator_with_retry(self, name, retry_options, input_, instance_id=None):
+        if name == "index_document_group":
+            self.groups.append([document["blob_name"] for document in input_["documents"]])
+            self.documents.extend(self.groups[-1])
+            task = FakeTask("index_document", input_, self.results[name](input_) if name in self.results else None)
+            task.started_at = self.now
+            return task
+        self.documents.append(input_["blob_name"])
+        self.started.append((self.now, input_["blob_name"]))
+        result = self.results[name](input_) if name in self.results else None
+        if input_["blob_name"] in self.failures:
+            result = RuntimeError(f"{input_['blob_name']} failed")
+        task = FakeTask(name, input_, result, self.durations.get(input_["blob_name"], 1))
+        task.started_at = self.now
+        return task
+
+    def create_timer(self, fire_at):
+        self.timers.append(FakeTimer(self.now, (fire_at - self.current_utc_datetime).total_seconds()))
+        return self.timers[-1]
+
+    def task_any(self, tasks):
+        self.max_in_flight = max(self.max_in_flight, sum(1 for task in tasks if task.name == "index_document"))
+        return FakeAnyTask(tasks)
+
+    def set_custom_status(self, status):
+        self.custom_status = dict(status)
+
+    def continue_as_new(self, input_):
+        self.continued_with = input_
+
+
+def run(context, orchestrator=run_index):
+    """
+    Drive the orchestrator generator until it returns, completing tasks in order of their finish time.
+    Activities whose result is an exception fail.
+    """
+    generator = orchestrator(context)
+    value = None
+    while True:
+        try:
+            # Failed activities raise in the orchestrator, task_any hands back the failed task
+            task = generator.throw(value) if isinstance(value, Exception) else generator.send(value)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(task, FakeAnyTask):
+            value = min(task.tasks, key=lambda child: child.started_at + child.duration)
+            context.now = value.started_at + value.duration
+            if isinstance(value, FakeTimer):
+                value.is_completed = True
+        else:
+            value = task.result
+
+
+def make_input(**overrides):
+    defaults = {"BLOB_CONTAINER_NAME": "source", "SEARCH_INDEX_NAME": "index", "BLOB_AMOUNT_PARALLEL": 3, "LIST_PAGE_SIZE": 4}
+    return {"prefix_list": [""], "defaults": {**defaults, **overrides}}
+
+
+def page(prefix, count):
+    return [{"blob_name": f"{prefix}{i}", "blob_url": f"https://account/source/{prefix}{i}"} for i in range(count)]
+
+
+def test_sliding_window_keeps_slots_busy_around_a_slow_document():
+    context = FakeContext(make_input(), [page("a", 4), [], page("b", 4)], durations={"a0": 100})
+
+    counters = run(context)
+
+    assert sorted(context.documents) == sorted([f"a{i}" for i in range(4)] + [f"b{i}" for i in range(4)])
+    assert context.max_in_flight == 3
+    # Everything else is done while the slow document, started after the first listing, is still running
+    assert context.now == 101
+    assert counters == {"generation": 0, "listed": 8, "skipped": 0, "deduplicated": 0, "documents": 8, "failed": 0}
+    assert context.continued_with is None
+    assert context.activities[0] == ("ensure_index_exists", "index")
+
+
+def test_continues_as_new_with_cursor_and_counters():
+    context = FakeContext(make_input(DOCUMENTS_PER_GENERATION=4), [page("a", 4), page("b", 4), page("c", 1)])
+
+    counters = run(context)
+
+    # The first generation stops listing after one page and drains it before continuing as new
+    assert context.documents == [f"a{i}" for i in range(4)]
+    assert [name for name, _ in context.activities].count("list_blobs_chunk") == 1
+    assert context.continued_with["continuation"] == {"cursor": 1, "counters": counters}
+    assert counters == {"generation": 1, "listed": 4, "skipped": 0, "deduplicated": 0, "documents": 4, "failed": 0}
+    assert context.continued_with["prefix_list"] == [""]
+
+
+def test_next_generation_resumes_at_the_cursor():
+    input_ = make_input(DOCUMENTS_PER_GENERATION=4)
+    input_["continuation"] = {"cursor": 1, "counters": {"generation": 1, "listed": 4, "skipped": 0, "deduplicated": 0, "documents": 4, "failed": 0}}
+    context = FakeContext(input_, [page("a", 4), page("b", 4), page("c", 1)])
+
+    counters = run(context)
+
+    assert "ensure_index_exists" not in [name for name, _ in context.activities]
+    assert context.activities[0][1]["cursor"] == 1
+    assert context.documents == [f"b{i}" for i in range(4)]
+    assert counters["generation"] == 2
+    assert context.continued_with["continuation"]["cursor"] == 2
+
+    final = FakeContext(context.continued_with, [page("a", 4), page("b", 4), page("c", 1)])
+    assert run(final) == {"generation": 2, "listed": 9, "skipped": 0, "deduplicated": 0, "documents": 9, "failed": 0}
+    assert final.continued_with is None
+    assert final.custom_status == {"generation": 2, "listed": 9, "skipped": 0, "deduplicated": 0, "documents": 9, "failed": 0}
+
+
+def test_bulk_run_shrinks_its_window_while_interactive_documents_are_active():
+    context = FakeContext(make_input(BLOB_AMOUNT_PARALLEL=4, LIST_PAGE_SIZE=8, LANE_CHECK_SECONDS=1, BULK_WINDOW_SIZE_WHEN_BUSY=1),
+                          [page("a", 8)], durations={f"a{i}": 2 for i in range(8)})
+    context.lanes = lambda now: {"interactive": 1} if now < 4 else {"interactive": 0}
+
+    run(context)
+
+    # One document at a time while the interactive lane is busy, the full window afterwards
+    assert [name for at, name in context.started if at < 4] == ["a0", "a1"]
+    assert [name for at, name in context.started if at == 5] == ["a2", "a3", "a4", "a5"]
+
+
+@pytest.mark.parametrize("overrides", [{"BLOB_AMOUNT_PARALLEL": 0}, {"BULK_WINDOW_SIZE_WHEN_BUSY": 0}])
+def test_empty_windows_are_rejected(overrides):
+    context = FakeContext(make_input(**overrides), [page("a", 3)])
+
+    with pytest.raises(ValueError):
+        run(context)
+
+
+def test_interactive_run_reports_its_active_documents():
+    input_ = make_input(LANE_CHECK_SECONDS=1, INTERACTIVE_WINDOW_SIZE=10)
+    input_["priority"] = "interactive"
+    context = FakeContext(input_, [page("a", 3)])
+
+    run(context)
+
+    assert context.max_in_flight == 3
+    assert context.lane_reports[0] == 3
+    assert context.lane_reports[-1] == 0
+
+
+def test_small_blobs_are_indexed_in_groups():
+    sizes = [100, 5000, 100, 100, 100, 100, 100]
+    blobs = [{**blob, "size": size} for blob, size in zip(page("a", 7), sizes)]
+    context = FakeContext(make_input(LIST_PAGE_SIZE=7, SMALL_DOCUMENT_BYTES=1000, DOCUMENT_GROUP_MAX_BYTES=300, DOCUMENT_GROUP_MAX_DOCUMENTS=10), [blobs])
+
+    counters = run(context)
+
+    # Groups are limited by their bytes, the large blob keeps its place and gets an index_document of its own
+    assert context.groups == [["a0", "a2", "a3"], ["a4", "a5", "a6"]]
+    assert [name for _, name in context.started] == ["a1"]
+    assert counters["documents"] == 7
+
+
+def test_group_holds_one_blob_per_file_name():
+    blobs = [{"blob_name": name, "blob_url": f"https://account/source/{name}", "size": 100} for name in ["a/x.pdf", "b/x.pdf", "c.pdf"]]
+    context = FakeContext(make_input(SMALL_DOCUMENT_BYTES=1000, DOCUMENT_GROUP_MAX_DOCUMENTS=10), [blobs])
+
+    run(context)
+
+    assert context.groups == [["a/x.pdf", "c.pdf"]]
+    assert [name for _, name in context.started] == ["b/x.pdf"]
+
+
+def test_blobs_a_group_could_not_crack_are_indexed_alone():
+    blobs = [{**blob, "size": 100} for blob in page("a", 3)]
+    group = {"index_document_group": lambda input_: {"group": 2, "indexed": 2, "superseded": 0, "ungrouped": input_["documents"][1:2]}}
+    context = FakeContext(make_input(SMALL_DOCUMENT_BYTES=1000, DOCUMENT_GROUP_MAX_DOCUMENTS=10), [blobs], results=group)
+
+    counters = run(context)
+
+    assert context.groups == [["a0", "a1", "a2"]]
+    assert [name for _, name in context.started] == ["a1"]
+    assert counters["documents"] == 3 and counters["failed"] == 0
+
+
+def claim_check(stage):
+    return {"claim_check": {"container": "pipeline-payloads", "blob": f"{stage}/0.json", "size": 1}}
+
+
+def test_document_resumes_after_its_checkpointed_stages():
+    document = {**page("a", 1)[0], "index_name": "index", "stage_checkpoints": True, "pipeline_mode": "stages"}
+    key = checkpoint_key(document)
+    results = {name: (lambda stage: lambda input_: claim_check(stage))(name) for name in ["embedding", "extract_entities", "classify"]}
+    results["add_documents"] = lambda input_: {"documents": 3, "uploaded": 3, "failed": 0}
+    context = FakeContext(document, [], results=results, checkpoints={key: {
+        "document_cracking": claim_check("document_cracking"), "chunking": claim_check("chunking")
+    }})
+
+    upload = run(context, run_document)
+
+    assert upload["uploaded"] == 3
+    assert [name for name, _ in context.activities] == [
+        "missing_payloads", "embedding", "extract_entities", "classify", "add_documents", "record_manifest_entry", "delete_payloads"
+    ]
+    # Stages read their input from the checkpoint and are asked for claim checks only
+    assert context.activities[1][1] == force_offload(claim_check("chunking"))
+    assert [(operation, (input_ or {}).get("stage")) for _, _, operation, input_ in context.signals] == [
+        ("set", "embedding"), ("set", "extract_entities"), ("set", "classify"), ("delete", None)
+    ]
+    assert len(context.activities[-1][1]) == 5
+
+
+def test_checkpoint_with_missing_payloads_runs_the_stages_again():
+    document = {**page("a", 1)[0], "index_name": "index", "stage_checkpoints": True, "pipeline_mode": "stages"}
+    key = checkpoint_key(document)
+    stages = ["document_cracking", "chunking", "embedding", "extract_entities", "classify"]
+    results = {name: (lambda stage: lambda input_: claim_check(stage))(name) for name in stages}
+    results["missing_payloads"] = lambda references: references[:1]
+    results["add_documents"] = lambda input_: {"documents": 3, "uploaded": 3, "failed": 0}
+    context = FakeContext(document, [], results=results, checkpoints={key: {
+        "document_cracking": claim_check("document_cracking"), "chunking": claim_check("chunking")
+    }})
+
+    run(context, run_document)
+
+    assert [name for name, _ in context.activities][:6] == ["missing_payloads", *stages]
+    assert context.signals[0] == ("document_checkpoint", key, "delete", None)
+
+
+def test_checkpoint_of_a_document_that_failed_for_good_is_deleted():
+    failed = {**page("a", 3)[1], "index_name": "index"}
+    outputs = {"document_cracking": claim_check("document_cracking"), "chunking": claim_check("chunking")}
+    context = FakeContext(make_input(STAGE_CHECKPOINTS=True), [page("a", 3)], failures={"a1"},
+                          checkpoints={checkpoint_key(failed): outputs})
+
+    with pytest.raises(RuntimeError):
+        run(context)
+
+    assert ("document_checkpoint", checkpoint_key(failed), "delete", None) in context.signals
+    assert ("delete_payloads", list(outputs.values())) in context.activities
+
+
+def test_failed_attempt_without_checkpoints_deletes_its_payloads():
+    document = {**page("a", 1)[0], "index_name": "index", "stage_checkpoints": False, "pipeline_mode": "stages"}
+    stages = ["document_cracking", "chunking", "embedding", "extract_entities", "classify"]
+    results = {name: (lambda stage: lambda input_: claim_check(stage))(name) for name in stages}
+    results["add_documents"] = lambda input_: RuntimeError("upload failed")
+    context = FakeContext(document, [], results=results)
+
+    with pytest.raises(RuntimeError):
+        run(context, run_document)
+
+    assert context.activities[-1] == ("delete_payloads", [claim_check(stage) for stage in stages])
+
+
+def test_interactive_run_keeps_reporting_while_its_documents_run_long():
+    input_ = make_input(LANE_CHECK_SECONDS=10, INTERACTIVE_WINDOW_SIZE=10)
+    input_["priority"] = "interactive"
+    context = FakeContext(input_, [page("a", 2)], durations={"a0": 35, "a1": 35})
+
+    run(context)
+
+    # Reported at 0, refreshed at 10, 20 and 30 while nothing finishes, then once per finished document
+    assert context.lane_reports == [2, 2, 2, 2, 1, 0]
+    assert context.timers[-1].cancelled
+
+
+def test_failed_interactive_run_reports_no_active_documents():
+    input_ = make_input(LANE_CHECK_SECONDS=1, INTERACTIVE_WINDOW_SIZE=10)
+    input_["priority"] = "interactive"
+    context = FakeContext(input_, [page("a", 3)], failures={"a0"})
+
+    with pytest.raises(RuntimeError):
+        run(context)
+
+    assert context.lane_reports == [3, 0]
+
+
+def test_group_records_the_documents_that_were_uploaded_and_releases_their_claims():
+    documents = [
+        {"blob_name": name, "blob_url": f"https://account/source/{name}?sas", "etag": f"etag-{name}", "instance_id": f"document-{name}"}
+        for name in ["a/x.pdf", "b/y.pdf", "c.pdf", "d.pdf"]
+    ]
+    results = {name: (lambda stage: lambda input_: claim_check(stage))(name)
+               for name in ["document_cracking", "chunk_documents", "embedding", "extract_entities", "classify"]}
+    # c.pdf was superseded by a newer version, b/y.pdf failed to upload
+    results["check_document_claim"] = lambda input_: [blob["blob_name"] != "c.pdf" for blob in input_["blobs"]]
+    results["add_documents"] = lambda input_: {"documents": 6, "uploaded": 5, "failed": 1, "failed_files": ["y.pdf"],
+                                               "failed_urls": ["https://account/source/b/y.pdf"]}
+    context = FakeContext({"documents": documents, "index_name": "index"}, [], results=results)
+
+    upload = run(context, run_document_group)
+
+    calls = dict(context.activities)
+    assert calls["chunk_documents"] == [claim_check("document_cracking")] * 4
+    assert calls["add_documents"]["exclude_urls"] == ["https://account/source/c.pdf"]
+    assert [blob["blob_name"] for blob in calls["record_manifest_entry"]["blobs"]] == ["a/x.pdf", "d.pdf"]
+    assert [blob["instance_id"] for blob in calls["release_document_claims"]["blobs"]] == [document["instance_id"] for document in documents]
+    assert upload["group"] == 4 and upload["indexed"] == 2 and upload["superseded"] == 1
+
+
+def test_group_leaves_out_blobs_that_fail_to_crack():
+    documents = [{"blob_name": name, "blob_url": f"https://account/source/{name}?sas"} for name in ["a.pdf", "b.pdf", "c.pdf"]]
+    results = {name: (lambda stage: lambda input_: claim_check(stage))(name)
+               for name in ["chunk_documents", "embedding", "extract_entities", "classify"]}
+    results["document_cracking"] = lambda input_: RuntimeError("corrupt") if input_["offload_output"]["blob_name"] == "b.pdf" else claim_check("document_cracking")
+    results["add_documents"] = lambda input_: {"documents": 2, "uploaded": 2, "failed": 0}
+    context = FakeContext({"documents": documents, "index_name": "index"}, [], results=results)
+
+    upload = run(context, run_document_group)
+
+    calls = dict(context.activities)
+    assert calls["chunk_documents"] == [claim_check("document_cracking")] * 2
+    assert [blob["blob_name"] for blob in calls["record_manifest_entry"]["blobs"]] == ["a.pdf", "c.pdf"]
+    assert upload["ungrouped"] == [documents[1]]
+    assert upload["group"] == 2 and upload["indexed"] == 2
+
+
+def test_documents_with_failed_chunks_are_counted():
+    uploads = {"a0": {"documents": 3, "uploaded": 3, "failed": 0}, "a1": {"documents": 3, "uploaded": 1, "failed": 2}}
+    context = FakeContext(make_input(), [page("a", 3)], results={"index_document": lambda input_: uploads.get(input_["blob_name"])})
+
+    counters = run(context)
+
+    assert counters["documents"] == 3
+    assert counters["failed"] == 1
+    assert context.custom_status["failed"] == 1
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+
+from activities import ingestmanifest
+from activities.ingestmanifest import parse_entry, read_manifest_chunk
+
+
+class FakeBlobClient:
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+
+    def get_blob_properties(self):
+        return SimpleNamespace(size=len(self.data))
+
+    def download_blob(self, offset, length):
+        self.reads.append((offset, length))
+        return SimpleNamespace(readall=lambda: self.data[offset:offset + length])
+
+
+@pytest.fixture
+def manifest(monkeypatch):
+    """Serves the manifest bytes set on the returned namespace from a fake source storage account."""
+    source = SimpleNamespace(blob_client=None)
+    service = SimpleNamespace(get_blob_client=lambda container, blob: source.blob_client)
+    monkeypatch.setattr(ingestmanifest, "get_source_service_client", lambda: service)
+    monkeypatch.setattr(ingestmanifest, "get_source_container_client", lambda name: SimpleNamespace(url=f"https://account/{name}"))
+    return source
+
+
+def read_all(source, data, path, page_size, window_bytes):
+    """Page through a whole manifest, returns the pages of blob names."""
+    source.blob_client = FakeBlobClient(data)
+    pages = []
+    cursor = None
+    while True:
+        result = read_manifest_chunk({"manifest": path, "container_name": "source", "cursor": cursor,
+                                      "page_size": page_size, "window_bytes": window_bytes})
+        pages.append([blob["blob_name"] for blob in result["blobs"]])
+        cursor = result["cursor"]
+        if result["done"]:
+            return pages, result
+
+
+def test_parse_entry_keeps_descriptor_columns_only():
+    columns = ["name", "etag", "size", "owner"]
+
+    assert parse_entry('a.pdf,"0x1",12,legal', columns) == {"blob_name": "a.pdf", "etag": "0x1", "size": 12}
+    assert parse_entry('{"blob_name": "b.pdf", "size": "n/a", "metadata": {"owner": "legal"}}', None) == {"blob_name": "b.pdf"}
+    assert parse_entry('"c.pdf"', None) == {"blob_name": "c.pdf"}
+    assert parse_entry('{"etag": "0x1"}', None) is None
+    assert parse_entry('{"blob_name": ', None) is None
+    assert parse_entry('["d.pdf"]', None) is None
+
+
+def test_malformed_jsonl_lines_are_skipped(manifest):
+    data = b'{"blob_name": "a.pdf"}\n{"blob_name": "b.pdf"\n[1, 2]\n42\n"c.pdf"\n'
+
+    pages, _ = read_all(manifest, data, "manifests/run.jsonl", page_size=10, window_bytes=1024)
+
+    assert pages == [["a.pdf", "c.pdf"]]
+
+
+def test_jsonl_manifest_is_paged_across_windows(manifest):
+    data = "".join(f'{{"blob_name": "doc{i}.pdf"}}\n' for i in range(7)).encode("utf-8")
+
+    pages, last = read_all(manifest, data, "manifests/run.jsonl", page_size=3, window_bytes=40)
+
+    assert pages == [["doc0.pdf", "doc1.pdf", "doc2.pdf"], ["doc3.pdf", "doc4.pdf", "doc5.pdf"], ["doc6.pdf"]]
+    assert last["cursor"]["offset"] == len(data)
+
+
+def test_csv_records_with_line_breaks_are_carried_to_the_next_window(manifest):
+    data = ('\ufeffname,etag,comment\n'
+            'a.pdf,1,"first line\nsecond line"\n'
+            'b.pdf,2,"quoted ""comma"", and\r\nbreak"\n'
+            'c.pdf,3,plain\n').encode("utf-8")
+
+    pages, last = read_all(manifest, data, "manifests/run.csv", page_size=2, window_bytes=24)
+
+    assert [name for page in pages for name in page] == ["a.pdf", "b.pdf", "c.pdf"]
+    assert last["cursor"]["columns"] == ["name", "etag", "comment"]
+    assert manifest.blob_client.reads[0] == (0, 24)
+
+
+def test_blob_urls_point_into_the_source_container(manifest):
+    manifest.blob_client = FakeBlobClient(b'"folder/a b.pdf"\n')
+
+    result = read_manifest_chunk({"manifest": "manifests/run.jsonl", "container_name": "source"})
+
+    assert result["blobs"] == [{"blob_name": "folder/a b.pdf", "blob_url": "https://account/source/folder/a%20b.pdf"}]
+    assert result["done"]
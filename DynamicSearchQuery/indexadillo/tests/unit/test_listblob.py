@@ -0,0 +1,152 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from activities import listblob
+from activities.listblob import container_sas, get_source_blob_client, list_blobs_chunk, sign_blob_url
+
+
+class FakePages:
+    """The pages of `names` from the position in the continuation token on, like ItemPaged.by_page()."""
+
+    def __init__(self, names, page_size, continuation_token):
+        self.names = names
+        self.page_size = page_size
+        self.position = int(continuation_token or 0)
+        self.continuation_token = None
+
+    def __iter__(self):
+        page = self.names[self.position:self.position + self.page_size]
+        end = self.position + len(page)
+        self.continuation_token = str(end) if end < len(self.names) else None
+        yield [blob_properties(name) for name in page]
+
+
+def blob_properties(name):
+    return SimpleNamespace(name=name, etag=f"etag-{name}", size=1, last_modified=None,
+                           content_settings=SimpleNamespace(content_md5=None, content_type="application/pdf"))
+
+
+class FakeContainer:
+    url = "https://account/source"
+
+    def __init__(self, names):
+        self.names = sorted(names)
+
+    def list_blobs(self, name_starts_with, results_per_page):
+        names = [name for name in self.names if name.startswith(name_starts_with)]
+        return SimpleNamespace(by_page=lambda continuation_token: FakePages(names, results_per_page, continuation_token))
+
+
+@pytest.fixture
+def source(monkeypatch):
+    source = SimpleNamespace(container=None)
+    monkeypatch.setattr(listblob, "get_source_container_client", lambda name: source.container)
+    return source
+
+
+def list_all(params):
+    """Call list_blobs_chunk until the listing is done, returns the blob names of every call."""
+    calls = []
+    cursor = None
+    while True:
+        result = list_blobs_chunk({**params, "cursor": cursor})
+        calls.append([blob["blob_name"] for blob in result["blobs"]])
+        cursor = result["cursor"]
+        if result["done"]:
+            return calls
+
+
+def test_prefixes_are_listed_in_parallel_lanes(source):
+    source.container = FakeContainer([f"a/{i}" for i in range(5)] + [f"b/{i}" for i in range(2)] + [f"c/{i}" for i in range(3)])
+
+    calls = list_all({"container_name": "source", "prefix_list": ["a/", "b/", "c/"], "page_size": 4, "prefix_parallelism": 2})
+
+    # Two lanes of two blobs, the lane of b/ is freed after the first call and taken over by c/
+    assert calls == [["a/0", "a/1", "b/0", "b/1"], ["a/2", "a/3", "c/0", "c/1"], ["a/4", "c/2"]]
+
+
+def test_every_blob_is_listed_once(source):
+    names = [f"{prefix}/{i}" for prefix in "abcde" for i in range(7)]
+    source.container = FakeContainer(names)
+
+    calls = list_all({"container_name": "source", "prefix_list": list("abcde"), "page_size": 6, "prefix_parallelism": 3})
+
+    listed = [name for call in calls for name in call]
+    assert sorted(listed) == sorted(names) and len(listed) == len(names)
+
+
+def test_blob_urls_carry_no_sas(source):
+    source.container = FakeContainer(["a/b c.pdf"])
+
+    result = list_blobs_chunk({"container_name": "source", "prefix_list": [""]})
+
+    assert result["blobs"][0]["blob_url"] == "https://account/source/a/b%20c.pdf"
+    assert result["done"]
+
+
+@pytest.fixture
+def account(monkeypatch):
+    monkeypatch.setattr(listblob, "get_source_service_client", lambda: SimpleNamespace(url="https://account/"))
+    monkeypatch.setattr(listblob, "container_sas", lambda name: f"sas-{name}")
+
+
+def test_only_unsigned_urls_of_the_source_account_are_signed(account):
+    assert sign_blob_url("https://account/my%20docs/a.pdf") == "https://account/my%20docs/a.pdf?sas-my docs"
+    assert sign_blob_url("https://account/source/a.pdf?own") == "https://account/source/a.pdf?own"
+    assert sign_blob_url("https://other/source/a.pdf") == "https://other/source/a.pdf"
+
+
+def test_source_blobs_are_read_through_the_shared_container_client(account, monkeypatch):
+    containers = []
+    monkeypatch.setattr(listblob, "get_source_container_client", lambda name: containers.append(name) or SimpleNamespace(
+        get_blob_client=lambda blob_name: ("shared", name, blob_name)))
+
+    assert get_source_blob_client("https://account/source/a/b%20c.pdf") == ("shared", "source", "a/b c.pdf")
+    assert get_source_blob_client("https://other/source/a.pdf").url == "https://other/source/a.pdf"
+    assert containers == ["source"]
+
+
+def test_empty_prefix_list_is_done():
+    assert list_blobs_chunk({"container_name": "source", "prefix_list": []})["done"]
+
+
+class FakeServiceClient:
+    account_name = "account"
+
+    def __init__(self):
+        self.key_requests = []
+
+    def get_user_delegation_key(self, key_start_time, key_expiry_time):
+        self.key_requests.append(key_expiry_time - key_start_time)
+        return SimpleNamespace(signed_expiry=key_expiry_time.isoformat().replace("+00:00", "Z"))
+
+
+@pytest.fixture
+def delegation(monkeypatch):
+    service = FakeServiceClient()
+    signed = []
+    monkeypatch.delenv("SOURCE_STORAGE_ACCOUNT_KEY", raising=False)
+    monkeypatch.setattr(listblob, "_delegation_key", None)
+    monkeypatch.setattr(listblob, "get_source_service_client", lambda: service)
+    monkeypatch.setattr(listblob, "generate_container_sas", lambda **kwargs: signed.append(kwargs) or "sas")
+    return SimpleNamespace(service=service, signed=signed)
+
+
+def test_delegation_key_is_reused_for_later_listings(delegation):
+    container_sas("source")
+    container_sas("source")
+    assert len(delegation.service.key_requests) == 1
+    assert len(delegation.signed) == 2
+
+
+def test_delegation_key_and_sas_stay_within_seven_days(delegation, monkeypatch):
+    monkeypatch.setattr(listblob, "LIST_SAS_EXPIRY_HOURS", 120)
+    before = datetime.datetime.now(datetime.timezone.utc)
+
+    container_sas("source")
+
+    # The key starts five minutes in the past
+    assert delegation.service.key_requests == [datetime.timedelta(days=7, minutes=5)]
+    assert delegation.signed[0]["expiry"] - before <= datetime.timedelta(hours=120, seconds=1)
@@ -0,0 +1,62 @@
+import pytest
+
+from activities import manifest
+from activities.manifest import IndexManifest
+
+
+@pytest.fixture
+def container(monkeypatch, blob_container):
+    monkeypatch.setattr(manifest, "get_container_client", lambda name: blob_container)
+    return blob_container
+
+
+def blob(name, etag="e1", content_md5=None):
+    return {"blob_name": name, "etag": etag, "content_md5": content_md5}
+
+
+def test_unchanged_blobs_are_skipped(container):
+    index = IndexManifest("index")
+    index.record(blob("a.pdf"))
+    index.record(blob("b.pdf", etag="old", content_md5="md5"))
+    blobs = [blob("a.pdf"), blob("b.pdf", etag="new", content_md5="md5"), blob("c.pdf"), blob("d.pdf", etag="e2")]
+    index.record(blob("d.pdf"))
+    assert [b["blob_name"] for b in index.filter_changed(blobs)] == ["c.pdf", "d.pdf"]
+
+
+def test_another_pipeline_version_indexes_again(container, monkeypatch):
+    IndexManifest("index").record(blob("a.pdf"))
+    monkeypatch.setattr(manifest, "EMBEDDING_MODEL", "another-model")
+    assert IndexManifest("index").filter_changed([blob("a.pdf")]) == [blob("a.pdf")]
+
+
+def test_entries_are_kept_per_index(container):
+    IndexManifest("index").record(blob("a.pdf"))
+    assert IndexManifest("other-index").filter_changed([blob("a.pdf")]) == [blob("a.pdf")]
+
+
+def test_a_listing_page_is_looked_up_with_one_listing(container):
+    index = IndexManifest("index")
+    names = [f"contracts/{i:04}.pdf" for i in range(50)]
+    for name in names[::2]:
+        index.record(blob(name))
+    changed = index.filter_changed([blob(name) for name in names])
+    assert [b["blob_name"] for b in changed] == names[1::2]
+    assert (container.lists, container.gets) == (1, 0)
+
+
+def test_scattered_names_are_looked_up_one_by_one(container, monkeypatch):
+    monkeypatch.setattr(manifest, "MANIFEST_LIST_SLACK", 5)
+    index = IndexManifest("index")
+    for i in range(100):
+        index.record(blob(f"{i:03}.pdf"))
+    changed = index.filter_changed([blob("000.pdf"), blob("099.pdf", etag="e2")])
+    assert [b["blob_name"] for b in changed] == ["099.pdf"]
+    assert container.gets == 2
+
+
+def test_long_blob_names_get_a_hashed_entry(container):
+    index = IndexManifest("index")
+    name = "a" * manifest.MAX_BLOB_NAME_LENGTH
+    index.record(blob(name))
+    assert all(len(entry) <= manifest.MAX_BLOB_NAME_LENGTH for entry in container.blobs)
+    assert index.filter_changed([blob(name), blob("b.pdf")]) == [blob("b.pdf")]
@@ -0,0 +1,26 @@
+import pytest
+
+from application import payloadstore
+from application.payloadstore import delete_payloads, load_payload, store_payload
+
+
+@pytest.fixture
+def container(monkeypatch, blob_container):
+    monkeypatch.setattr(payloadstore, "get_container_client", lambda name: blob_container)
+    return blob_container
+
+
+def test_small_payloads_stay_inline(container):
+    assert store_payload({"text": "short"}, "chunks") == {"text": "short"}
+    assert container.blobs == {}
+
+
+def test_identical_payloads_of_two_runs_do_not_share_a_blob(container):
+    payload = [{"text": "x" * 100}]
+    first = store_payload(payload, "chunks", threshold=0)
+    second = store_payload(payload, "chunks", threshold=0)
+    assert first["claim_check"]["blob"] != second["claim_check"]["blob"]
+
+    # The first run finishing must not take the payload away from the second
+    delete_payloads([first])
+    assert load_payload(second) == payload
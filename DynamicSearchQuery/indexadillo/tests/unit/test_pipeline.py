@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from activities.pipeline import run_pipeline
+
+
+def test_windows_flow_through_all_stages_in_order():
+    async def double(window):
+        await asyncio.sleep(0)
+        return [value * 2 for value in window]
+
+    async def total(window):
+        return sum(window)
+
+    outputs = asyncio.run(run_pipeline(list(range(10)), [double, total], window_chunks=3))
+
+    assert outputs == [6, 24, 42, 18]
+
+
+def test_stages_overlap_and_buffering_is_bounded():
+    active = {"stage": 0, "max": 0}
+    progress = {"started": 0, "finished": 0, "ahead": 0}
+
+    async def slow(window):
+        active["stage"] += 1
+        active["max"] = max(active["max"], active["stage"])
+        await asyncio.sleep(0.01)
+        active["stage"] -= 1
+        return window
+
+    async def record(window):
+        progress["started"] += 1
+        # Windows taken in by the first stage that the last stage has not finished yet
+        progress["ahead"] = max(progress["ahead"], progress["started"] - progress["finished"])
+        return window
+
+    async def last(window):
+        window = await slow(window)
+        progress["finished"] += 1
+        return window
+
+    outputs = asyncio.run(run_pipeline(list(range(40)), [record, slow, last], window_chunks=2, queue_windows=1))
+
+    assert [window[0] for window in outputs] == list(range(0, 40, 2))
+    # Both slow stages work on a window at the same time
+    assert active["max"] == 2
+    # Every stage holds one window and every queue between two stages one more, the fast first stage
+    # runs ahead of the slow ones by no more than that instead of taking in all 20 windows at once
+    assert 1 < progress["ahead"] <= 3 + 2 * 1
+
+
+def test_failing_stage_cancels_the_pipeline():
+    async def fail(window):
+        if window[0] == 4:
+            raise RuntimeError("upload failed")
+        return window
+
+    async def forever(window):
+        return window
+
+    with pytest.raises(RuntimeError, match="upload failed"):
+        asyncio.run(asyncio.wait_for(run_pipeline(list(range(100)), [forever, fail], window_chunks=2, queue_windows=1), 5))
@@ -0,0 +1,95 @@
+import email.utils
+import time
+
+import pytest
+
+from application import ratelimit
+from application.ratelimit import RateLimiter, TokenBucket, get_rate_limiter, retry_after_seconds
+
+
+def test_bucket_allows_a_burst_then_waits_for_the_refill():
+    bucket = TokenBucket(per_minute=60)
+    now = bucket.updated
+    # Holds BURST_SECONDS of its rate
+    assert bucket.reserve(ratelimit.BURST_SECONDS, now) == 0.0
+    assert bucket.reserve(2, now) == pytest.approx(2.0)
+    # Two seconds later the debt is paid off
+    assert bucket.reserve(1, now + 2) == pytest.approx(1.0)
+
+
+def test_bucket_does_not_store_more_than_a_burst():
+    bucket = TokenBucket(per_minute=60)
+    now = bucket.updated + 3600
+    assert bucket.reserve(ratelimit.BURST_SECONDS + 5, now) == pytest.approx(5.0)
+
+
+def test_bucket_keeps_its_level_when_the_rate_changes():
+    bucket = TokenBucket(per_minute=60)
+    now = bucket.updated
+    bucket.reserve(ratelimit.BURST_SECONDS, now)
+    bucket.set_rate(120, now)
+    assert bucket.reserve(4, now) == pytest.approx(2.0)
+
+
+@pytest.mark.parametrize("headers, seconds", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"x-ms-retry-after-ms": "250"}, 0.25),
+    ({"retry-after": "3"}, 3.0),
+    # Milliseconds win over seconds
+    ({"retry-after-ms": "500", "retry-after": "3"}, 0.5),
+    ({"retry-after-ms": "soon", "retry-after": "3"}, 3.0),
+    ({"retry-after": "soon"}, None),
+    ({}, None),
+])
+def test_retry_after_headers(headers, seconds):
+    assert retry_after_seconds(headers) == seconds
+
+
+def test_retry_after_http_date():
+    at = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 <= retry_after_seconds({"retry-after": at}) <= 30
+    assert retry_after_seconds({"retry-after": email.utils.formatdate(time.time() - 30, usegmt=True)}) == 0.0
+
+
+def test_throttling_halves_the_rate_once_per_pause():
+    limiter = RateLimiter("embedding", 0, 60000)
+    limiter.throttled(10)
+    # Responses of requests that were already in flight belong to the same episode
+    limiter.throttled(10)
+    assert limiter.factor == 0.5
+    assert limiter.tokens.rate == pytest.approx(500)
+    assert limiter.paused_until > time.time() + 9
+
+
+def test_rate_does_not_drop_below_the_minimum_factor():
+    limiter = RateLimiter("embedding", 60, 0)
+    for _ in range(10):
+        limiter.paused_until = 0.0
+        limiter.throttled(0)
+    assert limiter.factor == ratelimit.RATE_LIMIT_MIN_FACTOR
+
+
+def test_quiet_sync_increases_the_rate_again():
+    limiter = RateLimiter("embedding", 60, 0)
+    limiter.throttled(0)
+    # The sync that carries the throttling keeps the lowered rate
+    limiter.sync()
+    assert limiter.factor == 0.5
+    limiter.sync()
+    assert limiter.factor == pytest.approx(0.5 + ratelimit.RATE_LIMIT_INCREASE)
+    assert limiter.requests.rate == pytest.approx(limiter.factor)
+
+
+@pytest.fixture
+def limiters(monkeypatch):
+    monkeypatch.setattr(ratelimit, "_limiters", {})
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_COORDINATION", "blob")
+
+
+def test_only_limited_services_are_coordinated(limiters, monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_EMBEDDING_TPM", "350000")
+    monkeypatch.delenv("RATE_LIMIT_SEARCH_RPM", raising=False)
+    monkeypatch.delenv("RATE_LIMIT_SEARCH_TPM", raising=False)
+    assert get_rate_limiter("embedding").coordinator is not None
+    assert get_rate_limiter("search").coordinator is None
+    assert get_rate_limiter("search") is get_rate_limiter("search")
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from activities import search
+from activities.search import SearchManager
+
+
+class FakeSearchClient:
+    """Fails every key in `failures` with the listed status codes, one per attempt, then lets it through."""
+
+    def __init__(self, failures):
+        self.failures = {key: list(statuses) for key, statuses in failures.items()}
+        self.requests = []
+
+    async def merge_or_upload_documents(self, documents):
+        self.requests.append([document["id"] for document in documents])
+        results = []
+        for document in documents:
+            statuses = self.failures.get(document["id"])
+            status = statuses.pop(0) if statuses else 200
+            results.append(SimpleNamespace(key=document["id"], succeeded=status == 200, status_code=status, error_message="error"))
+        return results
+
+
+@pytest.fixture(autouse=True)
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(search, "SEARCH_UPLOAD_RETRY_SECONDS", 0)
+    monkeypatch.setattr(search, "SEARCH_UPLOAD_MAX_RETRIES", 2)
+
+
+def upload(client, keys):
+    manager = SearchManager(search_info=None, embeddings=None)
+    return asyncio.run(manager.upload_batch(client, [{"id": key} for key in keys]))
+
+
+def test_only_retriable_keys_are_retried():
+    client = FakeSearchClient({"b": [503], "c": [400]})
+
+    result = upload(client, ["a", "b", "c"])
+
+    assert client.requests == [["a", "b", "c"], ["b"]]
+    assert result == {"uploaded": 2, "failed_keys": ["c"], "retries": 1}
+
+
+def test_keys_that_keep_failing_are_reported_after_the_last_attempt():
+    client = FakeSearchClient({"a": [429, 429, 429]})
+
+    result = upload(client, ["a", "b"])
+
+    assert client.requests == [["a", "b"], ["a"], ["a"]]
+    assert result == {"uploaded": 1, "failed_keys": ["a"], "retries": 2}
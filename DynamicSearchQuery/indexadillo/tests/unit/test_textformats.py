@@ -0,0 +1,63 @@
+import io
+import json
+import zipfile
+from activities.textformats import detect_format, parse_pages, sniff_format, split_pages
+
+DOCX_BODY = (
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+    '<w:p><w:r><w:t>First page</w:t></w:r></w:p>'
+    '<w:p><w:r><w:br w:type="page"/><w:t>Second page</w:t></w:r></w:p>'
+    '<w:tbl><w:tr><w:tc><w:p><w:r><w:t>a</w:t></w:r></w:p></w:tc><w:tc><w:p><w:r><w:t>b</w:t></w:r></w:p></w:tc></w:tr></w:tbl>'
+    '</w:body></w:document>'
+)
+
+
+def make_docx(document_xml: str) -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        archive.writestr("word/document.xml", document_xml)
+    return data.getvalue()
+
+
+def test_detect_format_by_extension_and_content_type():
+    assert detect_format("notes.MD") == "markdown"
+    assert detect_format("report.pdf") is None
+    assert detect_format("README", "text/plain; charset=utf-8") == "text"
+    assert detect_format("scan.png", "text/plain") is None
+
+
+def test_sniff_format_rejects_pdf_content():
+    assert sniff_format(b"%PDF-1.7 ...", "text") is None
+    assert sniff_format(b"plain text", "text") == "text"
+    assert sniff_format(make_docx(DOCX_BODY), "docx") == "docx"
+
+
+def test_split_pages_keeps_paragraphs_and_form_feeds():
+    paragraphs = [f"paragraph {i} " + "x" * 80 for i in range(10)]
+    pages = split_pages("\n\n".join(paragraphs[:5]) + "\f" + "\n\n".join(paragraphs[5:]), page_chars=200)
+
+    assert "".join(pages).replace("\n", "") == "".join(paragraphs)
+    assert all(len(page) <= 200 for page in pages)
+    assert pages[2].startswith("paragraph 4")
+    assert pages[3].startswith("paragraph 5")
+    assert split_pages("") == [""]
+
+
+def test_parse_docx_pages_and_tables():
+    pages = parse_pages(make_docx(DOCX_BODY), "docx")
+
+    assert pages[0] == "First page"
+    assert pages[1].startswith("Second page")
+    assert "--- TABLE START ---\na | b\n--- TABLE END ---" in pages[1]
+
+
+def test_parse_html_skips_scripts():
+    html = b"<html><head><title>t</title><script>var x;</script></head><body><h1>Title</h1><p>Body &amp; text</p></body></html>"
+
+    assert parse_pages(html, "html") == ["Title\n\nBody & text"]
+
+
+def test_parse_json_is_pretty_printed():
+    pages = parse_pages(json.dumps({"name": "Contoso", "items": [1, 2]}).encode(), "json")
+
+    assert pages == [json.dumps({"name": "Contoso", "items": [1, 2]}, indent=2)]
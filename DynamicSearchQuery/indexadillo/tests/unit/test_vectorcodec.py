@@ -0,0 +1,49 @@
+import json
+import numpy as np
+from application.vectorcodec import chunk_list, embedding_matrix, is_packed, pack_embeddings, unpack_embeddings
+
+
+def make_chunks(count: int, dimensions: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(scale=0.05, size=(count, dimensions)).astype(np.float32)
+    return [{"text": f"chunk {i}", "embedding": vector.tolist()} for i, vector in enumerate(vectors)], vectors
+
+
+def test_float32_round_trip_is_exact():
+    chunks, vectors = make_chunks(5, 3072)
+    payload = json.loads(json.dumps(pack_embeddings(chunks, "float32")))
+
+    assert is_packed(payload)
+    assert all("embedding" not in chunk for chunk in chunk_list(payload))
+    np.testing.assert_array_equal(embedding_matrix(payload), vectors)
+    restored = unpack_embeddings(payload)
+    assert [chunk["text"] for chunk in restored] == [f"chunk {i}" for i in range(5)]
+    assert [chunk["embedding"] for chunk in restored] == vectors.tolist()
+
+
+def test_float16_round_trip_keeps_cosine_similarity():
+    chunks, vectors = make_chunks(20, 3072)
+    decoded = embedding_matrix(json.loads(json.dumps(pack_embeddings(chunks, "float16"))))
+
+    cosine = np.sum(decoded * vectors, axis=1) / (np.linalg.norm(decoded, axis=1) * np.linalg.norm(vectors, axis=1))
+    assert decoded.dtype == np.float32
+    assert np.all(cosine > 0.9999)
+
+
+def test_json_encoding_and_plain_payloads_are_unchanged():
+    chunks, vectors = make_chunks(3, 8)
+
+    payload = pack_embeddings(chunks, "json")
+
+    assert payload is chunks
+    assert not is_packed(payload)
+    assert chunk_list(payload) is chunks
+    assert unpack_embeddings(payload) is chunks
+    np.testing.assert_array_equal(embedding_matrix(payload), vectors)
+
+
+def test_empty_document():
+    payload = json.loads(json.dumps(pack_embeddings([], "float32")))
+
+    assert embedding_matrix(payload).shape == (0, 0)
+    assert unpack_embeddings(payload) == []